@@ -5,12 +5,16 @@ import time
 import httpx
 
 import config_manager
+import log_manager
 import request_manager
+import model_catalog
 import oai_tools
 
 
-# Pull the provider specific options or set defaults if they don't exist already.
-ADAPTER_CONFIG = config_manager.get_provider_options("ANTHROPIC", {"base_url": "https://api.anthropic.com", "api_key":""})
+# Provider specific options, read live from the current config with defaults for anything missing.
+PROVIDER = "ANTHROPIC"
+LOGGER = log_manager.get_logger("adapter_anthropic")
+ADAPTER_CONFIG = config_manager.ProviderOptions(PROVIDER, {"base_url": "https://api.anthropic.com", "api_key":""})
     
 async def construct_request(request_headers, endpoint):
     api_key = ADAPTER_CONFIG["api_key"]
@@ -102,14 +106,107 @@ def convert_anthropic_response_to_openai(anthropic_response):
     
     return openai_response
 
+# Anthropic stop reasons mapped to their OpenAI finish_reason.
+FINISH_REASONS = {
+    "end_turn": "stop",
+    "stop_sequence": "stop",
+    "max_tokens": "length",
+    "tool_use": "tool_calls"
+}
+
+async def stream_messages_response(upstream, model_name):
+    # Translates Anthropic's message event stream into OpenAI chunks as each event arrives.
+    created_time = int(time.time())
+    chat_id = f"chatcmpl-{created_time}"
+    prompt_tokens = 0
+    completion_tokens = 0
+    # Anthropic numbers every content block, OpenAI only numbers the tool calls.
+    tool_call_indexes = {}
+
+    anthropic_events = request_manager.iter_sse_data(upstream)
+    try:
+        async for data in anthropic_events:
+            event = json.loads(data)
+            event_type = event.get("type")
+
+            if event_type == "message_start":
+                message = event.get("message", {})
+                chat_id = message.get("id", chat_id).replace("msg_", "chatcmpl-")
+                model_name = message.get("model", model_name)
+                prompt_tokens = message.get("usage", {}).get("input_tokens", 0)
+                completion_tokens = message.get("usage", {}).get("output_tokens", 0)
+                yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {"role": "assistant", "content": ""})
+
+            elif event_type == "content_block_start":
+                content_block = event.get("content_block", {})
+                if content_block.get("type") == "tool_use":
+                    tool_call_index = len(tool_call_indexes)
+                    tool_call_indexes[event["index"]] = tool_call_index
+                    yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {
+                        "tool_calls": [{
+                            "index": tool_call_index,
+                            "id": content_block.get("id", "").replace("toolu_", "call_"),
+                            "type": "function",
+                            "function": {
+                                "name": content_block.get("name"),
+                                "arguments": ""
+                            }
+                        }]
+                    })
+                elif content_block.get("type") == "text" and content_block.get("text"):
+                    yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {"content": content_block["text"]})
+
+            elif event_type == "content_block_delta":
+                delta = event.get("delta", {})
+                if delta.get("type") == "text_delta":
+                    yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {"content": delta.get("text", "")})
+                elif delta.get("type") == "input_json_delta" and delta.get("partial_json"):
+                    tool_call_index = tool_call_indexes.get(event.get("index"))
+                    if tool_call_index is not None:
+                        yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {
+                            "tool_calls": [{
+                                "index": tool_call_index,
+                                "function": {"arguments": delta["partial_json"]}
+                            }]
+                        })
+
+            elif event_type == "message_delta":
+                completion_tokens = event.get("usage", {}).get("output_tokens", completion_tokens)
+                stop_reason = event.get("delta", {}).get("stop_reason")
+                yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {}, FINISH_REASONS.get(stop_reason, "stop"))
+
+            elif event_type == "message_stop":
+                yield oai_tools.build_usage_chunk(chat_id, created_time, model_name, prompt_tokens, completion_tokens)
+                break
+
+            elif event_type == "error":
+                LOGGER.error("Error in Anthropic stream: %s", event.get('error'))
+                yield json.dumps({"error": event.get("error", request_manager.ERROR_UNKNOWN_ERROR["error"])})
+                break
+    finally:
+        await anthropic_events.aclose()
+    yield "[DONE]"
+
+async def stream_chat_completions(request_headers, request_body):
+    request_body["stream"] = True
+    url, headers = await construct_request(request_headers, "/v1/messages")
+    headers["Accept"] = "text/event-stream"
+    response = await request_manager.open_stream("POST", url, headers, request_body, provider=PROVIDER)
+    if response.success:
+        response.body = stream_messages_response(response.body, request_body.get("model"))
+        response.stream = True
+    return response
+
 async def chat_completions(request_headers,request_body):
    
     is_streaming_response = request_body.get("stream", False)
     request_body['stream'] = False
     if 'tools' in request_body:
         request_body = convert_openai_request_to_anthropic(request_body)
+        if is_streaming_response:
+            return await stream_chat_completions(request_headers, request_body)
         url, headers = await construct_request(request_headers, "/v1/messages")   
-        response = await request_manager.send_request("POST", url, headers, request_body)
+        response = await request_manager.send_request("POST", url, headers, request_body, provider=PROVIDER)
         if response.status_code == 200:
             response.success = True
             response.body = convert_anthropic_response_to_openai(response.body)
@@ -147,11 +244,19 @@ async def chat_completions(request_headers,request_body):
     number_of_completions = request_body.get("n", 1)
     if 'n'  in request_body:
         del request_body['n']    
+
+    if is_streaming_response and number_of_completions == 1:
+        return await stream_chat_completions(request_headers, request_body)
+
     openai_response = request_manager.ResponseStatus(0, None)
 
-    for i in range(0,number_of_completions):
-        url, headers = await construct_request(request_headers, "/v1/messages")   
-        response = await request_manager.send_request("POST", url, headers, request_body)
+    async def send_completion():
+        url, headers = await construct_request(request_headers, "/v1/messages")
+        return await request_manager.send_request("POST", url, headers, request_body, provider=PROVIDER)
+
+    # The n completions run side by side, each one takes the next index as it finishes.
+    max_parallel_completions = ADAPTER_CONFIG.get("max_parallel_completions", request_manager.DEFAULT_MAX_PARALLEL_COMPLETIONS)
+    for response in await request_manager.fan_out(number_of_completions, send_completion, max_parallel_completions):
 
         openai_response.status_code = response.status_code
         if response.status_code == 400:
@@ -168,7 +273,7 @@ async def chat_completions(request_headers,request_body):
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
         elif not "content" in response.body:
-            print("Messages not found in response")
+            LOGGER.error("Messages not found in response")
             openai_response.status_code = 500
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
@@ -230,7 +335,10 @@ async def chat_completions(request_headers,request_body):
     response.status_code = 200
     return response
     
-async def list_models(request_headers, request_body):    
+async def list_models(request_headers, request_body):
+    return await model_catalog.list_models(PROVIDER, fetch_models, request_headers, request_body)
+
+async def fetch_models(request_headers, request_body):
     ### TODO: Implement actual API Polling - They Hardcode it into their SDK so I don't feel that bad about this
     response = {
         "object": "list",
@@ -278,25 +386,21 @@ async def list_models(request_headers, request_body):
     return openai_response    
     
 async def get_model(request_headers, request_body):
-    # This is a little gross because we have to list all models to get any details.
+    # Served from the cached model list, so this never has to go upstream on its own.
     created_time = 0
     owner = "organization-owner"
-    list_response = await list_models(request_headers, request_body)
+    model, failed_response = await model_catalog.find_model(PROVIDER, fetch_models, request_headers, request_body, request_body['model_id'])
     openai_response = request_manager.ResponseStatus(0, None)
 
-    if list_response.success is False:
+    if failed_response is not None:
         openai_response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
         openai_response.status_code = 500
         return openai_response
     
-    list_of_models = list_response.body['data']
-    model_exists = False
-    for model in list_of_models:
-        if model["id"] == request_body['model_id']:
-            created_time = model["created"]
-            owner = model["owned_by"]
-            model_exists = True
-            break
+    model_exists = model is not None
+    if model_exists:
+        created_time = model["created"]
+        owner = model["owned_by"]
 
     # We'll handle the error message in the main code.
     if not model_exists:
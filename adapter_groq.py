@@ -1,14 +1,20 @@
+import logging
 import json
 import time
 import httpx
 import dirtyjson
 
 import config_manager
+import log_manager
 import request_manager
+import model_catalog
+import oai_tools
 
 
-# Pull the provider specific options or set defaults if they don't exist already.
-ADAPTER_CONFIG = config_manager.get_provider_options("GROQ", {"base_url": "https://api.groq.com/openai", "api_key":""})
+# Provider specific options, read live from the current config with defaults for anything missing.
+PROVIDER = "GROQ"
+LOGGER = log_manager.get_logger("adapter_groq")
+ADAPTER_CONFIG = config_manager.ProviderOptions(PROVIDER, {"base_url": "https://api.groq.com/openai", "api_key":""})
     
 async def construct_request(request_headers, endpoint):
     api_key = ADAPTER_CONFIG["api_key"]
@@ -36,19 +42,7 @@ async def process_function_calling(request_headers, request_body):
         return response
 
     # Construct the system prompt explaining the available functions and their parameters
-    system_prompt = "You have the following functions available to you:\n"
-    for tool in request_body.get("tools", []):
-        function_info = tool.get("function", {})
-        function_name = function_info.get("name")
-        parameters = function_info.get("parameters", {})
-
-        system_prompt += f"- Function Name: {function_name}, Parameters: {json.dumps(parameters)}\n"
-    
-    system_prompt += "Please execute any function you deem appropriate based on the context provided.\n"
-    system_prompt += """ Respond only in a valid JSON block containing the following keys: \n
-    "name": "function_name", \n
-    "arguments": { "parameter1": "value1", "parameter2": "value2" } \n
-    """
+    system_prompt = oai_tools.build_tool_prompt(request_body.get("tools", []))
 
     # Add this system prompt to the message history for the /api/chat request
     if "messages" not in request_body:
@@ -76,11 +70,11 @@ async def process_function_calling(request_headers, request_body):
     
 
     # Send the request to the LLM
-    print("WARN: Sending Tool Request - This is SUPER Experimental!")
+    log_manager.log_event(LOGGER, logging.DEBUG, "tool_emulation", "Sending tool request through the experimental tool emulation")
     url, headers = await construct_request(request_headers, "/v1/chat/completions")
-    mistral_response = await request_manager.send_request("POST", url, headers=headers, body=request_body)
+    mistral_response = await request_manager.send_request("POST", url, headers=headers, body=request_body, provider=PROVIDER)
    
-    print(mistral_response.body)
+    log_manager.log_payload(LOGGER, "tool_emulation_response", "Tool emulation response", mistral_response.body)
 
     # Validate the LLM's response
     if mistral_response.status_code != 200:
@@ -147,6 +141,22 @@ async def process_function_calling(request_headers, request_body):
     openai_response.success = True
     return openai_response
 
+def promote_groq_usage(chunk):
+    # Groq tucks the usage block into x_groq on the last chunk, OpenAI clients look for it at the top level.
+    x_groq = chunk.get("x_groq")
+    if x_groq is not None and "usage" in x_groq:
+        chunk["usage"] = x_groq["usage"]
+    return chunk
+
+async def stream_chat_completions(request_headers, provider_request):
+    url, headers = await construct_request(request_headers, "/v1/chat/completions")
+    headers["Accept"] = "text/event-stream"
+    response = await request_manager.open_stream("POST", url, headers, provider_request, provider=PROVIDER)
+    if response.success:
+        response.body = oai_tools.relay_openai_stream(response.body, promote_groq_usage, '"x_groq"')
+        response.stream = True
+    return response
+
 async def chat_completions(request_headers, request_body):
 
     is_streaming_response = request_body.get("stream", False)
@@ -173,7 +183,7 @@ async def chat_completions(request_headers, request_body):
             provider_request["messages"][i]["seed"] == request_body['seed']
 
     if "stop" in request_body:
-        print("WARNING: Only using the first stop paramter")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Only using the first stop parameter")
         provider_request["stop"] = request_body["stop"][0]
 
     if "tools" in request_body:
@@ -186,13 +196,22 @@ async def chat_completions(request_headers, request_body):
         if not request_body['model'].startswith("mistral-large"):
             return await process_function_calling(request_headers, request_body)
 
+    # Single completions can be streamed straight through, n > 1 still gets stitched together below.
+    if is_streaming_response and number_of_completions == 1:
+        provider_request["stream"] = True
+        return await stream_chat_completions(request_headers, provider_request)
+
     response_messages = []
     prompt_tokens = 0
     completion_tokens = 0
     response_content = {}
-    for i in range(0,number_of_completions):
-        url, headers = await construct_request(request_headers, "/v1/chat/completions")   
-        response = await request_manager.send_request("POST", url, headers, provider_request)
+    async def send_completion():
+        url, headers = await construct_request(request_headers, "/v1/chat/completions")
+        return await request_manager.send_request("POST", url, headers, provider_request, provider=PROVIDER)
+
+    # The n completions run side by side, each one takes the next index as it finishes.
+    max_parallel_completions = ADAPTER_CONFIG.get("max_parallel_completions", request_manager.DEFAULT_MAX_PARALLEL_COMPLETIONS)
+    for response in await request_manager.fan_out(number_of_completions, send_completion, max_parallel_completions):
         
         openai_response.status_code = response.status_code
         if response.status_code == 400:
@@ -209,7 +228,7 @@ async def chat_completions(request_headers, request_body):
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
         elif not "choices" in response.body:
-            print("Messages not found in response")
+            LOGGER.error("Messages not found in response")
             openai_response.status_code = 500
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
@@ -235,47 +254,46 @@ async def chat_completions(request_headers, request_body):
         
         for choice in response_content["choices"]:
             tool_index = 0
-            for i in range(0,len(choice['message']["tool_calls"])):
+            for i in range(0,len(choice['message'].get("tool_calls", []))):
                 choice['message']['tool_calls'][i]['index'] = tool_index
                 tool_index += 1
             choice['delta'] = choice['message']
             del choice['message']
             stream_choices.append(choice)
         response_content["choices"] = stream_choices
-        print(response_content)
+        log_manager.log_payload(LOGGER, "fallback_stream_body", "Whole response for the fallback stream", response_content)
     
     openai_response = request_manager.ResponseStatus(response.status_code, response_content)
     openai_response.success = True
     return openai_response
     
 
-async def list_models(request_headers, request_body):    
+async def list_models(request_headers, request_body):
+    return await model_catalog.list_models(PROVIDER, fetch_models, request_headers, request_body)
+
+async def fetch_models(request_headers, request_body):
     url,headers= await construct_request(request_headers, "/v1/models")
-    openai_response = await request_manager.send_request("GET", url, headers)
+    openai_response = await request_manager.send_request("GET", url, headers, provider=PROVIDER)
     if openai_response.status_code == 200:
         openai_response.success = True
     return openai_response        
     
 async def get_model(request_headers, request_body):
-    # This is a little gross because we have to list all models to get any details.
+    # Served from the cached model list, so this never has to go upstream on its own.
     created_time = 0
     owner = "organization-owner"
-    list_response = await list_models(request_headers, request_body)
+    model, failed_response = await model_catalog.find_model(PROVIDER, fetch_models, request_headers, request_body, request_body['model_id'])
     openai_response = request_manager.ResponseStatus(0, None)
 
-    if list_response.success is False:
+    if failed_response is not None:
         openai_response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
         openai_response.status_code = 500
         return openai_response
     
-    list_of_models = list_response.body['data']
-    model_exists = False
-    for model in list_of_models:
-        if model["id"] == request_body['model_id']:
-            created_time = model["created"]
-            owner = model["owned_by"]
-            model_exists = True
-            break
+    model_exists = model is not None
+    if model_exists:
+        created_time = model["created"]
+        owner = model["owned_by"]
 
     # We'll handle the error message in the main code.
     if not model_exists:
@@ -302,7 +320,7 @@ async def process_request(request_type, request_headers, request_body):
         return await chat_completions(request_headers, request_body)
     # Embeddings API Handling
     elif request_type == "/v1/embeddings":
-        print("GROQ Doesn't Have Embedding Models Yet")
+        LOGGER.warning("GROQ doesn't have embedding models yet")
         return request_manager.ResponseStatus(400, request_manager.ERROR_NOT_IMPLEMENTED)
     # Model API Handling
     elif request_type == "/v1/models":
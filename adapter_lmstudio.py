@@ -1,3 +1,4 @@
+import logging
 import json
 import base64
 import struct
@@ -6,12 +7,21 @@ import httpx
 import dirtyjson
 
 import config_manager
+import log_manager
 import request_manager
+import model_catalog
+import embedding_cache
+import backend_pool
+import request_scheduler
 import oai_tools
 
 
-# Pull the provider specific options or set defaults if they don't exist already.
-ADAPTER_CONFIG = config_manager.get_provider_options("LMSTUDIO", {"base_url": "http://localhost:1234", "api_key":""})
+# Provider specific options, read live from the current config with defaults for anything missing.
+PROVIDER = "LMSTUDIO"
+LOGGER = log_manager.get_logger("adapter_lmstudio")
+ADAPTER_CONFIG = config_manager.ProviderOptions(PROVIDER, {"base_url": "http://localhost:1234", "api_key":""})
+backend_pool.register_provider(PROVIDER, "/v1/models")
+request_scheduler.register_provider(PROVIDER)
     
 async def construct_request(request_headers, endpoint):
     api_key = ADAPTER_CONFIG["api_key"]
@@ -22,7 +32,8 @@ async def construct_request(request_headers, endpoint):
         "Accept": "application/json",
         "Content-Type": "application/json"
     }    
-    url = f"{ADAPTER_CONFIG['base_url']}{endpoint}"
+    base_url = backend_pool.select_backend(PROVIDER, ADAPTER_CONFIG)
+    url = f"{base_url}{endpoint}"
     return url, headers
 
 async def process_function_calling(request_headers, request_body):
@@ -39,19 +50,7 @@ async def process_function_calling(request_headers, request_body):
         return response
 
     # Construct the system prompt explaining the available functions and their parameters
-    system_prompt = "You have the following functions available to you:\n"
-    for tool in request_body.get("tools", []):
-        function_info = tool.get("function", {})
-        function_name = function_info.get("name")
-        parameters = function_info.get("parameters", {})
-
-        system_prompt += f"- Function Name: {function_name}, Parameters: {json.dumps(parameters)}\n"
-    
-    system_prompt += "Please execute any function you deem appropriate based on the context provided.\n"
-    system_prompt += """ Respond only in a valid JSON block containing the following keys: \n
-    "name": "function_name", \n
-    "arguments": { "parameter1": "value1", "parameter2": "value2" } \n
-    """
+    system_prompt = oai_tools.build_tool_prompt(request_body.get("tools", []))
 
     # Add this system prompt to the message history for the /api/chat request
     if "messages" not in request_body:
@@ -79,9 +78,9 @@ async def process_function_calling(request_headers, request_body):
     
 
     # Send the request to the LLM
-    print("WARN: Sending Tool Request - This is SUPER Experimental!")
+    log_manager.log_event(LOGGER, logging.DEBUG, "tool_emulation", "Sending tool request through the experimental tool emulation")
     url, headers = await construct_request(request_headers, "/v1/chat/completions")
-    mistral_response = await request_manager.send_request("POST", url, headers=headers, body=request_body)
+    mistral_response = await request_manager.send_request("POST", url, headers=headers, body=request_body, provider=PROVIDER)
    
 
     # Validate the LLM's response
@@ -151,6 +150,15 @@ async def process_function_calling(request_headers, request_body):
     openai_response.success = True
     return openai_response
 
+async def stream_chat_completions(request_headers, provider_request):
+    url, headers = await construct_request(request_headers, "/v1/chat/completions")
+    headers["Accept"] = "text/event-stream"
+    response = await request_manager.open_stream("POST", url, headers, provider_request, provider=PROVIDER)
+    if response.success:
+        response.body = oai_tools.relay_openai_stream(response.body)
+        response.stream = True
+    return response
+
 async def chat_completions(request_headers, request_body):
 
     is_streaming_response = request_body.get("stream", False)
@@ -177,7 +185,7 @@ async def chat_completions(request_headers, request_body):
             provider_request["messages"][i]["seed"] == request_body['seed']
 
     if "stop" in request_body:
-        print("WARNING: Only using the first stop paramter")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Only using the first stop parameter")
         provider_request["stop"] = request_body["stop"][0]
 
     if "tools" in request_body:
@@ -190,13 +198,22 @@ async def chat_completions(request_headers, request_body):
         if not request_body['model'].startswith("mistral-large"):
             return await process_function_calling(request_headers, request_body)
 
+    # Single completions can be streamed straight through, n > 1 still gets stitched together below.
+    if is_streaming_response and number_of_completions == 1:
+        provider_request["stream"] = True
+        return await stream_chat_completions(request_headers, provider_request)
+
     response_messages = []
     prompt_tokens = 0
     completion_tokens = 0
     response_content = {}
-    for i in range(0,number_of_completions):
-        url, headers = await construct_request(request_headers, "/v1/chat/completions")   
-        response = await request_manager.send_request("POST", url, headers, provider_request)
+    async def send_completion():
+        url, headers = await construct_request(request_headers, "/v1/chat/completions")
+        return await request_manager.send_request("POST", url, headers, provider_request, provider=PROVIDER)
+
+    # The n completions run side by side, each one takes the next index as it finishes.
+    max_parallel_completions = ADAPTER_CONFIG.get("max_parallel_completions", request_manager.DEFAULT_MAX_PARALLEL_COMPLETIONS)
+    for response in await request_manager.fan_out(number_of_completions, send_completion, max_parallel_completions):
         
         openai_response.status_code = response.status_code
         if response.status_code == 400:
@@ -213,7 +230,7 @@ async def chat_completions(request_headers, request_body):
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
         elif not "choices" in response.body:
-            print("Messages not found in response")
+            LOGGER.error("Messages not found in response")
             openai_response.status_code = 500
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
@@ -239,57 +256,58 @@ async def chat_completions(request_headers, request_body):
         
         for choice in response_content["choices"]:
             tool_index = 0
-            for i in range(0,len(choice['message']["tool_calls"])):
+            for i in range(0,len(choice['message'].get("tool_calls", []))):
                 choice['message']['tool_calls'][i]['index'] = tool_index
                 tool_index += 1
             choice['delta'] = choice['message']
             del choice['message']
             stream_choices.append(choice)
         response_content["choices"] = stream_choices
-        print(response_content)
+        log_manager.log_payload(LOGGER, "fallback_stream_body", "Whole response for the fallback stream", response_content)
     
     openai_response = request_manager.ResponseStatus(response.status_code, response_content)
     openai_response.success = True
     return openai_response
     
 async def get_embeddings(request_headers, request_body):
+    return await embedding_cache.get_embeddings(PROVIDER, request_body.get("model"), fetch_embeddings, request_headers, request_body, ADAPTER_CONFIG.get("native_base64_embeddings", False))
+
+async def fetch_embeddings(request_headers, request_body):
     if "dimensions" in request_body:
-        print("WARNING: Dimensions parameter is not supported. Ignoring.")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Dimensions parameter is not supported. Ignoring.")
     
     input_list = request_body["input"]
     encoding_format = request_body.get("encoding_format", "float")
     if not isinstance(input_list, list):
         input_list = [input_list]
 
+    # Only ask upstream for base64 if it's known to speak it, otherwise floats get encoded here.
+    native_base64 = ADAPTER_CONFIG.get("native_base64_embeddings", False)
     mistral_body = {
         'model': request_body['model'],
         'input': input_list,
-        'encoding_format':'float'
+        'encoding_format': encoding_format if native_base64 else 'float'
     }
 
     url, headers = await construct_request(request_headers, "/v1/embeddings")
-    response = await request_manager.send_request("POST",url, headers=headers, body=mistral_body)
+    response = await request_manager.send_request("POST",url, headers=headers, body=mistral_body, provider=PROVIDER)
     if response.status_code != 200:
         return response
     
     response_content = response.body
-    converted_data = []
-    if encoding_format == "base64":
-        for data in response_content["data"]:
-            if data['object'] != "embedding":
-                converted_data.append(data)
-                continue
-            data['embedding'] = oai_tools.encode_embeddings_to_base64(data['embedding'])
-            converted_data.append(data)
-
+    if encoding_format == "base64" and not native_base64:
+        oai_tools.encode_embedding_data_to_base64(response_content["data"])
     openai_response = request_manager.ResponseStatus(response.status_code, response_content)
     openai_response.success = True
     return openai_response
 
 async def list_models(request_headers, request_body):
+    return await model_catalog.list_models(PROVIDER, fetch_models, request_headers, request_body)
+
+async def fetch_models(request_headers, request_body):
     url, headers = await construct_request(request_headers, "/v1/models")
 
-    provider_response = await request_manager.send_request('GET',url,headers)
+    provider_response = await request_manager.send_request('GET',url,headers, provider=PROVIDER)
     if provider_response.status_code != 200:
         if provider_response.status_code == 404:
             provider_response.response.body = request_manager.ERROR_INVALID_REQUEST
@@ -323,25 +341,21 @@ async def list_models(request_headers, request_body):
     return openai_response   
     
 async def get_model(request_headers,request_body):
-    # This is a little gross because we have to list all models to get any details.
+    # Served from the cached model list, so this never has to go upstream on its own.
     created_time = 0
     owner = "organization-owner"
-    list_response = await list_models(request_headers,request_body)
+    model, failed_response = await model_catalog.find_model(PROVIDER, fetch_models, request_headers, request_body, request_body['model_id'])
     openai_response = request_manager.ResponseStatus(0, None)
 
-    if list_response.success is False:
+    if failed_response is not None:
         openai_response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
         openai_response.status_code = 500
         return openai_response
     
-    provider_models = list_response.body
-    model_exists = False
-    for model in provider_models['data']:
-        if model["id"] == request_body['model_id']:
-            created_time = model["created"]
-            owner = model["owned_by"]
-            model_exists = True
-            break
+    model_exists = model is not None
+    if model_exists:
+        created_time = model["created"]
+        owner = model["owned_by"]
 
     # We'll handle the error message in the main code.
     if not model_exists:
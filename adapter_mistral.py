@@ -1,15 +1,21 @@
+import logging
 import json
 import time
 import httpx
 import dirtyjson
 
 import config_manager
+import log_manager
 import request_manager
+import model_catalog
+import embedding_cache
 import oai_tools
 
 
-# Pull the provider specific options or set defaults if they don't exist already.
-ADAPTER_CONFIG = config_manager.get_provider_options("MISTRAL", {"base_url": "https://api.mistral.ai", "api_key":""})
+# Provider specific options, read live from the current config with defaults for anything missing.
+PROVIDER = "MISTRAL"
+LOGGER = log_manager.get_logger("adapter_mistral")
+ADAPTER_CONFIG = config_manager.ProviderOptions(PROVIDER, {"base_url": "https://api.mistral.ai", "api_key":""})
     
 async def construct_request(request_headers, endpoint):
     api_key = ADAPTER_CONFIG["api_key"]
@@ -37,19 +43,7 @@ async def process_function_calling(request_headers, request_body):
         return response
 
     # Construct the system prompt explaining the available functions and their parameters
-    system_prompt = "You have the following functions available to you:\n"
-    for tool in request_body.get("tools", []):
-        function_info = tool.get("function", {})
-        function_name = function_info.get("name")
-        parameters = function_info.get("parameters", {})
-
-        system_prompt += f"- Function Name: {function_name}, Parameters: {json.dumps(parameters)}\n"
-    
-    system_prompt += "Please execute any function you deem appropriate based on the context provided.\n"
-    system_prompt += """ Respond only in a valid JSON block containing the following keys: \n
-    "name": "function_name", \n
-    "arguments": { "parameter1": "value1", "parameter2": "value2" } \n
-    """
+    system_prompt = oai_tools.build_tool_prompt(request_body.get("tools", []))
 
     # Add this system prompt to the message history for the /api/chat request
     if "messages" not in request_body:
@@ -77,11 +71,11 @@ async def process_function_calling(request_headers, request_body):
     
 
     # Send the request to the LLM
-    print("WARN: Sending Tool Request to Mistral - This is SUPER Experimental!")
+    log_manager.log_event(LOGGER, logging.DEBUG, "tool_emulation", "Sending tool request through the experimental tool emulation")
     url, headers = await construct_request(request_headers, "/v1/chat/completions")
-    mistral_response = await request_manager.send_request("POST", url, headers=headers, body=request_body)
+    mistral_response = await request_manager.send_request("POST", url, headers=headers, body=request_body, provider=PROVIDER)
    
-    print(mistral_response.body)
+    log_manager.log_payload(LOGGER, "tool_emulation_response", "Tool emulation response", mistral_response.body)
 
     # Validate the LLM's response
     if mistral_response.status_code != 200:
@@ -186,9 +180,13 @@ async def chat_completions(request_headers, request_body):
     number_of_completions = request_body.get("n", 1)
     openai_response = request_manager.ResponseStatus(0, None)
 
-    for i in range(0,number_of_completions):
-        url, headers = await construct_request(request_headers, "/v1/chat/completions")   
-        response = await request_manager.send_request("POST", url, headers, mistral_request)
+    async def send_completion():
+        url, headers = await construct_request(request_headers, "/v1/chat/completions")
+        return await request_manager.send_request("POST", url, headers, mistral_request, provider=PROVIDER)
+
+    # The n completions run side by side, each one takes the next index as it finishes.
+    max_parallel_completions = ADAPTER_CONFIG.get("max_parallel_completions", request_manager.DEFAULT_MAX_PARALLEL_COMPLETIONS)
+    for response in await request_manager.fan_out(number_of_completions, send_completion, max_parallel_completions):
        
         openai_response.status_code = response.status_code
         if response.status_code == 400:
@@ -205,7 +203,7 @@ async def chat_completions(request_headers, request_body):
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
         elif not "choices" in response.body:
-            print("Messages not found in response")
+            LOGGER.error("Messages not found in response")
             openai_response.status_code = 500
             openai_response.body = request_manager.ERROR_UNKNOWN_ERROR
             return openai_response
@@ -231,7 +229,8 @@ async def chat_completions(request_headers, request_body):
         
         for choice in response_content["choices"]:
             tool_index = 0
-            for i in range(0,len(choice['message']["tool_calls"])):
+            # Mistral sends tool_calls as null when the model didn't call anything.
+            for i in range(0,len(choice['message'].get("tool_calls") or [])):
                 choice['message']['tool_calls'][i]['index'] = tool_index
                 tool_index += 1
             choice['delta'] = choice['message']
@@ -245,66 +244,63 @@ async def chat_completions(request_headers, request_body):
     return openai_response
     
 async def get_embeddings(request_headers, request_body):
+    return await embedding_cache.get_embeddings(PROVIDER, request_body.get("model"), fetch_embeddings, request_headers, request_body, ADAPTER_CONFIG.get("native_base64_embeddings", False))
+
+async def fetch_embeddings(request_headers, request_body):
     if "dimensions" in request_body:
-        print("WARNING: Dimensions parameter is not supported by MISTRAL. Ignoring.")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Dimensions parameter is not supported by MISTRAL. Ignoring.")
     
     input_list = request_body["input"]
     encoding_format = request_body.get("encoding_format", "float")
     if not isinstance(input_list, list):
         input_list = [input_list]
 
+    # Only ask upstream for base64 if it's known to speak it, otherwise floats get encoded here.
+    native_base64 = ADAPTER_CONFIG.get("native_base64_embeddings", False)
     mistral_body = {
         'model': request_body['model'],
         'input': input_list,
-        'encoding_format':'float'
+        'encoding_format': encoding_format if native_base64 else 'float'
     }
 
     url, headers = await construct_request(request_headers, "/v1/embeddings")
-    response = await request_manager.send_request("POST",url, headers=headers, body=mistral_body)
+    response = await request_manager.send_request("POST",url, headers=headers, body=mistral_body, provider=PROVIDER)
     if response.status_code != 200:
         return response
     
     response_content = response.body
-    converted_data = []
-    if encoding_format == "base64":
-        for data in response_content["data"]:
-            if data['object'] != "embedding":
-                converted_data.append(data)
-                continue
-            data['embedding'] = oai_tools.encode_embeddings_to_base64(data['embedding'])
-            converted_data.append(data)
-        response_content["data"] = converted_data
+    if encoding_format == "base64" and not native_base64:
+        oai_tools.encode_embedding_data_to_base64(response_content["data"])
     openai_response = request_manager.ResponseStatus(response.status_code, response_content)
     openai_response.success = True
     return openai_response
 
-async def list_models(request_headers, request_body):    
+async def list_models(request_headers, request_body):
+    return await model_catalog.list_models(PROVIDER, fetch_models, request_headers, request_body)
+
+async def fetch_models(request_headers, request_body):
     url,headers= await construct_request(request_headers, "/v1/models")
-    openai_response = await request_manager.send_request("GET", url, headers)
+    openai_response = await request_manager.send_request("GET", url, headers, provider=PROVIDER)
     if openai_response.status_code == 200:
         openai_response.success = True
     return openai_response      
     
 async def get_model(request_headers, request_body):
-    # This is a little gross because we have to list all models to get any details.
+    # Served from the cached model list, so this never has to go upstream on its own.
     created_time = 0
     owner = "organization-owner"
-    list_response = await list_models(request_headers, request_body)
+    model, failed_response = await model_catalog.find_model(PROVIDER, fetch_models, request_headers, request_body, request_body['model_id'])
     openai_response = request_manager.ResponseStatus(0, None)
 
-    if list_response.success is False:
+    if failed_response is not None:
         openai_response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
         openai_response.status_code = 500
         return openai_response
     
-    list_of_models = list_response.body['data']
-    model_exists = False
-    for model in list_of_models:
-        if model["id"] == request_body['model_id']:
-            created_time = model["created"]
-            owner = model["owned_by"]
-            model_exists = True
-            break
+    model_exists = model is not None
+    if model_exists:
+        created_time = model["created"]
+        owner = model["owned_by"]
 
     # We'll handle the error message in the main code.
     if not model_exists:
@@ -1,16 +1,87 @@
 
+import logging
+import asyncio
 import json
 import time
+from datetime import datetime, timezone
 import dirtyjson
 
 import config_manager
+import log_manager
 import request_manager
+import model_catalog
+import embedding_cache
+import backend_pool
+import request_scheduler
 import oai_tools
 
-# Pull the provider specific options or set defaults if they don't exist already.
-ADAPTER_CONFIG = config_manager.get_provider_options("OLLAMA", {"base_url": "http://localhost:11434", "model_settings":{}})
+# Provider specific options, read live from the current config with defaults for anything missing.
+PROVIDER = "OLLAMA"
+LOGGER = log_manager.get_logger("adapter_ollama")
+ADAPTER_CONFIG = config_manager.ProviderOptions(PROVIDER, {"base_url": "http://localhost:11434", "model_settings":{}})
+
+# Which models each backend has loaded, as base_url -> model -> when we stop assuming it's still loaded.
+# Requests prefer backends that already have their model in memory, since a cold load can take far longer than
+# the generation itself. Filled in from /api/ps (the health check) and from every successful response.
+RESIDENT_MODELS = {}
+# Ollama's default keep_alive.
+DEFAULT_RESIDENCY_TTL = 300
+# Responses with a load_duration over this (in ns) mean the model had to be loaded first.
+COLD_LOAD_THRESHOLD = 1000000000
+
+def normalize_model_name(model_name):
+    # Ollama treats "llama3" and "llama3:latest" as the same model.
+    if isinstance(model_name, str) and ":" not in model_name:
+        return f"{model_name}:latest"
+    return model_name
+
+def get_warm_backends(model_name):
+    model_name = normalize_model_name(model_name)
+    now = time.monotonic()
+    return {base_url for base_url, resident_models in RESIDENT_MODELS.items() if resident_models.get(model_name, 0) > now}
+
+def mark_resident(url, model_name, response_body=None):
+    # Whichever backend just answered for model_name has it loaded now.
+    backend_state = backend_pool.find_backend(PROVIDER, url)
+    if backend_state is None:
+        return
+    base_url = backend_state["base_url"]
+    residency_ttl = ADAPTER_CONFIG.get("residency_ttl", DEFAULT_RESIDENCY_TTL)
+    RESIDENT_MODELS.setdefault(base_url, {})[normalize_model_name(model_name)] = time.monotonic() + residency_ttl
+    if isinstance(response_body, dict) and response_body.get("load_duration", 0) > COLD_LOAD_THRESHOLD:
+        log_manager.log_event(LOGGER, logging.INFO, "cold_load", "Model had to be loaded before answering", model=model_name, backend=base_url, load_seconds=round(response_body["load_duration"] / 1e9, 2))
+
+def update_residency(base_url, response):
+    # /api/ps lists what a backend has loaded and until when. Older servers without it just 404.
+    if response.status_code != 200:
+        return
+    try:
+        loaded_models = response.json().get("models", [])
+    except ValueError:
+        return
+    now = time.monotonic()
+    wall_now = datetime.now(timezone.utc)
+    residency_ttl = ADAPTER_CONFIG.get("residency_ttl", DEFAULT_RESIDENCY_TTL)
+    resident_models = {}
+    for loaded_model in loaded_models:
+        remaining = residency_ttl
+        try:
+            remaining = (datetime.fromisoformat(loaded_model["expires_at"]) - wall_now).total_seconds()
+        except (KeyError, TypeError, ValueError):
+            pass
+        if remaining <= 0:
+            remaining = residency_ttl
+        resident_models[normalize_model_name(loaded_model.get("name"))] = now + remaining
+    RESIDENT_MODELS[base_url] = resident_models
+
+backend_pool.register_provider(PROVIDER, "/api/ps", update_residency)
+request_scheduler.register_provider(PROVIDER)
+
+# Whether each backend has the batch /api/embed endpoint, by base_url. Missing until we've asked it once.
+BATCH_EMBEDDINGS_SUPPORTED = {}
+DEFAULT_MAX_PARALLEL_EMBEDDINGS = 8
     
-async def construct_request(request_headers, endpoint):
+async def construct_request(request_headers, endpoint, base_url=None, model_name=None):
     api_key = ADAPTER_CONFIG.get("api_key",None)
     if request_headers != None and request_headers.get("provider_auth"):
         api_key = request_headers.get("provider_auth")    
@@ -20,9 +91,33 @@ async def construct_request(request_headers, endpoint):
     }    
     if api_key is not None:
         headers["Authorization"] = f"Bearer {api_key}"
-    url = f"{ADAPTER_CONFIG['base_url']}{endpoint}"
+    if base_url is None:
+        warm_backends = None
+        if model_name is not None:
+            warm_backends = get_warm_backends(model_name)
+        base_url = backend_pool.select_backend(PROVIDER, ADAPTER_CONFIG, warm_backends)
+    url = f"{base_url}{endpoint}"
     return url, headers
 
+def resolve_model_name(model_name):
+    # Aliases in model_settings point at the actual Ollama model.
+    return ADAPTER_CONFIG["model_settings"].get(model_name, {}).get("model", model_name)
+
+def convert_error_response(response):
+    if response.status_code == 400:
+        if "model is required" in str(response.body):
+            response.body = request_manager.ERROR_MODEL_NOT_FOUND
+        else:
+            response.body = request_manager.ERROR_BAD_REQUEST
+    elif response.status_code == 404:
+        response.body = request_manager.ERROR_MODEL_NOT_FOUND
+    elif response.status_code == 500:
+        response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
+    else:
+        response.status_code = 500
+        response.body = request_manager.ERROR_UNKNOWN_ERROR
+    return response
+
 async def process_function_calling(selected_model, is_streaming_response, request_headers, openai_request_body):
     """
     Sends a simulated function calling request to an LLM via the /api/chat endpoint,
@@ -34,19 +129,7 @@ async def process_function_calling(selected_model, is_streaming_response, reques
         return response
 
     # Construct the system prompt explaining the available functions and their parameters
-    system_prompt = "You have the following functions available to you:\n"
-    for tool in openai_request_body.get("tools", []):
-        function_info = tool.get("function", {})
-        function_name = function_info.get("name")
-        parameters = function_info.get("parameters", {})
-
-        system_prompt += f"- Function Name: {function_name}, Parameters: {json.dumps(parameters)}\n"
-    
-    system_prompt += "Please execute any function you deem appropriate based on the context provided.\n"
-    system_prompt += """ Respond only in a valid JSON block containing the following keys: \n
-    "name": "function_name", \n
-    "arguments": { "parameter1": "value1", "parameter2": "value2" } \n
-    """
+    system_prompt = oai_tools.build_tool_prompt(openai_request_body.get("tools", []))
 
     # Add this system prompt to the message history for the /api/chat request
     if "messages" not in openai_request_body:
@@ -76,9 +159,11 @@ async def process_function_calling(selected_model, is_streaming_response, reques
     
 
     # Send the request to the LLM
-    print("WARN: Sending Tool Request to OLLAMA - This is SUPER Experimental!")
-    url,headers = await construct_request(request_headers, "/api/chat")
-    ollama_response = await request_manager.send_request("POST", url,headers, body=ollama_request_body)
+    log_manager.log_event(LOGGER, logging.DEBUG, "tool_emulation", "Sending tool request through the experimental tool emulation")
+    url,headers = await construct_request(request_headers, "/api/chat", model_name=ollama_request_body["model"])
+    ollama_response = await request_manager.send_request("POST", url,headers, body=ollama_request_body, provider=PROVIDER)
+    if ollama_response.status_code == 200:
+        mark_resident(url, ollama_request_body["model"], ollama_response.body)
    
     
 
@@ -148,6 +233,64 @@ async def process_function_calling(selected_model, is_streaming_response, reques
 
 
 
+def convert_messages(messages):
+    # OpenAI messages to Ollama ones. Images are only collected here, as (message, url) pairs, so the
+    # caller can download them all at once.
+    ollama_messages = []
+    image_requests = []
+    for message in messages:
+        ollama_message = {
+            "role": message["role"],            
+        }
+        if isinstance(message["content"], str):
+            ollama_message["content"] = message["content"]
+        elif isinstance(message["content"], list):
+            for content in message["content"]:
+                if content['type'] == "text":
+                    ollama_message['content'] = content['text']
+                    break
+            
+            for content in message['content']:
+                if content['type'] == "image_url":
+                    image_requests.append((ollama_message, content["image_url"]['url']))
+           
+        ollama_messages.append(ollama_message)
+    return ollama_messages, image_requests
+
+async def stream_chat_response(upstream, model_name):
+    # Translates Ollama's NDJSON chat stream into OpenAI chunks, one line at a time as they arrive.
+    created_time = int(time.time())
+    chat_id = f"chatcmpl-{created_time}"
+    yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {"role": "assistant", "content": ""})
+
+    ollama_lines = request_manager.iter_ndjson(upstream)
+    try:
+        async for line in ollama_lines:
+            if "error" in line:
+                LOGGER.error("Error in Ollama stream: %s", line['error'])
+                yield json.dumps({"error": {"message": line["error"], "type": "upstream_error", "param": None, "code": None}})
+                break
+
+            content = line.get("message", {}).get("content", "")
+            if content:
+                yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {"content": content})
+
+            if line.get("done", False):
+                finish_reason = "stop"
+                if line.get("done_reason") == "length":
+                    finish_reason = "length"
+                yield oai_tools.build_stream_chunk(chat_id, created_time, model_name, {}, finish_reason)
+
+                # Same as the non-streaming path, prompt_eval_count goes missing when Ollama had the prompt cached.
+                prompt_tokens = line.get("prompt_eval_count", 0)
+                completion_tokens = line.get("eval_count", 0)
+                yield oai_tools.build_usage_chunk(chat_id, created_time, model_name, prompt_tokens, completion_tokens)
+                break
+    finally:
+        await ollama_lines.aclose()
+    yield "[DONE]"
+
+
 async def chat_completions(request_headers, request_body):
     if not "model" in request_body:
         return request_manager.ResponseStatus(400, request_manager.ERROR_BAD_REQUEST)
@@ -170,7 +313,7 @@ async def chat_completions(request_headers, request_body):
 
     ollama_request_body = {
         'model': model_name,
-        # In the interest of having ONE stream only, we're going to always disable streaming for this.
+        # Only single completions get streamed from Ollama, everything else is stitched together below.
         'stream': False,
         'messages': []
     }
@@ -193,13 +336,13 @@ async def chat_completions(request_headers, request_body):
         ollama_options["repeat_penalty"] = request_body["frequency_penalty"]
 
     if "logit_bias" in request_body:
-        print("WARNING: Logit bias is not supported by OLLAMA. Ignoring.")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Logit bias is not supported by OLLAMA. Ignoring.")
     
     if "logprobs" in request_body:
-        print("WARNING: Logprobs is not supported by OLLAMA. Ignoring.")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Logprobs is not supported by OLLAMA. Ignoring.")
 
     if "top_logprobs" in request_body:
-        print("WARNING: Top logprobs is not supported by OLLAMA. Ignoring.")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Top logprobs is not supported by OLLAMA. Ignoring.")
 
     if "seed" in request_body:
         ollama_options["seed"] = request_body["seed"]
@@ -215,48 +358,52 @@ async def chat_completions(request_headers, request_body):
 
     if "stop" in request_body:
         if(len(request_body["stop"]) > 1):
-            print("WARNING: Multiple stop tokens are not supported by OLLAMA. Using the first one.")
+            log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Multiple stop tokens are not supported by OLLAMA. Using the first one.")
         ollama_options["stop"] = request_body["stop"][0]
 
     # We will need this later.
     number_of_completions = request_body.get("n", 1)
 
     # Time to convert the messages.
-    ollama_messages = []
-    for message in request_body.get("messages", []):
-        ollama_message = {
-            "role": message["role"],            
-        }
-        if isinstance(message["content"], str):
-            ollama_message["content"] = message["content"]
-        elif isinstance(message["content"], list):
-            for content in message["content"]:
-                if content['type'] == "text":
-                    ollama_message['content'] = content['text']
-                    break
-            
-            for content in message['content']:
-                if content['type'] == "image_url":
-                    url = content["image_url"]['url']
-                    # Download and base64 image from url
-                    image_b64 = await oai_tools.download_image_from_url_and_encode_b64(url)
-                    if not 'images' in ollama_message:
-                        ollama_message['images'] = []
-                    ollama_message['images'].append(image_b64)
-           
-        ollama_messages.append(ollama_message)
+    ollama_messages, image_requests = convert_messages(request_body.get("messages", []))
+
+    # Download and base64 every image in the conversation at once rather than one after another.
+    images = await asyncio.gather(*[oai_tools.download_image_from_url_and_encode_b64(url) for ollama_message, url in image_requests])
+    for (ollama_message, url), image_b64 in zip(image_requests, images):
+        if image_b64 is None:
+            return request_manager.ResponseStatus(400, request_manager.ERROR_IMAGE_DOWNLOAD_FAILED)
+        if not 'images' in ollama_message:
+            ollama_message['images'] = []
+        ollama_message['images'].append(image_b64)
     
     ollama_request_body["messages"] = ollama_messages
 
+    if is_streaming_response and number_of_completions == 1:
+        ollama_request_body["stream"] = True
+        url, headers = await construct_request(request_headers, "/api/chat", model_name=model_name)
+        response = await request_manager.open_stream("POST", url, headers, ollama_request_body, provider=PROVIDER)
+        if not response.success:
+            return convert_error_response(response)
+        mark_resident(url, model_name)
+        response.body = stream_chat_response(response.body, model_name)
+        response.stream = True
+        return response
 
     response = request_manager.ResponseStatus(0, None)
     ollama_response_messages = []
     prompt_tokens = 0
     completion_tokens = 0
 
-    for i in range(0,number_of_completions):
-        url, headers = await construct_request(request_headers, "/api/chat")
-        ollama_response = await request_manager.send_request("POST",url,headers, body=ollama_request_body)
+    async def send_completion():
+        url, headers = await construct_request(request_headers, "/api/chat", model_name=model_name)
+        completion_response = await request_manager.send_request("POST",url,headers, body=ollama_request_body, provider=PROVIDER)
+        if completion_response.status_code == 200:
+            mark_resident(url, model_name, completion_response.body)
+        return completion_response
+
+    # The n completions run side by side, each one takes the next index as it finishes.
+    max_parallel_completions = ADAPTER_CONFIG.get("max_parallel_completions", request_manager.DEFAULT_MAX_PARALLEL_COMPLETIONS)
+    for ollama_response in await request_manager.fan_out(number_of_completions, send_completion, max_parallel_completions):
         response.status_code = ollama_response.status_code
         if ollama_response.status_code == 400:
             if "model is required" in str(ollama_response):
@@ -272,7 +419,7 @@ async def chat_completions(request_headers, request_body):
             response.body = request_manager.ERROR_UNKNOWN_ERROR
             return response
         elif not "message" in ollama_response.body:
-            print("Messages not found in response")
+            LOGGER.error("Messages not found in response")
             response.status_code = 500
             response.body = request_manager.ERROR_UNKNOWN_ERROR
             return response
@@ -325,59 +472,106 @@ async def chat_completions(request_headers, request_body):
     return response
 
 
+async def fetch_batch_embeddings(request_headers, model_name, input_list, base_url):
+    # One round trip for the whole batch. Returns None if this Ollama is too old to have /api/embed.
+    ollama_request = {
+        "model": model_name,
+        "input": input_list
+    }
+    url, headers = await construct_request(request_headers, "/api/embed", base_url)
+    response = await request_manager.send_request("POST", url, headers, ollama_request, provider=PROVIDER)
+    if response.status_code == 200:
+        mark_resident(url, model_name, response.body)
+    # A missing route is a plain text 404, a missing model comes back as a JSON error.
+    if response.status_code == 404 and not isinstance(response.body, dict):
+        LOGGER.warning("This OLLAMA has no /api/embed, falling back to one request per input.")
+        BATCH_EMBEDDINGS_SUPPORTED[base_url] = False
+        return None
+    if response.status_code != 200:
+        return convert_error_response(response)
+    BATCH_EMBEDDINGS_SUPPORTED[base_url] = True
+    if not "embeddings" in response.body or len(response.body["embeddings"]) != len(input_list):
+        LOGGER.error("Embeddings not found in response")
+        response.status_code = 500
+        response.body = request_manager.ERROR_UNKNOWN_ERROR
+        return response
+    return response
+
+async def fetch_single_embeddings(request_headers, model_name, input_list):
+    # Old style /api/embeddings only takes one prompt, so send them side by side and put them back in order.
+    def make_send(input_text):
+        async def send_embedding():
+            ollama_request = {
+                "model": model_name,
+                "prompt": input_text
+            }
+            url, headers = await construct_request(request_headers, "/api/embeddings", model_name=model_name)
+            embedding_response = await request_manager.send_request("POST", url, headers, ollama_request, provider=PROVIDER)
+            if embedding_response.status_code == 200:
+                mark_resident(url, model_name)
+            return embedding_response
+        return send_embedding
+
+    max_parallel_embeddings = ADAPTER_CONFIG.get("max_parallel_embeddings", DEFAULT_MAX_PARALLEL_EMBEDDINGS)
+    responses = await request_manager.gather_limited([make_send(input_text) for input_text in input_list], max_parallel_embeddings)
+    embeddings = []
+    for response in responses:
+        if response.status_code != 200:
+            return convert_error_response(response)
+        elif not "embedding" in response.body:
+            LOGGER.error("Embedding not found in response")
+            response.status_code = 500
+            response.body = request_manager.ERROR_UNKNOWN_ERROR
+            return response
+        embeddings.append(response.body["embedding"])
+
+    response = request_manager.ResponseStatus(200, {"embeddings": embeddings})
+    response.success = True
+    return response
+
 async def get_embeddings(request_headers, request_body):
+    return await embedding_cache.get_embeddings(PROVIDER, resolve_model_name(request_body.get("model")), fetch_embeddings, request_headers, request_body)
+
+async def fetch_embeddings(request_headers, request_body):
     if "dimensions" in request_body:
-        print("WARNING: Dimensions parameter is not supported by OLLAMA. Ignoring.")
+        log_manager.log_event(LOGGER, logging.WARNING, "unsupported_parameter", "Dimensions parameter is not supported by OLLAMA. Ignoring.")
     
     input_list = request_body["input"]
     encoding_format = request_body.get("encoding_format", "float")
     if not isinstance(input_list, list):
         input_list = [input_list]
+
+    model_name = resolve_model_name(request_body["model"])
+    response = None
+    # Backends can run different Ollama versions, so batch support is remembered per backend.
+    base_url = backend_pool.select_backend(PROVIDER, ADAPTER_CONFIG, get_warm_backends(model_name))
+    if BATCH_EMBEDDINGS_SUPPORTED.get(base_url) is not False:
+        response = await fetch_batch_embeddings(request_headers, model_name, input_list, base_url)
+    if response is None:
+        response = await fetch_single_embeddings(request_headers, model_name, input_list)
+    if response.status_code != 200:
+        return response
+
+    # Only the batch endpoint reports how many tokens it read.
+    prompt_tokens = response.body.get("prompt_eval_count", 0)
     openai_response = {
         "object": "list",
         "data": [],
         "model": request_body["model"],
         "usage": {
-            "prompt_tokens": 0,
-            "total_tokens": 0
+            "prompt_tokens": prompt_tokens,
+            "total_tokens": prompt_tokens
         }
     }
 
-    for input_text in input_list:
-        ollama_request = {
-            "model": request_body["model"],
-            "prompt": input_text            
-        }
-        url,headers = await construct_request(request_headers, "/api/embeddings")
-        response = await request_manager.send_request("POST",url,headers,ollama_request)
-        if response.status_code == 400:        
-            if "model is required" in str(response.body):
-                response.body = request_manager.ERROR_MODEL_NOT_FOUND
-            else:
-                response.body = request_manager.ERROR_BAD_REQUEST
-            return response
-        elif response.status_code == 500:
-            response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
-            return response
-        elif response.status_code != 200:
-            response.status_code = 500
-            response.body = request_manager.ERROR_UNKNOWN_ERROR        
-            return response
-        elif not "embedding" in response.body:
-            print("Embedding not found in response")
-            response.status_code = 500
-            response.body = request_manager.ERROR_UNKNOWN_ERROR
-            return response
-        
-        embedding_data = response.body["embedding"]
-        if encoding_format == "base64":
-            embedding_data = oai_tools.encode_embeddings_to_base64(embedding_data)
-            
+    for embedding_data in response.body["embeddings"]:
         openai_response["data"].append({
             "object": "embedding",
             "embedding": embedding_data,
             "index": len(openai_response["data"])
         })
+    if encoding_format == "base64":
+        oai_tools.encode_embedding_data_to_base64(openai_response["data"])
     
     response.body = openai_response
     response.success = True
@@ -385,9 +579,12 @@ async def get_embeddings(request_headers, request_body):
     return response
 
 async def list_models(request_headers, request_body):
+    return await model_catalog.list_models(PROVIDER, fetch_models, request_headers, request_body)
+
+async def fetch_models(request_headers, request_body):
     url, headers = await construct_request(request_headers, "/api/tags")
 
-    ollama_response = await request_manager.send_request('GET',url,headers)
+    ollama_response = await request_manager.send_request('GET',url,headers, provider=PROVIDER)
     if ollama_response.status_code != 200:
         if ollama_response.status_code == 404:
             ollama_response.response.body = request_manager.ERROR_INVALID_REQUEST
@@ -421,25 +618,21 @@ async def list_models(request_headers, request_body):
 
 # -- MODEL HANDLERS --
 async def get_model(request_headers,request_body):
-    # This is a little gross because we have to list all models to get any details.
+    # Served from the cached model list, so this never has to go upstream on its own.
     created_time = 0
     owner = "organization-owner"
-    list_response = await list_models(request_headers,request_body)
+    model, failed_response = await model_catalog.find_model(PROVIDER, fetch_models, request_headers, request_body, request_body['model_id'])
     openai_response = request_manager.ResponseStatus(0, None)
 
-    if list_response.success is False:
+    if failed_response is not None:
         openai_response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
         openai_response.status_code = 500
         return openai_response
     
-    ollama_models = list_response.body
-    model_exists = False
-    for model in ollama_models["data"]:
-        if model["id"] == request_body['model_id']:
-            created_time = model["created"]
-            owner = model["owned_by"]
-            model_exists = True
-            break
+    model_exists = model is not None
+    if model_exists:
+        created_time = model["created"]
+        owner = model["owned_by"]
 
     # We'll handle the error message in the main code.
     if not model_exists:
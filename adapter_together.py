@@ -6,11 +6,14 @@ import httpx
 
 import config_manager
 import request_manager
+import model_catalog
+import embedding_cache
 import oai_tools
 
 
-# Pull the provider specific options or set defaults if they don't exist already.
-ADAPTER_CONFIG = config_manager.get_provider_options("TOGETHER", {"base_url": "https://api.together.xyz", "api_key":""})
+# Provider specific options, read live from the current config with defaults for anything missing.
+PROVIDER = "TOGETHER"
+ADAPTER_CONFIG = config_manager.ProviderOptions(PROVIDER, {"base_url": "https://api.together.xyz", "api_key":""})
     
 async def construct_request(request_headers, endpoint):
     api_key = ADAPTER_CONFIG["api_key"]
@@ -25,46 +28,47 @@ async def construct_request(request_headers, endpoint):
     return url, headers
 
 
+async def stream_chat_completions(request_headers, request_body):
+    # Upstream already speaks OpenAI SSE, so the chunks go straight through to the client.
+    url,headers= await construct_request(request_headers, "/v1/chat/completions")
+    headers["Accept"] = "text/event-stream"
+    response = await request_manager.open_stream("POST", url, headers, request_body, provider=PROVIDER)
+    if response.success:
+        response.body = oai_tools.relay_openai_stream(response.body)
+        response.stream = True
+    return response
+
 async def chat_completions(request_headers,request_body):
    
-    is_streaming_response = request_body.get("stream", False)
-    request_body['stream'] = False
+    if request_body.get("stream", False):
+        return await stream_chat_completions(request_headers, request_body)
 
     url,headers= await construct_request(request_headers, "/v1/chat/completions")
-    response = await request_manager.send_request("POST", url, headers,request_body)
+    response = await request_manager.send_request("POST", url, headers,request_body, provider=PROVIDER)
     if response.status_code != 200:
         return response
     
     response_content = response.body      
-    if is_streaming_response:
-        response_content["object"] = "chat.completion.chunk"
-        stream_choices = []
-        
-        for choice in response_content["choices"]:
-            tool_index = 0
-            for i in range(0,len(choice['message']["tool_calls"])):
-                choice['message']['tool_calls'][i]['index'] = tool_index
-                tool_index += 1
-            choice['delta'] = choice['message']
-            del choice['message']
-            stream_choices.append(choice)
-        response_content["choices"] = stream_choices
-        print(response_content)
-    
     openai_response = request_manager.ResponseStatus(response.status_code, response_content)
     openai_response.success = True
     return openai_response
     
-async def get_embeddings(request_headers,request_body):
+async def get_embeddings(request_headers, request_body):
+    return await embedding_cache.get_embeddings(PROVIDER, request_body.get("model"), fetch_embeddings, request_headers, request_body, ADAPTER_CONFIG.get("native_base64_embeddings", True))
+
+async def fetch_embeddings(request_headers, request_body):
     url,headers= await construct_request(request_headers, "/v1/embeddings")
-    openai_response = await request_manager.send_request("POST", url, headers,request_body)
+    openai_response = await request_manager.send_request("POST", url, headers,request_body, provider=PROVIDER)
     if openai_response.status_code == 200:
         openai_response.success = True
     return openai_response    
 
-async def list_models(request_headers, request_body):    
+async def list_models(request_headers, request_body):
+    return await model_catalog.list_models(PROVIDER, fetch_models, request_headers, request_body)
+
+async def fetch_models(request_headers, request_body):
     url,headers= await construct_request(request_headers, "/v1/models")
-    openai_response = await request_manager.send_request("GET", url, headers)
+    openai_response = await request_manager.send_request("GET", url, headers, provider=PROVIDER)
     if openai_response.status_code == 200:
         for i in range(0,len(openai_response.body)):
             openai_response.body[i]["id"] = openai_response.body[i]["id"].split("/")[-1]
@@ -72,25 +76,21 @@ async def list_models(request_headers, request_body):
     return openai_response    
     
 async def get_model(request_headers, request_body):
-    # This is a little gross because we have to list all models to get any details.
+    # Served from the cached model list, so this never has to go upstream on its own.
     created_time = 0
     owner = "organization-owner"
-    list_response = await list_models(request_headers, request_body)
+    model, failed_response = await model_catalog.find_model(PROVIDER, fetch_models, request_headers, request_body, request_body['model_id'])
     openai_response = request_manager.ResponseStatus(0, None)
 
-    if list_response.success is False:
+    if failed_response is not None:
         openai_response.body = request_manager.ERROR_INTERNAL_SERVER_ERROR
         openai_response.status_code = 500
         return openai_response
-
-    list_of_models = list_response.body
-    model_exists = False
-    for model in list_of_models:
-        if request_body['model_id'] == model["id"]:
-            created_time = model["created"]
-            owner = model["organization"]
-            model_exists = True
-            break
+    
+    model_exists = model is not None
+    if model_exists:
+        created_time = model["created"]
+        owner = model["organization"]
 
     # We'll handle the error message in the main code.
     if not model_exists:
@@ -0,0 +1,298 @@
+import asyncio
+import contextvars
+import random
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+import config_manager
+import log_manager
+
+LOGGER = log_manager.get_logger("backend_pool")
+
+# A provider can list several backends instead of one base_url:
+#   "backends": [{"base_url": "http://gpu-1:11434", "weight": 2}, {"base_url": "http://gpu-2:11434"}]
+# Requests go to the backend with the fewest outstanding requests (scaled by weight). Backends that keep
+# failing are ejected for a while, and a periodic health check ejects and restores them too.
+#
+# Every backend (and every single-URL provider) also gets a circuit breaker. It's closed normally, opens after
+# max_failures failures in a row so requests fail fast instead of piling up on a dead upstream, and goes
+# half open after eject_duration to let one probe request through. The probe closes it again or reopens it.
+DEFAULT_BACKEND_OPTIONS = {
+    "health_check_interval": 10,
+    "max_failures": 3,
+    "eject_duration": 30
+}
+# Status codes that say the backend itself is in trouble, rather than the request.
+BACKEND_FAILURE_CODES = {502, 503, 504}
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+# Requests let through at a time while a circuit is half open.
+HALF_OPEN_PROBES = 1
+
+# provider -> base_url -> state
+BACKENDS = {}
+# provider -> path that answers cheaply when the backend is up
+HEALTH_PATHS = {}
+# provider -> called with (base_url, response) after every successful health check
+HEALTH_CALLBACKS = {}
+HEALTH_CHECK_TASK = None
+
+# Hedged requests use these so the duplicate goes somewhere other than the original. ROUTED_BACKENDS collects
+# the backends picked in the current context, and select_backend stays off AVOIDED_BACKENDS when it can.
+ROUTED_BACKENDS = contextvars.ContextVar("routed_backends", default=None)
+AVOIDED_BACKENDS = contextvars.ContextVar("avoided_backends", default=None)
+
+
+class CircuitOpenError(Exception):
+    # Raised by start_request when a backend's circuit won't take the request.
+    pass
+
+
+def register_provider(provider, health_path, on_health_check=None):
+    # Adapters that support backend lists call this so their backends get health checked.
+    # on_health_check lets an adapter learn something from the health check response too.
+    HEALTH_PATHS[provider] = health_path
+    if on_health_check is not None:
+        HEALTH_CALLBACKS[provider] = on_health_check
+
+def get_backend_options(provider_options):
+    backend_options = dict(DEFAULT_BACKEND_OPTIONS)
+    for option in DEFAULT_BACKEND_OPTIONS:
+        if option in provider_options:
+            backend_options[option] = provider_options[option]
+    return backend_options
+
+def get_backends(provider_options):
+    backends = provider_options.get("backends")
+    if not backends:
+        return [{"base_url": provider_options["base_url"]}]
+    return backends
+
+def get_backend_state(provider, base_url):
+    provider_backends = BACKENDS.setdefault(provider, {})
+    backend_state = provider_backends.get(base_url)
+    if backend_state is None:
+        backend_state = {
+            "provider": provider,
+            "base_url": base_url,
+            "outstanding": 0,
+            "failures": 0,
+            "circuit": CIRCUIT_CLOSED,
+            "ejected_until": 0.0,
+            "probes": 0,
+            "requests": 0
+        }
+        provider_backends[base_url] = backend_state
+    return backend_state
+
+def is_available(backend_state, now):
+    if backend_state["circuit"] == CIRCUIT_CLOSED:
+        return True
+    if backend_state["circuit"] == CIRCUIT_HALF_OPEN:
+        return backend_state["probes"] < HALF_OPEN_PROBES
+    return backend_state["ejected_until"] <= now
+
+def select_backend(provider, provider_options, preferred_urls=None):
+    # preferred_urls narrows the choice to those backends whenever any of them are available.
+    backends = get_backends(provider_options)
+    if len(backends) == 1:
+        return backends[0]["base_url"]
+
+    now = time.monotonic()
+    backend_states = [(backend, get_backend_state(provider, backend["base_url"])) for backend in backends]
+    candidates = [(backend, backend_state) for backend, backend_state in backend_states if is_available(backend_state, now)]
+    if len(candidates) == 0:
+        # Everything is ejected. Pick one anyway, its circuit breaker decides whether it's tried.
+        candidates = backend_states
+    avoided_urls = AVOIDED_BACKENDS.get()
+    if avoided_urls:
+        other_candidates = [(backend, backend_state) for backend, backend_state in candidates if backend["base_url"] not in avoided_urls]
+        if other_candidates:
+            candidates = other_candidates
+    if preferred_urls:
+        preferred_candidates = [(backend, backend_state) for backend, backend_state in candidates if backend["base_url"] in preferred_urls]
+        if preferred_candidates:
+            candidates = preferred_candidates
+
+    # Least outstanding requests per unit of weight, ties broken at random so idle backends share the load.
+    best_score = None
+    best_backends = []
+    for backend, backend_state in candidates:
+        score = (backend_state["outstanding"] + 1) / max(backend.get("weight", 1), 0.001)
+        if best_score is None or score < best_score:
+            best_score = score
+            best_backends = [backend]
+        elif score == best_score:
+            best_backends.append(backend)
+    base_url = random.choice(best_backends)["base_url"]
+    routed_urls = ROUTED_BACKENDS.get()
+    if routed_urls is not None:
+        routed_urls.add(base_url)
+    return base_url
+
+def find_backend(provider, url):
+    for base_url, backend_state in BACKENDS.get(provider, {}).items():
+        # Checked up to the path so http://host:1 doesn't claim requests for http://host:11434.
+        if url.startswith(base_url) and url[len(base_url):len(base_url) + 1] in ("", "/", "?"):
+            return backend_state
+    return None
+
+def get_origin(url):
+    url_parts = urlsplit(url)
+    return f"{url_parts.scheme}://{url_parts.netloc}"
+
+def retarget(provider, url):
+    # Moves a request to another of the provider's backends, for retries. Single backends keep their url.
+    backend_state = find_backend(provider, url)
+    provider_options = config_manager.get_config()["provider_options"].get(provider, {})
+    backends = provider_options.get("backends") or []
+    if backend_state is None or len(backends) < 2:
+        return url
+    other_urls = {backend["base_url"] for backend in backends if backend["base_url"] != backend_state["base_url"]}
+    base_url = select_backend(provider, provider_options, other_urls)
+    return base_url + url[len(backend_state["base_url"]):]
+
+def start_request(provider, url):
+    # Called by request_manager for every upstream request. Returns a handle for finish_request, or raises
+    # CircuitOpenError if the backend's circuit breaker turns the request away.
+    if provider is None:
+        return None
+    backend_state = find_backend(provider, url)
+    if backend_state is None:
+        # Providers with a single URL still get a breaker, keyed by where the request is going.
+        backend_state = get_backend_state(provider, get_origin(url))
+
+    is_probe = False
+    if backend_state["circuit"] == CIRCUIT_OPEN:
+        if backend_state["ejected_until"] > time.monotonic():
+            raise CircuitOpenError(f"{provider} backend {backend_state['base_url']} is ejected")
+        backend_state["circuit"] = CIRCUIT_HALF_OPEN
+        LOGGER.info("Probing %s backend %s", provider, backend_state["base_url"])
+    if backend_state["circuit"] == CIRCUIT_HALF_OPEN:
+        if backend_state["probes"] >= HALF_OPEN_PROBES:
+            raise CircuitOpenError(f"{provider} backend {backend_state['base_url']} is already being probed")
+        backend_state["probes"] += 1
+        is_probe = True
+
+    backend_state["outstanding"] += 1
+    backend_state["requests"] += 1
+    return {"backend": backend_state, "probe": is_probe}
+
+def eject_backend(backend_state, eject_duration, reason):
+    if backend_state["circuit"] != CIRCUIT_OPEN:
+        LOGGER.warning("Ejecting %s backend %s for %ss: %s", backend_state["provider"], backend_state["base_url"], eject_duration, reason)
+    backend_state["circuit"] = CIRCUIT_OPEN
+    backend_state["ejected_until"] = time.monotonic() + eject_duration
+
+def restore_backend(backend_state):
+    if backend_state["circuit"] != CIRCUIT_CLOSED:
+        LOGGER.info("Restoring %s backend %s", backend_state["provider"], backend_state["base_url"])
+    backend_state["circuit"] = CIRCUIT_CLOSED
+    backend_state["failures"] = 0
+    backend_state["ejected_until"] = 0.0
+
+def finish_request(backend_request, status_code):
+    # Passive health check: consecutive connection errors or gateway errors open the circuit,
+    # and a half open circuit follows whatever happened to its probe.
+    if backend_request is None:
+        return
+    backend_state = backend_request["backend"]
+    backend_state["outstanding"] -= 1
+    if backend_request["probe"]:
+        backend_state["probes"] -= 1
+    if status_code == "cancelled":
+        # Nothing learned about the backend either way.
+        return
+    backend_options = get_backend_options(config_manager.get_config()["provider_options"].get(backend_state["provider"], {}))
+    if status_code == "error" or status_code in BACKEND_FAILURE_CODES:
+        backend_state["failures"] += 1
+        if backend_request["probe"]:
+            eject_backend(backend_state, backend_options["eject_duration"], "probe request failed")
+        elif backend_state["failures"] >= backend_options["max_failures"]:
+            eject_backend(backend_state, backend_options["eject_duration"], f"{backend_state['failures']} failures in a row")
+    elif backend_request["probe"]:
+        restore_backend(backend_state)
+    else:
+        backend_state["failures"] = 0
+
+# -- ACTIVE HEALTH CHECKS --
+
+async def check_backend(client, provider, provider_options, base_url):
+    backend_state = get_backend_state(provider, base_url)
+    backend_options = get_backend_options(provider_options)
+    headers = {}
+    if provider_options.get("api_key"):
+        headers["Authorization"] = f"Bearer {provider_options['api_key']}"
+    try:
+        response = await client.get(f"{base_url}{HEALTH_PATHS[provider]}", headers=headers)
+        healthy = response.status_code < 500
+        reason = f"health check returned {response.status_code}"
+    except Exception as e:
+        healthy = False
+        reason = f"health check failed: {e!r}"
+    if healthy:
+        restore_backend(backend_state)
+        if provider in HEALTH_CALLBACKS:
+            HEALTH_CALLBACKS[provider](base_url, response)
+    else:
+        eject_backend(backend_state, backend_options["eject_duration"], reason)
+
+async def run_health_checks():
+    async with httpx.AsyncClient(timeout=5) as client:
+        while True:
+            checks = []
+            health_check_interval = DEFAULT_BACKEND_OPTIONS["health_check_interval"]
+            for provider in HEALTH_PATHS:
+                provider_options = config_manager.get_config()["provider_options"].get(provider, {})
+                backends = provider_options.get("backends") or []
+                # A single backend has nowhere else to send traffic, so there's nothing to check for.
+                if len(backends) < 2:
+                    continue
+                health_check_interval = min(health_check_interval, get_backend_options(provider_options)["health_check_interval"])
+                for backend in backends:
+                    checks.append(check_backend(client, provider, provider_options, backend["base_url"]))
+            await asyncio.gather(*checks)
+            await asyncio.sleep(health_check_interval)
+
+def start_health_checks():
+    global HEALTH_CHECK_TASK
+    if HEALTH_CHECK_TASK is None:
+        HEALTH_CHECK_TASK = config_manager.start_background_task(run_health_checks())
+
+def stop_health_checks():
+    global HEALTH_CHECK_TASK
+    if HEALTH_CHECK_TASK is not None:
+        HEALTH_CHECK_TASK.cancel()
+        HEALTH_CHECK_TASK = None
+
+def drop_removed_backends(old_config, new_config):
+    # Reload listener: forget backends that were taken out of a backends list once nothing is running on them.
+    for provider, provider_backends in BACKENDS.items():
+        old_backends = old_config["provider_options"].get(provider, {}).get("backends") or []
+        new_backends = new_config["provider_options"].get(provider, {}).get("backends") or []
+        configured_urls = {backend["base_url"] for backend in new_backends}
+        for backend in old_backends:
+            base_url = backend["base_url"]
+            if base_url not in configured_urls and base_url in provider_backends and provider_backends[base_url]["outstanding"] == 0:
+                provider_backends.pop(base_url)
+
+config_manager.add_reload_listener(drop_removed_backends)
+
+def get_backend_stats():
+    now = time.monotonic()
+    backend_stats = {}
+    for provider, provider_backends in BACKENDS.items():
+        backend_stats[provider] = [{
+            "base_url": backend_state["base_url"],
+            "outstanding": backend_state["outstanding"],
+            "requests": backend_state["requests"],
+            "failures": backend_state["failures"],
+            "circuit": backend_state["circuit"],
+            "ejected_for": max(0.0, round(backend_state["ejected_until"] - now, 1)),
+            "available": is_available(backend_state, now)
+        } for backend_state in provider_backends.values()]
+    return backend_stats
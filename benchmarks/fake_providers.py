@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+import base64
+import json
+import random
+import socket
+import struct
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# Stand-ins for the upstream providers, speaking just enough of each wire format for the adapters.
+# They run in the same process as the benchmark, so nothing leaves the machine. Every response waits
+# `latency` seconds before its first byte and then produces completion_tokens at tokens_per_second, so
+# anything a request takes beyond that is Warp Pipe (or the benchmark machine) and not the provider.
+DEFAULT_FAKE_OPTIONS = {
+    # Seconds before the first byte of every response.
+    "latency": 0.05,
+    # 0 sends the whole completion at once.
+    "tokens_per_second": 200,
+    "completion_tokens": 64,
+    # Share of requests answered with error_status instead.
+    "error_rate": 0.0,
+    "error_status": 500,
+    "embedding_dimensions": 1024,
+    # Set to make which requests fail repeatable.
+    "seed": None
+}
+
+# Which fake each provider gets. TOGETHER and LMSTUDIO speak plain OpenAI, GROQ moves the stream usage
+# into x_groq, and MISTRAL sends tool_calls as null when there aren't any.
+WIRE_FORMATS = {
+    "OPENAI": "openai",
+    "TOGETHER": "openai",
+    "LMSTUDIO": "openai",
+    "GROQ": "groq",
+    "MISTRAL": "mistral",
+    "OLLAMA": "ollama",
+    "ANTHROPIC": "anthropic"
+}
+TOKEN_TEXT = "lorem "
+
+
+def count_prompt_tokens(messages):
+    # Close enough to a real tokenizer for usage numbers, about four characters a token.
+    return max(1, len(json.dumps(messages)) // 4)
+
+def encode_embedding(embedding):
+    return base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding)).decode("ascii")
+
+class FakeProvider:
+    def __init__(self, wire_format, options=None):
+        self.wire_format = wire_format
+        self.options = dict(DEFAULT_FAKE_OPTIONS)
+        self.options.update(options or {})
+        self.random = random.Random(self.options["seed"])
+        # One vector shared by every input, building a fresh one per request would cost more than the proxy.
+        embedding_random = random.Random(0)
+        self.embedding = [round(embedding_random.uniform(-1, 1), 6) for i in range(self.options["embedding_dimensions"])]
+        self.encoded_embedding = encode_embedding(self.embedding)
+        self.stats = {"requests": 0, "errors": 0}
+        self.socket = None
+        self.server = None
+        self.serve_task = None
+        self.url = None
+        self.app = Starlette(routes=self.get_routes())
+
+    def get_routes(self):
+        if self.wire_format == "ollama":
+            return [
+                Route("/api/chat", self.ollama_chat, methods=["POST"]),
+                Route("/api/embed", self.ollama_embed, methods=["POST"]),
+                Route("/api/embeddings", self.ollama_embeddings, methods=["POST"]),
+                Route("/api/tags", self.ollama_tags, methods=["GET"]),
+                Route("/api/ps", self.ollama_ps, methods=["GET"])
+            ]
+        if self.wire_format == "anthropic":
+            return [Route("/v1/messages", self.anthropic_messages, methods=["POST"])]
+        return [
+            Route("/v1/chat/completions", self.openai_chat, methods=["POST"]),
+            Route("/v1/embeddings", self.openai_embeddings, methods=["POST"]),
+            Route("/v1/models", self.openai_models, methods=["GET"])
+        ]
+
+    # -- LIFECYCLE --
+
+    def bind(self, host="127.0.0.1", port=0):
+        # Bound up front so the url is known before the config that points at it is built.
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Accepted connections inherit this. Without it every keep-alive response sits out a 40ms delayed ACK.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.bind((host, port))
+        host, port = self.socket.getsockname()
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def start(self):
+        if self.socket is None:
+            self.bind()
+        uvicorn_config = uvicorn.Config(self.app, log_level="warning", lifespan="off", access_log=False)
+        self.server = uvicorn.Server(uvicorn_config)
+        self.serve_task = asyncio.ensure_future(self.server.serve(sockets=[self.socket]))
+        while not self.server.started:
+            if self.serve_task.done():
+                self.serve_task.result()
+            await asyncio.sleep(0.01)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.should_exit = True
+            await self.serve_task
+            self.server = None
+
+    # -- TIMING --
+
+    async def begin_response(self):
+        # Returns an error response for the share of requests that should fail, otherwise waits out the latency.
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.options["latency"])
+        if self.options["error_rate"] and self.random.random() < self.options["error_rate"]:
+            self.stats["errors"] += 1
+            error_body = {"error": {"message": "Injected failure", "type": "server_error", "param": None, "code": None}}
+            if self.wire_format == "ollama":
+                error_body = {"error": "Injected failure"}
+            elif self.wire_format == "anthropic":
+                error_body = {"type": "error", "error": {"type": "api_error", "message": "Injected failure"}}
+            return JSONResponse(error_body, status_code=self.options["error_status"])
+        return None
+
+    def get_completion_tokens(self, request_body):
+        return min(request_body.get("max_tokens") or self.options["completion_tokens"], self.options["completion_tokens"])
+
+    async def generate_tokens(self, request_body):
+        # The first token goes out right away. The rest are paced against the start time rather than slept
+        # one at a time, so sleep overshoot doesn't add up over a long completion.
+        tokens_per_second = self.options["tokens_per_second"]
+        start_time = time.perf_counter()
+        for i in range(self.get_completion_tokens(request_body)):
+            if i > 0 and tokens_per_second:
+                await asyncio.sleep(max(0, start_time + i / tokens_per_second - time.perf_counter()))
+            yield TOKEN_TEXT
+
+    async def get_completion(self, request_body):
+        # Takes as long as the last token of the same completion streamed would.
+        completion_tokens = self.get_completion_tokens(request_body)
+        if self.options["tokens_per_second"]:
+            await asyncio.sleep((completion_tokens - 1) / self.options["tokens_per_second"])
+        return TOKEN_TEXT * completion_tokens, completion_tokens
+
+    # -- OPENAI, GROQ, MISTRAL, TOGETHER, LMSTUDIO --
+
+    async def openai_chat(self, request):
+        request_body = await request.json()
+        error_response = await self.begin_response()
+        if error_response is not None:
+            return error_response
+        created_time = int(time.time())
+        prompt_tokens = count_prompt_tokens(request_body.get("messages", []))
+        if request_body.get("stream", False):
+            return StreamingResponse(self.openai_chat_stream(request_body, created_time, prompt_tokens), media_type="text/event-stream")
+
+        content, completion_tokens = await self.get_completion(request_body)
+        message = {"role": "assistant", "content": content}
+        if self.wire_format == "mistral":
+            message["tool_calls"] = None
+        return JSONResponse({
+            "id": f"chatcmpl-{created_time}",
+            "object": "chat.completion",
+            "created": created_time,
+            "model": request_body.get("model"),
+            "choices": [{"index": 0, "message": message, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        })
+
+    async def openai_chat_stream(self, request_body, created_time, prompt_tokens):
+        def build_chunk(delta, finish_reason=None):
+            return {
+                "id": f"chatcmpl-{created_time}",
+                "object": "chat.completion.chunk",
+                "created": created_time,
+                "model": request_body.get("model"),
+                "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}]
+            }
+
+        yield f"data: {json.dumps(build_chunk({'role': 'assistant', 'content': ''}))}\n\n"
+        completion_tokens = 0
+        async for token in self.generate_tokens(request_body):
+            completion_tokens += 1
+            yield f"data: {json.dumps(build_chunk({'content': token}))}\n\n"
+        last_chunk = build_chunk({}, "stop")
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        if self.wire_format == "groq":
+            last_chunk["x_groq"] = {"id": f"req_{created_time}", "usage": usage}
+        else:
+            last_chunk["usage"] = usage
+        yield f"data: {json.dumps(last_chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    async def openai_embeddings(self, request):
+        request_body = await request.json()
+        error_response = await self.begin_response()
+        if error_response is not None:
+            return error_response
+        input_list = request_body["input"]
+        if not isinstance(input_list, list):
+            input_list = [input_list]
+        embedding = self.embedding
+        if request_body.get("encoding_format") == "base64":
+            embedding = self.encoded_embedding
+        prompt_tokens = sum(max(1, len(input_text) // 4) for input_text in input_list)
+        return JSONResponse({
+            "object": "list",
+            "data": [{"object": "embedding", "embedding": embedding, "index": i} for i in range(len(input_list))],
+            "model": request_body.get("model"),
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+        })
+
+    async def openai_models(self, request):
+        return JSONResponse({
+            "object": "list",
+            "data": [{"id": "fake-model", "object": "model", "created": 0, "owned_by": "warp-pipe-benchmark"}]
+        })
+
+    # -- OLLAMA --
+
+    async def ollama_chat(self, request):
+        request_body = await request.json()
+        error_response = await self.begin_response()
+        if error_response is not None:
+            return error_response
+        prompt_tokens = count_prompt_tokens(request_body.get("messages", []))
+        ollama_request = {"max_tokens": request_body.get("options", {}).get("num_predict")}
+        if request_body.get("stream", True):
+            return StreamingResponse(self.ollama_chat_stream(request_body, ollama_request, prompt_tokens), media_type="application/x-ndjson")
+
+        content, completion_tokens = await self.get_completion(ollama_request)
+        return JSONResponse({
+            "model": request_body.get("model"),
+            "created_at": "2024-05-01T00:00:00Z",
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "done_reason": "stop",
+            "load_duration": 1000000,
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": completion_tokens
+        })
+
+    async def ollama_chat_stream(self, request_body, ollama_request, prompt_tokens):
+        completion_tokens = 0
+        async for token in self.generate_tokens(ollama_request):
+            completion_tokens += 1
+            yield json.dumps({"model": request_body.get("model"), "created_at": "2024-05-01T00:00:00Z", "message": {"role": "assistant", "content": token}, "done": False}) + "\n"
+        yield json.dumps({
+            "model": request_body.get("model"),
+            "created_at": "2024-05-01T00:00:00Z",
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "load_duration": 1000000,
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": completion_tokens
+        }) + "\n"
+
+    async def ollama_embed(self, request):
+        request_body = await request.json()
+        error_response = await self.begin_response()
+        if error_response is not None:
+            return error_response
+        input_list = request_body["input"]
+        if not isinstance(input_list, list):
+            input_list = [input_list]
+        return JSONResponse({
+            "model": request_body.get("model"),
+            "embeddings": [self.embedding] * len(input_list),
+            "load_duration": 1000000,
+            "prompt_eval_count": sum(max(1, len(input_text) // 4) for input_text in input_list)
+        })
+
+    async def ollama_embeddings(self, request):
+        await request.json()
+        error_response = await self.begin_response()
+        if error_response is not None:
+            return error_response
+        return JSONResponse({"embedding": self.embedding})
+
+    async def ollama_tags(self, request):
+        return JSONResponse({"models": [{"name": "fake-model:latest", "model": "fake-model:latest", "modified_at": "2024-05-01T00:00:00Z", "size": 0}]})
+
+    async def ollama_ps(self, request):
+        return JSONResponse({"models": []})
+
+    # -- ANTHROPIC --
+
+    async def anthropic_messages(self, request):
+        request_body = await request.json()
+        error_response = await self.begin_response()
+        if error_response is not None:
+            return error_response
+        created_time = int(time.time())
+        prompt_tokens = count_prompt_tokens(request_body.get("messages", []))
+        if request_body.get("stream", False):
+            return StreamingResponse(self.anthropic_messages_stream(request_body, created_time, prompt_tokens), media_type="text/event-stream")
+
+        content, completion_tokens = await self.get_completion(request_body)
+        return JSONResponse({
+            "id": f"msg_{created_time}",
+            "type": "message",
+            "role": "assistant",
+            "model": request_body.get("model"),
+            "content": [{"type": "text", "text": content}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens}
+        })
+
+    async def anthropic_messages_stream(self, request_body, created_time, prompt_tokens):
+        def build_event(event_type, event):
+            event["type"] = event_type
+            return f"event: {event_type}\ndata: {json.dumps(event)}\n\n"
+
+        yield build_event("message_start", {"message": {
+            "id": f"msg_{created_time}",
+            "type": "message",
+            "role": "assistant",
+            "model": request_body.get("model"),
+            "content": [],
+            "stop_reason": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": 1}
+        }})
+        yield build_event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        completion_tokens = 0
+        async for token in self.generate_tokens(request_body):
+            completion_tokens += 1
+            yield build_event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": token}})
+        yield build_event("content_block_stop", {"index": 0})
+        yield build_event("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": completion_tokens}})
+        yield build_event("message_stop", {})
+
+
+async def serve_forever(provider, host, port, options):
+    fake_provider = FakeProvider(WIRE_FORMATS[provider], options)
+    fake_provider.bind(host, port)
+    await fake_provider.start()
+    print(f"Fake {provider} listening on {fake_provider.url}")
+    try:
+        await fake_provider.serve_task
+    finally:
+        await fake_provider.stop()
+
+def main():
+    # Runs one fake on its own, to point a real Warp Pipe at it and load test over HTTP.
+    parser = argparse.ArgumentParser(description="Serve a fake LLM provider for load testing Warp Pipe.")
+    parser.add_argument("--provider", default="OPENAI", type=str.upper, choices=sorted(WIRE_FORMATS))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=0, type=int)
+    parser.add_argument("--latency", default=DEFAULT_FAKE_OPTIONS["latency"], type=float)
+    parser.add_argument("--tokens-per-second", default=DEFAULT_FAKE_OPTIONS["tokens_per_second"], type=float)
+    parser.add_argument("--completion-tokens", default=DEFAULT_FAKE_OPTIONS["completion_tokens"], type=int)
+    parser.add_argument("--error-rate", default=DEFAULT_FAKE_OPTIONS["error_rate"], type=float)
+    parser.add_argument("--error-status", default=DEFAULT_FAKE_OPTIONS["error_status"], type=int)
+    parser.add_argument("--embedding-dimensions", default=DEFAULT_FAKE_OPTIONS["embedding_dimensions"], type=int)
+    parser.add_argument("--seed", default=None, type=int)
+    args = parser.parse_args()
+    options = {option: getattr(args, option) for option in DEFAULT_FAKE_OPTIONS}
+    try:
+        asyncio.run(serve_forever(args.provider, args.host, args.port, options))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
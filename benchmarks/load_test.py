@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import copy
+import importlib
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+import fake_providers
+
+# Load test for the adapters. Every provider gets pointed at a fake (see fake_providers.py) and each
+# scenario calls the adapter's process_request directly, many at once, the same way warp_pipe.py does.
+# Everything runs on one event loop with the fakes, so absolute numbers depend on the machine. Compare
+# runs against each other (before and after a change, or two configs) on the same machine.
+#
+#   python benchmarks/load_test.py --providers ollama,openai --requests 500 --concurrency 32
+#   python benchmarks/load_test.py --config my_config.json --output after.json
+
+ADAPTER_MODULES = {
+    "OPENAI": "adapter_openai",
+    "GROQ": "adapter_groq",
+    "MISTRAL": "adapter_mistral",
+    "TOGETHER": "adapter_together",
+    "ANTHROPIC": "adapter_anthropic",
+    "OLLAMA": "adapter_ollama",
+    "LMSTUDIO": "adapter_lmstudio"
+}
+BENCHMARK_MODELS = {
+    "ANTHROPIC": "claude-3-haiku-20240307",
+    "OLLAMA": "llama3:latest"
+}
+# GROQ and ANTHROPIC have no embeddings endpoint.
+EMBEDDING_PROVIDERS = {"OPENAI", "MISTRAL", "TOGETHER", "OLLAMA", "LMSTUDIO"}
+# Providers that can spread over several backends, and so get --backends fakes each.
+POOLED_PROVIDERS = {"OLLAMA", "LMSTUDIO"}
+SCENARIOS = ("chat", "stream", "embeddings")
+
+
+def build_chat_body(model_name, history_length, stream):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(history_length):
+        messages.append({"role": "user", "content": f"Question {i}: how does a proxy add latency to a request?"})
+        messages.append({"role": "assistant", "content": f"Answer {i}: " + "every hop parses and re-serializes the payload. " * 4})
+    messages.append({"role": "user", "content": "Summarize the above."})
+    return {"model": model_name, "messages": messages, "stream": stream}
+
+def build_embeddings_body(model_name, input_count):
+    # Unique inputs, so the embedding cache never answers for the provider.
+    request_id = uuid.uuid4().hex
+    return {"model": model_name, "input": [f"benchmark input {request_id} {i}" for i in range(input_count)]}
+
+def get_percentile(sorted_values, percentile):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(percentile * len(sorted_values)))]
+
+def build_config(args, provider_urls):
+    # Start from the given config file, or the defaults, and point every provider at its fakes.
+    if args.config is not None:
+        with open(args.config, "r") as config_file:
+            config_data = json.load(config_file)
+    else:
+        config_data = copy.deepcopy(config_manager.DEFAULT_CONFIG)
+    config_data.setdefault("logging", {})
+    config_data["logging"]["level"] = args.log_level
+    # Embeddings are cached in memory as usual, but never written next to wherever the benchmark was run.
+    config_data.setdefault("embedding_cache", {})
+    config_data["embedding_cache"]["disk_path"] = ""
+    provider_options = config_data.setdefault("provider_options", {})
+    for provider, urls in provider_urls.items():
+        options = dict(provider_options.get(provider, {}))
+        options["base_url"] = urls[0]
+        options["api_key"] = "benchmark"
+        options.pop("backends", None)
+        if len(urls) > 1:
+            options["backends"] = [{"base_url": url} for url in urls]
+        provider_options[provider] = options
+    return config_manager.build_config(config_data)
+
+async def send_one(process_request, header_info, path, request_body):
+    # Returns (succeeded, status, seconds to the first chunk, seconds to the end). Responses that come back
+    # whole count their first chunk as arriving with the rest, that's what the client would see.
+    start_time = time.perf_counter()
+    first_chunk_time = None
+    try:
+        response = await process_request(path, header_info, request_body)
+        if response.success and response.stream:
+            async for chunk in response.body:
+                if first_chunk_time is None:
+                    first_chunk_time = time.perf_counter()
+    except Exception as e:
+        return False, type(e).__name__, None, time.perf_counter() - start_time
+    end_time = time.perf_counter()
+    if first_chunk_time is None:
+        first_chunk_time = end_time
+    return response.success, response.status_code, first_chunk_time - start_time, end_time - start_time
+
+async def run_scenario(provider, scenario, args):
+    process_request = importlib.import_module(ADAPTER_MODULES[provider]).process_request
+    header_info = {"llm_provider": provider}
+    model_name = BENCHMARK_MODELS.get(provider, "fake-model")
+    if scenario == "embeddings":
+        path = "/v1/embeddings"
+        make_body = lambda: build_embeddings_body(model_name, args.embedding_inputs)
+    else:
+        path = "/v1/chat/completions"
+        make_body = lambda: build_chat_body(model_name, args.history, scenario == "stream")
+
+    # Opens the connections before anything is timed.
+    await asyncio.gather(*[send_one(process_request, header_info, path, make_body()) for i in range(min(args.concurrency, args.requests))])
+
+    results = []
+    remaining = [args.requests]
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            results.append(await send_one(process_request, header_info, path, make_body()))
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker() for i in range(args.concurrency)])
+    elapsed = time.perf_counter() - start_time
+
+    successes = [result for result in results if result[0]]
+    errors = {}
+    for result in results:
+        if not result[0]:
+            errors[str(result[1])] = errors.get(str(result[1]), 0) + 1
+    latencies = sorted(result[3] for result in successes)
+    first_chunk_latencies = sorted(result[2] for result in successes)
+    # The least the fake could have taken, so what's left over is the proxy's share.
+    upstream_seconds = args.latency
+    if scenario != "embeddings" and args.tokens_per_second:
+        upstream_seconds += (args.completion_tokens - 1) / args.tokens_per_second
+
+    scenario_result = {
+        "provider": provider,
+        "scenario": scenario,
+        "requests": len(results),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(successes) / elapsed, 2),
+        "latency_p50": get_percentile(latencies, 0.5),
+        "latency_p99": get_percentile(latencies, 0.99),
+        "overhead_p50": None
+    }
+    if len(latencies) > 0:
+        scenario_result["overhead_p50"] = scenario_result["latency_p50"] - upstream_seconds
+    if scenario == "stream":
+        scenario_result["ttft_p50"] = get_percentile(first_chunk_latencies, 0.5)
+        scenario_result["ttft_p99"] = get_percentile(first_chunk_latencies, 0.99)
+    return scenario_result
+
+def format_ms(seconds):
+    if seconds is None:
+        return "-"
+    return f"{seconds * 1000:.1f}"
+
+def print_results(results):
+    print(f"{'provider':<10} {'scenario':<11} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'ttft p50':>9} {'ttft p99':>9} {'overhead':>9}  errors")
+    for result in results:
+        errors = ", ".join(f"{status}: {count}" for status, count in result["errors"].items()) or "-"
+        print(f"{result['provider']:<10} {result['scenario']:<11} {result['throughput']:>8.1f} {format_ms(result['latency_p50']):>8} {format_ms(result['latency_p99']):>8} "
+              f"{format_ms(result.get('ttft_p50')):>9} {format_ms(result.get('ttft_p99')):>9} {format_ms(result['overhead_p50']):>9}  {errors}")
+
+async def run_load_test(args):
+    fake_options = {
+        "latency": args.latency,
+        "tokens_per_second": args.tokens_per_second,
+        "completion_tokens": args.completion_tokens,
+        "error_rate": args.error_rate,
+        "error_status": args.error_status,
+        "embedding_dimensions": args.embedding_dimensions,
+        "seed": args.seed
+    }
+    fakes = []
+    provider_urls = {}
+    for provider in args.providers:
+        backend_count = args.backends if provider in POOLED_PROVIDERS else 1
+        provider_urls[provider] = []
+        for i in range(backend_count):
+            fake_provider = fake_providers.FakeProvider(fake_providers.WIRE_FORMATS[provider], fake_options)
+            provider_urls[provider].append(fake_provider.bind())
+            fakes.append(fake_provider)
+
+    # The rest of Warp Pipe reads the config as it's imported, so the benchmark's goes in first.
+    config_manager.swap_config(build_config(args, provider_urls))
+    import log_manager
+    import request_manager
+    log_manager.setup_logging()
+    for fake_provider in fakes:
+        await fake_provider.start()
+    request_manager.init_clients()
+
+    results = []
+    try:
+        for provider in args.providers:
+            for scenario in args.scenarios:
+                if scenario == "embeddings" and provider not in EMBEDDING_PROVIDERS:
+                    continue
+                results.append(await run_scenario(provider, scenario, args))
+    finally:
+        await request_manager.close_clients()
+        for fake_provider in fakes:
+            await fake_provider.stop()
+        log_manager.stop_logging()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Warp Pipe's adapters against local fake providers.")
+    parser.add_argument("--providers", default=",".join(ADAPTER_MODULES), type=lambda value: [provider.strip().upper() for provider in value.split(",")])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), type=lambda value: [scenario.strip() for scenario in value.split(",")])
+    parser.add_argument("--requests", default=200, type=int, help="Timed requests per scenario.")
+    parser.add_argument("--concurrency", default=16, type=int)
+    parser.add_argument("--history", default=8, type=int, help="Question and answer pairs in every chat request.")
+    parser.add_argument("--embedding-inputs", default=16, type=int, help="Inputs in every embeddings request.")
+    parser.add_argument("--backends", default=1, type=int, help="Fakes behind each OLLAMA and LMSTUDIO provider.")
+    parser.add_argument("--latency", default=fake_providers.DEFAULT_FAKE_OPTIONS["latency"], type=float)
+    parser.add_argument("--tokens-per-second", default=fake_providers.DEFAULT_FAKE_OPTIONS["tokens_per_second"], type=float)
+    parser.add_argument("--completion-tokens", default=fake_providers.DEFAULT_FAKE_OPTIONS["completion_tokens"], type=int)
+    parser.add_argument("--error-rate", default=fake_providers.DEFAULT_FAKE_OPTIONS["error_rate"], type=float)
+    parser.add_argument("--error-status", default=fake_providers.DEFAULT_FAKE_OPTIONS["error_status"], type=int)
+    parser.add_argument("--embedding-dimensions", default=fake_providers.DEFAULT_FAKE_OPTIONS["embedding_dimensions"], type=int)
+    parser.add_argument("--seed", default=None, type=int)
+    parser.add_argument("--config", default=None, help="Config file to benchmark with. Provider URLs are pointed at the fakes.")
+    parser.add_argument("--log-level", default="ERROR", help="Warp Pipe log level. Injected errors log a warning each.")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    for provider in args.providers:
+        if provider not in ADAPTER_MODULES:
+            parser.error(f"Unknown provider {provider}, expected some of {', '.join(ADAPTER_MODULES)}")
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"Unknown scenario {scenario}, expected some of {', '.join(SCENARIOS)}")
+
+    results = asyncio.run(run_load_test(args))
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({"options": vars(args), "results": results}, output_file, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+# Microbenchmarks for the per-request CPU work: the request and response translation every adapter does,
+# the fallback stream chunking and base64 embeddings. Payloads are built once, from a fixed seed, and sized
+# like busy real traffic (long chat histories, big tool schemas, 1000 vector embedding batches).
+#
+#   python benchmarks/microbench.py run --output benchmarks/baselines/main.json
+#   python benchmarks/microbench.py run --baseline benchmarks/baselines/main.json --threshold 0.1
+#   python benchmarks/microbench.py compare before.json after.json
+#
+# compare (and run with --baseline) exits with 1 when anything got slower than the threshold allows, so it
+# can gate a merge. Timings are per call and only comparable between runs on the same machine.
+
+# Benchmarks read the config as they're imported, so they get the defaults rather than whatever file is around.
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import oai_tools
+import adapter_anthropic
+import adapter_ollama
+
+# Batches are grown until one takes at least this long, so timer resolution doesn't matter.
+DEFAULT_MIN_BATCH_TIME = 0.05
+DEFAULT_REPEAT = 7
+DEFAULT_THRESHOLD = 0.10
+
+
+# -- PAYLOADS --
+
+def build_words(rng, word_count):
+    words = ["the", "proxy", "model", "request", "token", "stream", "answer", "context", "function", "backend", "latency", "embedding"]
+    return " ".join(rng.choice(words) for i in range(word_count))
+
+def build_history(rng, turns):
+    messages = [{"role": "system", "content": build_words(rng, 200)}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": build_words(rng, 60)})
+        messages.append({"role": "assistant", "content": build_words(rng, 250)})
+    return messages
+
+def build_multimodal_history(rng, turns):
+    # Every fifth user turn carries an image, the way a vision chat piles them up over a conversation.
+    messages = build_history(rng, turns)
+    for i in range(1, len(messages), 10):
+        messages[i] = {"role": "user", "content": [
+            {"type": "text", "text": messages[i]["content"]},
+            {"type": "image_url", "image_url": {"url": f"https://example.com/image-{i}.png"}}
+        ]}
+    return messages
+
+def build_tools(rng, tool_count, property_count):
+    tools = []
+    for i in range(tool_count):
+        properties = {}
+        for j in range(property_count):
+            properties[f"argument_{j}"] = {
+                "type": rng.choice(["string", "integer", "number", "boolean"]),
+                "description": build_words(rng, 12)
+            }
+        properties["options"] = {
+            "type": "object",
+            "properties": {f"option_{j}": {"type": "string", "enum": ["a", "b", "c"]} for j in range(5)}
+        }
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": f"function_{i}",
+                "description": build_words(rng, 30),
+                "parameters": {"type": "object", "properties": properties, "required": [f"argument_{j}" for j in range(0, property_count, 2)]}
+            }
+        })
+    return tools
+
+def build_anthropic_response(rng, tool_uses):
+    content = [{"type": "text", "text": build_words(rng, 400)}]
+    for i in range(tool_uses):
+        content.append({
+            "type": "tool_use",
+            "id": f"toolu_{i:024d}",
+            "name": f"function_{i}",
+            "input": {f"argument_{j}": build_words(rng, 8) for j in range(10)}
+        })
+    return {
+        "id": "msg_01XFDUDYJgAACzvnptvVoYEL",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-3-haiku-20240307",
+        "content": content,
+        "stop_reason": "tool_use",
+        "usage": {"input_tokens": 5000, "output_tokens": 1200}
+    }
+
+def build_completion(rng, choice_count, word_count):
+    return {
+        "id": "chatcmpl-123",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "llama3:latest",
+        "choices": [{"index": i, "message": {"role": "assistant", "content": build_words(rng, word_count)}, "logprobs": None, "finish_reason": "stop"} for i in range(choice_count)],
+        "usage": {"prompt_tokens": 5000, "completion_tokens": 4000, "total_tokens": 9000}
+    }
+
+def build_embedding_data(rng, vector_count, dimensions):
+    return [{"object": "embedding", "embedding": [rng.uniform(-1, 1) for i in range(dimensions)], "index": i} for i in range(vector_count)]
+
+def copy_embedding_data(embedding_data):
+    # encode_embedding_data_to_base64 swaps the vectors out in place, every call needs its own items.
+    return [dict(data) for data in embedding_data]
+
+# -- BENCHMARKS --
+
+def get_benchmarks():
+    # name -> (payload factory, function to time, copier for functions that change their input, or None)
+    return {
+        "generate_response_chunks/long_answer": (
+            lambda rng: build_completion(rng, 1, 6000), oai_tools.generate_response_chunks, None),
+        "generate_response_chunks/n4": (
+            lambda rng: build_completion(rng, 4, 1500), oai_tools.generate_response_chunks, None),
+        "split_string_by_length/1mb": (
+            lambda rng: build_words(rng, 160000), lambda text: oai_tools.split_string_by_length(text, 4096), None),
+        "convert_openai_request_to_anthropic/tools": (
+            lambda rng: {"model": "claude-3-haiku-20240307", "messages": build_history(rng, 50), "tools": build_tools(rng, 64, 12)},
+            adapter_anthropic.convert_openai_request_to_anthropic, None),
+        "convert_anthropic_response_to_openai/tool_use": (
+            lambda rng: build_anthropic_response(rng, 16), adapter_anthropic.convert_anthropic_response_to_openai, None),
+        "ollama_convert_messages/history": (
+            lambda rng: build_history(rng, 100), adapter_ollama.convert_messages, None),
+        "ollama_convert_messages/multimodal": (
+            lambda rng: build_multimodal_history(rng, 100), adapter_ollama.convert_messages, None),
+        "encode_embedding_data_to_base64/1000x1024": (
+            lambda rng: build_embedding_data(rng, 1000, 1024), oai_tools.encode_embedding_data_to_base64, copy_embedding_data),
+        "encode_embedding_data_to_base64/1000x1536": (
+            lambda rng: build_embedding_data(rng, 1000, 1536), oai_tools.encode_embedding_data_to_base64, copy_embedding_data),
+        "encode_embeddings_to_base64/1536": (
+            lambda rng: build_embedding_data(rng, 1, 1536)[0]["embedding"], oai_tools.encode_embeddings_to_base64, None),
+        "build_tool_prompt/tools": (
+            lambda rng: build_tools(rng, 64, 12), oai_tools.build_tool_prompt, None)
+    }
+
+def time_batch(function, payload, copier, loops):
+    # Copies are made before the clock starts, only the calls themselves are timed.
+    if copier is not None:
+        payloads = [copier(payload) for i in range(loops)]
+    else:
+        payloads = [payload] * loops
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start_time = time.perf_counter()
+        for each_payload in payloads:
+            function(each_payload)
+        return time.perf_counter() - start_time
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def run_benchmark(make_payload, function, copier, repeat, min_batch_time):
+    payload = make_payload(random.Random(0))
+    # The first call warms up anything lazy, and the loop count doubles until a batch is long enough.
+    loops = 1
+    while time_batch(function, payload, copier, loops) < min_batch_time:
+        loops *= 2
+    timings = [time_batch(function, payload, copier, loops) / loops for i in range(repeat)]
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "loops": loops,
+        "repeat": repeat
+    }
+
+def run_benchmarks(name_filter=None, repeat=DEFAULT_REPEAT, min_batch_time=DEFAULT_MIN_BATCH_TIME):
+    results = {}
+    for name, (make_payload, function, copier) in get_benchmarks().items():
+        if name_filter is not None and name_filter not in name:
+            continue
+        results[name] = run_benchmark(make_payload, function, copier, repeat, min_batch_time)
+        print(f"{name:<50} {format_seconds(results[name]['min']):>12} {format_seconds(results[name]['median']):>12}", flush=True)
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "benchmarks": results
+    }
+
+# -- COMPARING --
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f} us"
+    return f"{seconds * 1e3:.2f} ms"
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    # Compared on the fastest run, which is the one least disturbed by whatever else the machine was doing.
+    # Returns the names that got slower by more than threshold.
+    regressions = []
+    if baseline.get("python") != current.get("python") or baseline.get("machine") != current.get("machine"):
+        print(f"Warning: baseline is from Python {baseline.get('python')} on {baseline.get('machine')}, "
+              f"this is Python {current.get('python')} on {current.get('machine')}.")
+    print(f"{'benchmark':<50} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, result in current["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None:
+            print(f"{name:<50} {'-':>12} {format_seconds(result['min']):>12} {'new':>9}")
+            continue
+        change = result["min"] / baseline_result["min"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<50} {format_seconds(baseline_result['min']):>12} {format_seconds(result['min']):>12} {change * 100:>+8.1f}%{flag}")
+    for name in baseline["benchmarks"]:
+        if name not in current["benchmarks"]:
+            print(f"{name:<50} {format_seconds(baseline['benchmarks'][name]['min']):>12} {'-':>12} {'missing':>9}")
+    if len(regressions) > 0:
+        print(f"{len(regressions)} benchmark(s) slower than the {threshold * 100:.0f}% threshold: {', '.join(regressions)}")
+    return regressions
+
+def load_results(path):
+    with open(path, "r") as results_file:
+        return json.load(results_file)
+
+def save_results(path, results):
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=4)
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for Warp Pipe's translation hot paths.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument("--output", default=None, help="Save the results as a JSON baseline.")
+    run_parser.add_argument("--baseline", default=None, help="Compare against this baseline and exit 1 on a regression.")
+    run_parser.add_argument("--threshold", default=DEFAULT_THRESHOLD, type=float, help="Slowdown that counts as a regression, 0.1 is 10%%.")
+    run_parser.add_argument("--filter", default=None, help="Only run benchmarks whose name contains this.")
+    run_parser.add_argument("--repeat", default=DEFAULT_REPEAT, type=int)
+    run_parser.add_argument("--min-batch-time", default=DEFAULT_MIN_BATCH_TIME, type=float)
+
+    compare_parser = commands.add_parser("compare", help="Compare two saved results and exit 1 on a regression.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", default=DEFAULT_THRESHOLD, type=float, help="Slowdown that counts as a regression, 0.1 is 10%%.")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        print(f"{'benchmark':<50} {'min':>12} {'median':>12}")
+        results = run_benchmarks(args.filter, args.repeat, args.min_batch_time)
+        if args.output is not None:
+            save_results(args.output, results)
+        if args.baseline is not None:
+            print()
+            if compare_results(load_results(args.baseline), results, args.threshold):
+                sys.exit(1)
+    else:
+        if compare_results(load_results(args.baseline), load_results(args.current), args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
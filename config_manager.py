@@ -1,9 +1,21 @@
 import os
+import asyncio
+import contextvars
 import json
+import logging
+import types
 import uuid
 
-APP_CONFIG = {}
+# APP_CONFIG is an immutable snapshot. A reload builds a whole new one and swaps it in, so readers
+# never see a half-applied config, and a request pins the snapshot it started with.
+APP_CONFIG = types.MappingProxyType({})
 CONFIG_LOADED = False
+CONFIG_SNAPSHOT = contextvars.ContextVar("config_snapshot", default=None)
+CONFIG_MTIME = None
+# Called with (old config, new config) after every swap.
+RELOAD_LISTENERS = []
+# log_manager reads this module's config, so it gets the stdlib logger instead of importing log_manager.
+LOGGER = logging.getLogger("warp_pipe.config_manager")
 CONFIG_PATH = os.environ.get("WARP_PIPE_CONFIG_PATH", None)
 if CONFIG_PATH is None:
     CONFIG_PATH = os.path.expanduser("~/.warp_pipe.conf")
@@ -16,53 +28,216 @@ DEFAULT_CONFIG = {
                     "port": 32823,
                     "allowed_origins": ["localhost"],
                     "default_provider": "OLLAMA",
-                    "provider_options": {}
+                    "provider_options": {},
+                    "embedding_cache": {
+                        "enabled": True,
+                        "max_memory_entries": 10000,
+                        "disk_path": "embedding_cache.db"
+                    },
+                    "image_fetch": {
+                        "timeout": 10,
+                        "max_bytes": 20971520,
+                        "cache_max_bytes": 67108864,
+                        "cache_ttl": 300
+                    },
+                    "response_cache": {
+                        "enabled": False,
+                        "max_bytes": 67108864,
+                        "ttl": 3600
+                    },
+                    "request_coalescing": {
+                        "enabled": True,
+                        "include_sampled": False
+                    },
+                    "request_hedging": {
+                        "enabled": False,
+                        "percentile": 0.95,
+                        "budget": 0.05
+                    },
+                    "rate_limits": {
+                        "default": {},
+                        "keys": {}
+                    },
+                    "scheduler": {
+                        "default_priority": "interactive",
+                        "max_queue_time": {"interactive": 30, "batch": 600},
+                        "keys": {}
+                    },
+                    "usage_ledger": {
+                        "enabled": True,
+                        "disk_path": "usage_ledger.db",
+                        "flush_interval": 10,
+                        "retention_days": 400,
+                        "key_names": {}
+                    },
+                    "logging": {
+                        "level": "INFO",
+                        "format": "json",
+                        "log_payloads": False,
+                        "sample_rates": {}
+                    },
+                    "config_watch_interval": 2
 }
 
 def save_config(config):
     with open(CONFIG_PATH, "w") as config_file:
         json.dump(config, config_file, indent=4)
 
-def load_config():
+def freeze(value):
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def thaw(value):
+    if isinstance(value, types.MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (tuple, frozenset)):
+        return [thaw(item) for item in value]
+    return value
+
+def build_config(config_data):
+    return freeze({
+        # A set, so checking a key is a hash lookup however many there are.
+        "api_keys": frozenset(config_data.get("api_keys",[])),
+        "auth_enforcement_enabled": config_data.get("auth_enforcement_enabled", False),
+        "host": config_data.get("host", "localhost"),
+        "port": config_data.get("port", 32823),
+        "allowed_origins": config_data.get("allowed_origins", ["localhost"]),
+        "default_provider": config_data.get("default_provider", "OLLAMA"),
+        "provider_options": config_data.get("provider_options",{}),
+        "embedding_cache": config_data.get("embedding_cache",{}),
+        "image_fetch": config_data.get("image_fetch",{}),
+        "response_cache": config_data.get("response_cache",{}),
+        "request_coalescing": config_data.get("request_coalescing",{}),
+        "request_hedging": config_data.get("request_hedging",{}),
+        "rate_limits": config_data.get("rate_limits",{}),
+        "scheduler": config_data.get("scheduler",{}),
+        "usage_ledger": config_data.get("usage_ledger",{}),
+        "logging": config_data.get("logging",{}),
+        "config_watch_interval": config_data.get("config_watch_interval", 2)
+    })
+
+def swap_config(new_config):
     global APP_CONFIG
     global CONFIG_LOADED
+    old_config = APP_CONFIG
+    APP_CONFIG = new_config
+    CONFIG_LOADED = True
+    for listener in RELOAD_LISTENERS:
+        listener(old_config, new_config)
+
+def read_config_file():
+    global CONFIG_MTIME
+    # Recorded before parsing so a broken file is only reported once, not on every poll.
+    CONFIG_MTIME = os.path.getmtime(CONFIG_PATH)
+    with open(CONFIG_PATH, "r") as config_file:
+        return json.load(config_file)
+
+def load_config():
     try:
-        with open(CONFIG_PATH, "r") as config_file:
-            config_data = json.load(config_file)
+        config_data = read_config_file()
     except:
         config_data = DEFAULT_CONFIG
         save_config(config_data)
-    CONFIG_LOADED = True
-    APP_CONFIG["api_keys"] = config_data.get("api_keys",[])
-    APP_CONFIG["auth_enforcement_enabled"] = config_data.get("auth_enforcement_enabled", False)
-    APP_CONFIG["host"] = config_data.get("host", "localhost")
-    APP_CONFIG["port"] = config_data.get("port", 32823)
-    APP_CONFIG["allowed_origins"] = config_data.get("allowed_origins", ["localhost"])
-    APP_CONFIG["default_provider"] = config_data.get("default_provider", "OLLAMA")
-    APP_CONFIG["provider_options"] = config_data.get("provider_options",{})
+    swap_config(build_config(config_data))
+
+async def reload_config():
+    # Re-reads the file off the event loop and swaps it in. A broken file leaves the running config alone.
+    # In-flight requests keep the snapshot they started with, new ones get the new one.
+    config_data = await asyncio.to_thread(read_config_file)
+    swap_config(build_config(config_data))
+
+def config_file_changed():
+    try:
+        return os.path.getmtime(CONFIG_PATH) != CONFIG_MTIME
+    except OSError:
+        return False
+
+async def watch_config():
+    # Polls the file's mtime, cheap enough to leave running and it works on every platform.
+    while True:
+        watch_interval = get_config()["config_watch_interval"]
+        if not watch_interval:
+            return
+        await asyncio.sleep(watch_interval)
+        if config_file_changed():
+            try:
+                await reload_config()
+                LOGGER.info("Reloaded configuration from %s", CONFIG_PATH)
+            except Exception as e:
+                LOGGER.warning("Configuration reload failed, keeping the current one: %s", e)
+
+def add_reload_listener(listener):
+    RELOAD_LISTENERS.append(listener)
+
+def pin_config():
+    # Pins the current snapshot to the running request so it reads one consistent config throughout.
+    CONFIG_SNAPSHOT.set(APP_CONFIG)
+
+class ConfigSnapshotMiddleware:
+    # Pins the snapshot at the start of every request, so a reload mid-request can't mix old and new settings.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Not for lifespan: anything started from the startup event would be stuck on the first config forever.
+        if scope["type"] in ("http", "websocket"):
+            pin_config()
+        await self.app(scope, receive, send)
+
+def start_background_task(coroutine):
+    # Long running loops start in an empty context, so they never inherit a pinned snapshot and always
+    # read the live config.
+    return contextvars.Context().run(asyncio.ensure_future, coroutine)
 
 def get_config():
-    global CONFIG_LOADED
-    global APP_CONFIG
     if not CONFIG_LOADED:
         load_config()
-    return APP_CONFIG
+    config = CONFIG_SNAPSHOT.get()
+    if config is None:
+        config = APP_CONFIG
+    return config
 
 def get_provider_options(provider, default_options={}):
-    config = get_config()
-    provider_options = config["provider_options"].get(provider)
-    if provider_options is None:
-        provider_options = default_options
-        set_provider_options(provider, provider_options)
-    return provider_options
+    # Missing options fall back to the defaults in memory, nothing gets written back to the file.
+    provider_options = get_config()["provider_options"].get(provider, {})
+    return types.MappingProxyType({**default_options, **provider_options})
+
+class ProviderOptions:
+    # A live read-only view of one provider's options, so adapters can hold onto it across reloads.
+    def __init__(self, provider, default_options={}):
+        self.provider = provider
+        self.default_options = default_options
+
+    def current(self):
+        provider_options = get_config()["provider_options"].get(self.provider, {})
+        return provider_options
+
+    def __getitem__(self, key):
+        provider_options = self.current()
+        if key in provider_options:
+            return provider_options[key]
+        return self.default_options[key]
+
+    def __contains__(self, key):
+        return key in self.current() or key in self.default_options
+
+    def get(self, key, default=None):
+        provider_options = self.current()
+        if key in provider_options:
+            return provider_options[key]
+        return self.default_options.get(key, default)
 
 def set_provider_options(provider, options):
-    config = get_config()
-    config["provider_options"][provider] = options
-    save_config(APP_CONFIG)
+    # Admin-side only: writes the options to the file and swaps in a config with them applied.
+    config_data = thaw(get_config())
+    config_data["provider_options"][provider] = options
+    save_config(config_data)
+    swap_config(build_config(config_data))
 
 def init_config():
-    global APP_CONFIG
     if not os.path.exists(CONFIG_PATH):
         save_config(DEFAULT_CONFIG)
         print(f"Configuration file not found at {CONFIG_PATH}. A new configuration file has been created with default values. Please edit this file to configure Warp Pipe.")
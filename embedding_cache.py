@@ -0,0 +1,236 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import config_manager
+import log_manager
+import request_manager
+import oai_tools
+
+LOGGER = log_manager.get_logger("embedding_cache")
+
+# Embeddings are cached by (provider, model, dimensions, hash of the input) as packed float32 bytes.
+# The memory tier is a plain LRU, the disk tier is a SQLite file so the cache survives restarts.
+DEFAULT_CACHE_OPTIONS = {
+    "enabled": True,
+    "max_memory_entries": 10000,
+    "disk_path": "embedding_cache.db"
+}
+
+CACHE_STATS = {
+    "memory_hits": 0,
+    "disk_hits": 0,
+    "misses": 0
+}
+
+MEMORY_CACHE = OrderedDict()
+DISK_CACHE = None
+DISK_LOCK = threading.Lock()
+# Disk writes are queued up and flushed by a single background task so requests never wait on them.
+PENDING_DISK_WRITES = []
+DISK_FLUSH_TASK = None
+
+
+def get_cache_options():
+    cache_options = dict(DEFAULT_CACHE_OPTIONS)
+    cache_options.update(config_manager.get_config().get("embedding_cache", {}))
+    return cache_options
+
+def make_cache_key(provider, model_name, input_value, dimensions):
+    if not isinstance(input_value, str):
+        # Token arrays are valid inputs too.
+        input_value = json.dumps(input_value)
+    input_hash = hashlib.sha256(input_value.encode("utf-8")).hexdigest()
+    return f"{provider}|{model_name}|{dimensions}|{input_hash}"
+
+# -- MEMORY TIER --
+
+def memory_get(key):
+    vector_bytes = MEMORY_CACHE.get(key)
+    if vector_bytes is not None:
+        MEMORY_CACHE.move_to_end(key)
+    return vector_bytes
+
+def memory_put(key, vector_bytes, max_entries):
+    MEMORY_CACHE[key] = vector_bytes
+    MEMORY_CACHE.move_to_end(key)
+    while len(MEMORY_CACHE) > max_entries:
+        MEMORY_CACHE.popitem(last=False)
+
+# -- DISK TIER --
+
+def open_disk_cache():
+    global DISK_CACHE
+    disk_path = get_cache_options()["disk_path"]
+    if DISK_CACHE is not None or not disk_path:
+        return DISK_CACHE
+    with DISK_LOCK:
+        connection = sqlite3.connect(disk_path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created INTEGER NOT NULL)")
+        connection.commit()
+        DISK_CACHE = connection
+    return DISK_CACHE
+
+async def close_disk_cache():
+    global DISK_CACHE
+    if DISK_FLUSH_TASK is not None:
+        await DISK_FLUSH_TASK
+    if DISK_CACHE is not None:
+        with DISK_LOCK:
+            DISK_CACHE.close()
+            DISK_CACHE = None
+
+def disk_get_many(keys):
+    connection = open_disk_cache()
+    if connection is None:
+        return {}
+    found = {}
+    with DISK_LOCK:
+        # Stay well under SQLite's bound parameter limit.
+        for i in range(0, len(keys), 500):
+            key_batch = keys[i:i+500]
+            placeholders = ",".join("?" * len(key_batch))
+            for key, vector_bytes in connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", key_batch):
+                found[key] = vector_bytes
+    return found
+
+def disk_put_many(rows):
+    connection = open_disk_cache()
+    if connection is None:
+        return
+    with DISK_LOCK:
+        connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, created) VALUES (?, ?, ?)", rows)
+        connection.commit()
+
+async def flush_disk_writes():
+    global DISK_FLUSH_TASK
+    try:
+        while PENDING_DISK_WRITES:
+            rows = PENDING_DISK_WRITES[:]
+            del PENDING_DISK_WRITES[:]
+            try:
+                await asyncio.to_thread(disk_put_many, rows)
+            except Exception as e:
+                LOGGER.warning("Failed to write %s embeddings to the disk cache: %s", len(rows), e)
+    finally:
+        DISK_FLUSH_TASK = None
+
+def schedule_disk_write(rows):
+    global DISK_FLUSH_TASK
+    PENDING_DISK_WRITES.extend(rows)
+    if DISK_FLUSH_TASK is None:
+        DISK_FLUSH_TASK = asyncio.ensure_future(flush_disk_writes())
+
+# -- LOOKUP --
+
+def get_cache_stats():
+    return {
+        **CACHE_STATS,
+        "memory_entries": len(MEMORY_CACHE),
+        "pending_disk_writes": len(PENDING_DISK_WRITES)
+    }
+
+async def get_embeddings(provider, model_name, fetch_embeddings, request_headers, request_body, native_base64=False):
+    # Splits the batch into cache hits and misses, and only the misses go to fetch_embeddings.
+    # With native_base64 the misses are fetched as base64 so they never get parsed into Python floats.
+    cache_options = get_cache_options()
+    if not cache_options["enabled"]:
+        return await fetch_embeddings(request_headers, request_body)
+
+    input_list = request_body["input"]
+    # A bare string or a single token array is one input.
+    if not isinstance(input_list, list) or (len(input_list) > 0 and isinstance(input_list[0], int)):
+        input_list = [input_list]
+    encoding_format = request_body.get("encoding_format", "float")
+    dimensions = request_body.get("dimensions")
+
+    cache_keys = [make_cache_key(provider, model_name, input_value, dimensions) for input_value in input_list]
+    vectors = {}
+    for key in cache_keys:
+        vector_bytes = memory_get(key)
+        if vector_bytes is not None:
+            vectors[key] = vector_bytes
+            CACHE_STATS["memory_hits"] += 1
+
+    missing_keys = [key for key in dict.fromkeys(cache_keys) if key not in vectors]
+    if missing_keys and cache_options["disk_path"]:
+        disk_vectors = await asyncio.to_thread(disk_get_many, missing_keys)
+        for key, vector_bytes in disk_vectors.items():
+            memory_put(key, vector_bytes, cache_options["max_memory_entries"])
+            vectors[key] = vector_bytes
+        CACHE_STATS["disk_hits"] += len(disk_vectors)
+        missing_keys = [key for key in missing_keys if key not in vectors]
+
+    usage = {
+        "prompt_tokens": 0,
+        "total_tokens": 0
+    }
+    response_model = request_body.get("model")
+    # Base64 that came straight from upstream goes back out untouched.
+    passthrough_base64 = {}
+    if missing_keys:
+        CACHE_STATS["misses"] += len(missing_keys)
+        missing_key_set = set(missing_keys)
+        missing_inputs = {}
+        for key, input_value in zip(cache_keys, input_list):
+            if key in missing_key_set and key not in missing_inputs:
+                missing_inputs[key] = input_value
+
+        upstream_request = dict(request_body)
+        upstream_request["input"] = list(missing_inputs.values())
+        upstream_request["encoding_format"] = "base64" if native_base64 else "float"
+        response = await fetch_embeddings(request_headers, upstream_request)
+        if response.status_code != 200:
+            return response
+
+        upstream_data = response.body["data"]
+        if len(upstream_data) != len(missing_inputs):
+            LOGGER.error("Embedding count doesn't match the number of inputs")
+            return request_manager.ResponseStatus(500, request_manager.ERROR_UNKNOWN_ERROR)
+
+        new_rows = []
+        created_time = int(time.time())
+        missing_key_list = list(missing_inputs.keys())
+        for position, data in enumerate(upstream_data):
+            key = missing_key_list[data.get("index", position)]
+            vector_bytes = oai_tools.embedding_to_bytes(data["embedding"])
+            if encoding_format == "base64" and isinstance(data["embedding"], str):
+                passthrough_base64[key] = data["embedding"]
+            vectors[key] = vector_bytes
+            memory_put(key, vector_bytes, cache_options["max_memory_entries"])
+            new_rows.append((key, vector_bytes, created_time))
+        if cache_options["disk_path"]:
+            schedule_disk_write(new_rows)
+
+        usage = response.body.get("usage", usage)
+        response_model = response.body.get("model", response_model)
+
+    openai_response_body = {
+        "object": "list",
+        "data": [],
+        "model": response_model,
+        "usage": usage
+    }
+    if encoding_format == "base64":
+        encode_keys = [key for key in dict.fromkeys(cache_keys) if key not in passthrough_base64]
+        encoded_embeddings = dict(zip(encode_keys, oai_tools.encode_embedding_batch_to_base64([vectors[key] for key in encode_keys])))
+        encoded_embeddings.update(passthrough_base64)
+        embedding_list = [encoded_embeddings[key] for key in cache_keys]
+    else:
+        embedding_list = [oai_tools.embedding_from_bytes(vectors[key]) for key in cache_keys]
+
+    for index, embedding_data in enumerate(embedding_list):
+        openai_response_body["data"].append({
+            "object": "embedding",
+            "embedding": embedding_data,
+            "index": index
+        })
+
+    openai_response = request_manager.ResponseStatus(200, openai_response_body)
+    openai_response.success = True
+    return openai_response
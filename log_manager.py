@@ -0,0 +1,166 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import uuid
+
+import config_manager
+
+# Log records are handed to a queue on the event loop and written out by a background thread,
+# so a slow terminal or log pipe never stalls a request.
+DEFAULT_LOGGING_OPTIONS = {
+    "level": "INFO",
+    # "json" for one object per line, "text" for something easier on the eyes.
+    "format": "json",
+    # Request and response bodies only get logged when this is on.
+    "log_payloads": False,
+    # Fraction of each verbose event to keep, by event name. Anything not listed is always kept.
+    "sample_rates": {},
+    "max_payload_chars": 2048
+}
+
+REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+
+LOG_LISTENER = None
+LOGGING_OPTIONS = dict(DEFAULT_LOGGING_OPTIONS)
+
+
+def get_logging_options(config=None):
+    if config is None:
+        config = config_manager.get_config()
+    logging_options = dict(DEFAULT_LOGGING_OPTIONS)
+    logging_options.update(config.get("logging", {}))
+    return logging_options
+
+def get_logger(name):
+    return logging.getLogger(f"warp_pipe.{name}")
+
+class RequestIdFilter(logging.Filter):
+    # Runs on the calling side of the queue, where the request's context is still around.
+    def filter(self, record):
+        record.request_id = REQUEST_ID.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        log_entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if getattr(record, "request_id", None):
+            log_entry["request_id"] = record.request_id
+        log_entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(log_entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}"
+        if getattr(record, "request_id", None):
+            line += f" [{record.request_id}]"
+        line += f": {record.getMessage()}"
+        for field, value in getattr(record, "fields", {}).items():
+            line += f" {field}={value}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+def setup_logging():
+    global LOG_LISTENER
+    global LOGGING_OPTIONS
+    if LOG_LISTENER is not None:
+        return
+    LOGGING_OPTIONS = get_logging_options()
+
+    output_handler = logging.StreamHandler(sys.stdout)
+    if LOGGING_OPTIONS["format"] == "text":
+        output_handler.setFormatter(TextFormatter())
+    else:
+        output_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root_logger = logging.getLogger("warp_pipe")
+    root_logger.setLevel(LOGGING_OPTIONS["level"].upper())
+    root_logger.handlers = [queue_handler]
+    root_logger.propagate = False
+
+    LOG_LISTENER = logging.handlers.QueueListener(log_queue, output_handler)
+    LOG_LISTENER.start()
+    config_manager.add_reload_listener(apply_logging_options)
+
+def apply_logging_options(old_config, new_config):
+    # Reload listener: level, payload logging and sample rates change live. The format needs a restart.
+    global LOGGING_OPTIONS
+    LOGGING_OPTIONS = get_logging_options(new_config)
+    logging.getLogger("warp_pipe").setLevel(LOGGING_OPTIONS["level"].upper())
+
+def stop_logging():
+    # Flushes whatever is still queued before the process goes away.
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER = None
+
+def log_event(logger, level, event, message, **fields):
+    # For the chatty events: skipped cheaply when the level is off, and thinned out by the event's sample rate.
+    if not logger.isEnabledFor(level):
+        return
+    sample_rate = LOGGING_OPTIONS["sample_rates"].get(event, 1.0)
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    logger.log(level, message, extra={"fields": {"event": event, **fields}})
+
+def log_payload(logger, event, message, payload):
+    # Bodies can hold prompts and keys, so they stay out of the logs unless log_payloads is on.
+    if not LOGGING_OPTIONS["log_payloads"]:
+        return
+    if not isinstance(payload, str):
+        payload = json.dumps(payload, default=str)
+    log_event(logger, logging.DEBUG, event, message, payload=payload[:LOGGING_OPTIONS["max_payload_chars"]])
+
+def truncate_body(body):
+    # Error bodies are worth logging, just not in full.
+    if not isinstance(body, str):
+        body = json.dumps(body, default=str)
+    max_chars = 512
+    if LOGGING_OPTIONS["log_payloads"]:
+        max_chars = LOGGING_OPTIONS["max_payload_chars"]
+    if len(body) > max_chars:
+        return body[:max_chars] + "..."
+    return body
+
+class RequestIdMiddleware:
+    # Tags every request with an id (the caller's X-Request-ID if it sent one) that shows up in its
+    # log lines and is echoed back in the response headers.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        for header_name, header_value in scope["headers"]:
+            if header_name == b"x-request-id":
+                request_id = header_value.decode("latin-1")[:128]
+                break
+        if not request_id:
+            request_id = uuid.uuid4().hex
+        REQUEST_ID.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
@@ -0,0 +1,205 @@
+import bisect
+import contextvars
+import json
+import time
+
+# Prometheus-style metrics kept in plain dicts. Everything records from the event loop thread, so there's
+# nothing to lock, and a recording is a dict lookup plus an add (and a bisect for histograms).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+METRIC_INFO = {
+    "warp_pipe_requests_total": ("counter", "Requests handled, by endpoint, provider, model and status code."),
+    "warp_pipe_request_duration_seconds": ("histogram", "Time from request received to the last byte of the response."),
+    "warp_pipe_time_to_first_byte_seconds": ("histogram", "Time from request received to the first byte of the response body."),
+    "warp_pipe_requests_in_flight": ("gauge", "Requests currently being handled."),
+    "warp_pipe_upstream_requests_total": ("counter", "Requests sent to providers, by status code."),
+    "warp_pipe_upstream_duration_seconds": ("histogram", "Time spent on provider requests, through the end of the stream for streamed ones."),
+    "warp_pipe_upstream_in_flight": ("gauge", "Provider requests currently open."),
+    "warp_pipe_tokens_total": ("counter", "Tokens reported in provider usage blocks, by type."),
+    "warp_pipe_upstream_retries_total": ("counter", "Provider requests that were tried again, by what went wrong."),
+    "warp_pipe_queue_depth": ("gauge", "Requests waiting for a slot on a scheduled backend."),
+    "warp_pipe_queue_wait_seconds": ("histogram", "Time requests to scheduled backends spent waiting for a slot."),
+    "warp_pipe_concurrency_limit": ("gauge", "Learned limit on requests in flight, by backend.")
+}
+
+# Model names come straight from clients, so past this many the rest get lumped together.
+MAX_MODEL_LABELS = 200
+MODEL_LABELS = set()
+
+COUNTERS = {}
+GAUGES = {}
+# name -> labels -> [per bucket counts (last one is +Inf), sum, count]
+HISTOGRAMS = {}
+
+# Called with (provider, model, usage) once for every client a response with usage goes to, in that client's
+# request context, for anything that bills tokens to whoever asked.
+USAGE_LISTENERS = []
+
+# (endpoint, provider, model) for the request being handled, so upstream metrics can be labeled too.
+REQUEST_LABELS = contextvars.ContextVar("request_labels", default=("", "", ""))
+
+
+def model_label(model_name):
+    if not isinstance(model_name, str) or model_name == "":
+        return ""
+    if model_name not in MODEL_LABELS:
+        if len(MODEL_LABELS) >= MAX_MODEL_LABELS:
+            return "other"
+        MODEL_LABELS.add(model_name)
+    return model_name
+
+def inc_counter(name, labels, value=1):
+    series = COUNTERS.setdefault(name, {})
+    series[labels] = series.get(labels, 0) + value
+
+def add_gauge(name, labels, value):
+    series = GAUGES.setdefault(name, {})
+    series[labels] = series.get(labels, 0) + value
+
+def observe(name, labels, value):
+    series = HISTOGRAMS.setdefault(name, {})
+    histogram = series.get(labels)
+    if histogram is None:
+        histogram = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        series[labels] = histogram
+    histogram[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+def set_request_labels(request, provider, model_name):
+    # Called by the route handlers once they know who the request is for.
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else request.url.path
+    labels = (endpoint, provider, model_label(model_name))
+    request.scope["metrics_labels"] = labels
+    REQUEST_LABELS.set(labels)
+
+def add_usage_listener(listener):
+    USAGE_LISTENERS.append(listener)
+
+def record_usage(provider, model_name, usage):
+    # Tokens the provider reported, once per upstream response.
+    if not isinstance(usage, dict):
+        return
+    model_name = model_label(model_name)
+    for token_type in ("prompt_tokens", "completion_tokens"):
+        token_count = usage.get(token_type)
+        if token_count:
+            inc_counter("warp_pipe_tokens_total", (provider, model_name, token_type.split("_")[0]), token_count)
+
+def record_client_usage(provider, model_name, usage):
+    # Tokens handed to one client. Coalesced and cached responses come through here once per client that got
+    # them, even though the provider only saw one request.
+    if not isinstance(usage, dict):
+        return
+    for listener in USAGE_LISTENERS:
+        listener(provider, model_name, usage)
+
+async def count_stream_usage(response_chunks, provider, model_name, record=record_usage):
+    # Passes chunks through and records any usage chunk. Only chunks that mention usage get parsed.
+    async for response_chunk in response_chunks:
+        if '"usage"' in response_chunk:
+            try:
+                record(provider, model_name, json.loads(response_chunk).get("usage"))
+            except ValueError:
+                pass
+        yield response_chunk
+
+# -- UPSTREAM --
+
+def start_upstream(provider):
+    add_gauge("warp_pipe_upstream_in_flight", (provider or "",), 1)
+    return (provider or "", time.perf_counter())
+
+def finish_upstream(upstream_timer, status_code):
+    provider, start_time = upstream_timer
+    endpoint, _, model_name = REQUEST_LABELS.get()
+    add_gauge("warp_pipe_upstream_in_flight", (provider,), -1)
+    inc_counter("warp_pipe_upstream_requests_total", (endpoint, provider, model_name, str(status_code)))
+    observe("warp_pipe_upstream_duration_seconds", (endpoint, provider, model_name), time.perf_counter() - start_time)
+
+def record_retry(provider, reason):
+    inc_counter("warp_pipe_upstream_retries_total", (provider or "", reason))
+
+# -- ROUTES --
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, so streamed responses are timed to their last chunk without buffering anything.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            return await self.app(scope, receive, send)
+
+        start_time = time.perf_counter()
+        request_state = {"status_code": 500, "first_byte": None}
+        add_gauge("warp_pipe_requests_in_flight", (), 1)
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                request_state["status_code"] = message["status"]
+            elif message["type"] == "http.response.body" and request_state["first_byte"] is None:
+                request_state["first_byte"] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            end_time = time.perf_counter()
+            add_gauge("warp_pipe_requests_in_flight", (), -1)
+            # The matched route template keeps /v1/models/{model_id} from making a series per model.
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            _, provider, model_name = scope.get("metrics_labels", ("", "", ""))
+            labels = (endpoint, provider, model_name)
+            inc_counter("warp_pipe_requests_total", labels + (str(request_state["status_code"]),))
+            observe("warp_pipe_request_duration_seconds", labels, end_time - start_time)
+            observe("warp_pipe_time_to_first_byte_seconds", labels, (request_state["first_byte"] or end_time) - start_time)
+
+# -- EXPOSITION --
+
+LABEL_NAMES = {
+    "warp_pipe_requests_total": ("endpoint", "provider", "model", "status"),
+    "warp_pipe_request_duration_seconds": ("endpoint", "provider", "model"),
+    "warp_pipe_time_to_first_byte_seconds": ("endpoint", "provider", "model"),
+    "warp_pipe_requests_in_flight": (),
+    "warp_pipe_upstream_requests_total": ("endpoint", "provider", "model", "status"),
+    "warp_pipe_upstream_duration_seconds": ("endpoint", "provider", "model"),
+    "warp_pipe_upstream_in_flight": ("provider",),
+    "warp_pipe_tokens_total": ("provider", "model", "type"),
+    "warp_pipe_upstream_retries_total": ("provider", "reason"),
+    "warp_pipe_queue_depth": ("provider", "backend", "priority"),
+    "warp_pipe_queue_wait_seconds": ("provider", "priority"),
+    "warp_pipe_concurrency_limit": ("provider", "backend")
+}
+
+def format_labels(name, labels, extra_labels=()):
+    label_pairs = list(zip(LABEL_NAMES[name], labels)) + list(extra_labels)
+    if len(label_pairs) == 0:
+        return ""
+    escaped_pairs = []
+    for label_name, label_value in label_pairs:
+        label_value = str(label_value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped_pairs.append(f'{label_name}="{label_value}"')
+    return "{" + ",".join(escaped_pairs) + "}"
+
+def render_metrics():
+    # Prometheus text exposition format.
+    lines = []
+    for name, (metric_type, help_text) in METRIC_INFO.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == "histogram":
+            for labels, (bucket_counts, total, count) in list(HISTOGRAMS.get(name, {}).items()):
+                cumulative_count = 0
+                for bucket, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f"{name}_bucket{format_labels(name, labels, [('le', bucket)])} {cumulative_count}")
+                lines.append(f"{name}_sum{format_labels(name, labels)} {total}")
+                lines.append(f"{name}_count{format_labels(name, labels)} {count}")
+        else:
+            series = COUNTERS if metric_type == "counter" else GAUGES
+            for labels, value in list(series.get(name, {}).items()):
+                lines.append(f"{name}{format_labels(name, labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import time
+
+import config_manager
+import log_manager
+
+LOGGER = log_manager.get_logger("model_catalog")
+
+# Model lists barely ever change, so each provider's list is kept in memory with an id index.
+# Past the ttl it's still served while a background refresh runs (stale-while-revalidate),
+# and only once it's older than ttl + max_stale does a request have to wait on upstream.
+DEFAULT_CATALOG_OPTIONS = {
+    "model_cache_ttl": 300,
+    "model_cache_max_stale": 3600
+}
+
+# Keyed by provider and a hash of the provider auth, since bring-your-own keys can see different models.
+CATALOGS = {}
+REFRESH_TASKS = {}
+
+
+def clear_changed_catalogs(old_config, new_config):
+    # Reload listener: a provider whose options changed (say a new base_url) might list different models.
+    for catalog_key in list(CATALOGS):
+        provider = catalog_key[0]
+        if old_config["provider_options"].get(provider) != new_config["provider_options"].get(provider):
+            CATALOGS.pop(catalog_key, None)
+
+config_manager.add_reload_listener(clear_changed_catalogs)
+
+def get_catalog_options(provider):
+    provider_options = config_manager.get_config()["provider_options"].get(provider, {})
+    catalog_options = dict(DEFAULT_CATALOG_OPTIONS)
+    for option in DEFAULT_CATALOG_OPTIONS:
+        if option in provider_options:
+            catalog_options[option] = provider_options[option]
+    return catalog_options
+
+def make_catalog_key(provider, request_headers):
+    provider_auth = ""
+    if request_headers != None:
+        provider_auth = request_headers.get("provider_auth", "")
+    if provider_auth:
+        provider_auth = hashlib.sha256(provider_auth.encode("utf-8")).hexdigest()
+    return (provider, provider_auth)
+
+def build_index(models_body):
+    # Most providers wrap the list in "data", Together just sends the list.
+    models = models_body
+    if isinstance(models_body, dict):
+        models = models_body.get("data", [])
+    return {model["id"]: model for model in models}
+
+async def refresh_catalog(catalog_key, fetch_models, request_headers, request_body):
+    try:
+        response = await fetch_models(request_headers, request_body)
+        if response.success:
+            CATALOGS[catalog_key] = {
+                "response": response,
+                "index": build_index(response.body),
+                "fetched_at": time.monotonic()
+            }
+        return response
+    finally:
+        REFRESH_TASKS.pop(catalog_key, None)
+
+def report_refresh_failure(refresh_task):
+    # Background refreshes have nobody awaiting them, so failures would otherwise go unnoticed.
+    if not refresh_task.cancelled() and refresh_task.exception() is not None:
+        LOGGER.warning("Model list refresh failed: %s", refresh_task.exception())
+
+def start_refresh(catalog_key, fetch_models, request_headers, request_body):
+    # Concurrent callers share one refresh instead of each hitting upstream.
+    refresh_task = REFRESH_TASKS.get(catalog_key)
+    if refresh_task is None:
+        refresh_task = asyncio.ensure_future(refresh_catalog(catalog_key, fetch_models, request_headers, request_body))
+        refresh_task.add_done_callback(report_refresh_failure)
+        REFRESH_TASKS[catalog_key] = refresh_task
+    return refresh_task
+
+async def get_catalog(provider, fetch_models, request_headers, request_body):
+    # Returns (catalog, None) when there's something to serve, or (None, failed response) when there isn't.
+    catalog_key = make_catalog_key(provider, request_headers)
+    catalog_options = get_catalog_options(provider)
+    catalog = CATALOGS.get(catalog_key)
+    if catalog is not None:
+        catalog_age = time.monotonic() - catalog["fetched_at"]
+        if catalog_age < catalog_options["model_cache_ttl"]:
+            return catalog, None
+        if catalog_age < catalog_options["model_cache_ttl"] + catalog_options["model_cache_max_stale"]:
+            start_refresh(catalog_key, fetch_models, request_headers, request_body)
+            return catalog, None
+
+    # Shielded so a client hanging up doesn't cancel the refresh everyone else is waiting on.
+    response = await asyncio.shield(start_refresh(catalog_key, fetch_models, request_headers, request_body))
+    catalog = CATALOGS.get(catalog_key)
+    if not response.success or catalog is None:
+        return None, response
+    return catalog, None
+
+async def list_models(provider, fetch_models, request_headers, request_body):
+    catalog, failed_response = await get_catalog(provider, fetch_models, request_headers, request_body)
+    if catalog is None:
+        return failed_response
+    return catalog["response"]
+
+async def find_model(provider, fetch_models, request_headers, request_body, model_id):
+    # Returns (model, None) if it exists, (None, None) if it doesn't, and (None, failed response) if the list couldn't be fetched.
+    catalog, failed_response = await get_catalog(provider, fetch_models, request_headers, request_body)
+    if catalog is None:
+        return None, failed_response
+    return catalog["index"].get(model_id), None
@@ -1,35 +1,296 @@
 from datetime import datetime, timezone
+from collections import OrderedDict
+import array
+import asyncio
+import sys
 import time
-import struct
 import base64
+import json
+import urllib.parse
 import httpx
 
+import config_manager
+import log_manager
+import request_manager
+
+LOGGER = log_manager.get_logger("oai_tools")
+
+DEFAULT_IMAGE_FETCH_OPTIONS = {
+    "timeout": 10,
+    "max_bytes": 20 * 1024 * 1024,
+    "cache_max_bytes": 64 * 1024 * 1024,
+    "cache_ttl": 300
+}
+
+# Images get re-sent on every turn of a conversation, so keep the recent ones around (LRU, by size).
+# Past cache_ttl they're revalidated against their ETag instead of downloaded again.
+IMAGE_CACHE = OrderedDict()
+IMAGE_CACHE_BYTES = 0
+IMAGE_DOWNLOADS = {}
+
 def convert_datetime_to_epoch(datetime_str):
     """Convert a datetime string to epoch time."""
     datetime_obj = datetime.fromisoformat(datetime_str)
     epoch_time = datetime_obj.replace(tzinfo=timezone.utc).timestamp()
     return int(epoch_time)
 
+# Embeddings travel through warp pipe as little-endian float32 bytes, the same layout OpenAI's
+# base64 encoding_format uses, so floats only get materialized if the client asked for them.
+def embedding_to_bytes(embedding):
+    if isinstance(embedding, (bytes, bytearray)):
+        return bytes(embedding)
+    if isinstance(embedding, str):
+        # Already base64 from upstream, no floats involved.
+        return base64.b64decode(embedding)
+    vector = array.array('f', embedding)
+    if sys.byteorder == "big":
+        vector.byteswap()
+    return vector.tobytes()
+
+def embedding_from_bytes(vector_bytes):
+    vector = array.array('f')
+    vector.frombytes(vector_bytes)
+    if sys.byteorder == "big":
+        vector.byteswap()
+    return vector.tolist()
+
+def encode_embedding_batch_to_base64(vectors):
+    # Every 3 bytes become 4 characters, so when every vector is a multiple of 3 bytes long
+    # (768, 1536, 3072 dims...) the whole batch is encoded in one pass and cut back up.
+    if len(vectors) == 0:
+        return []
+    vector_size = len(vectors[0])
+    if vector_size % 3 == 0 and all(len(vector) == vector_size for vector in vectors):
+        encoded_batch = base64.b64encode(b"".join(vectors)).decode('utf-8')
+        encoded_size = vector_size // 3 * 4
+        return [encoded_batch[i:i+encoded_size] for i in range(0, len(encoded_batch), encoded_size)]
+    return [base64.b64encode(vector).decode('utf-8') for vector in vectors]
+
 def encode_embeddings_to_base64(embeddings):
-    # Step 1: Convert the list of floats into binary data.
-    # Using 'f' as format specifier for single precision float.
-    # Use 'd' instead of 'f' for double precision.
-    binary_data = struct.pack(f'{len(embeddings)}f', *embeddings)
-    
-    # Step 2: Encode this binary data into a base64 byte string.
-    base64_bytes = base64.b64encode(binary_data)
-    
-    # Convert the byte string to a regular string for easier use
-    base64_string = base64_bytes.decode('utf-8')
-    
-    return base64_string
+    return base64.b64encode(embedding_to_bytes(embeddings)).decode('utf-8')
+
+def encode_embedding_data_to_base64(embedding_data):
+    # Swaps the float lists in an OpenAI "data" list for base64 strings, encoding the batch together.
+    embedding_items = [data for data in embedding_data if data.get('object', "embedding") == "embedding"]
+    encoded_embeddings = encode_embedding_batch_to_base64([embedding_to_bytes(data['embedding']) for data in embedding_items])
+    for data, encoded_embedding in zip(embedding_items, encoded_embeddings):
+        data['embedding'] = encoded_embedding
+    return embedding_data
+
+def get_image_fetch_options():
+    image_fetch_options = dict(DEFAULT_IMAGE_FETCH_OPTIONS)
+    image_fetch_options.update(config_manager.get_config().get("image_fetch", {}))
+    return image_fetch_options
+
+def decode_data_url(image_url):
+    # data: URLs already carry the image, so there's nothing to download.
+    header, _, payload = image_url.partition(",")
+    if header.endswith(";base64"):
+        return payload
+    return base64.b64encode(urllib.parse.unquote_to_bytes(payload)).decode('utf-8')
+
+def cache_image(image_url, etag, image_b64, cache_max_bytes):
+    global IMAGE_CACHE_BYTES
+    previous = IMAGE_CACHE.pop(image_url, None)
+    if previous is not None:
+        IMAGE_CACHE_BYTES -= len(previous["image_b64"])
+    if len(image_b64) > cache_max_bytes:
+        return
+    IMAGE_CACHE[image_url] = {
+        "etag": etag,
+        "image_b64": image_b64,
+        "fetched_at": time.monotonic()
+    }
+    IMAGE_CACHE_BYTES += len(image_b64)
+    while IMAGE_CACHE_BYTES > cache_max_bytes:
+        evicted_url, evicted = IMAGE_CACHE.popitem(last=False)
+        IMAGE_CACHE_BYTES -= len(evicted["image_b64"])
+
+async def fetch_image(image_url, cached_image, image_fetch_options):
+    headers = {}
+    if cached_image is not None and cached_image["etag"]:
+        headers["If-None-Match"] = cached_image["etag"]
+
+    client = request_manager.get_client()
+    max_bytes = image_fetch_options["max_bytes"]
+    async with client.stream("GET", image_url, headers=headers, follow_redirects=True) as response:
+        if response.status_code == 304 and cached_image is not None:
+            cached_image["fetched_at"] = time.monotonic()
+            IMAGE_CACHE.move_to_end(image_url)
+            return cached_image["image_b64"]
+        if response.status_code != 200:
+            LOGGER.warning("Image download from %s failed: %s", image_url, response.status_code)
+            return None
+        if int(response.headers.get("Content-Length", 0)) > max_bytes:
+            LOGGER.warning("Image at %s is over the %s byte limit.", image_url, max_bytes)
+            return None
+        image_bytes = bytearray()
+        async for image_part in response.aiter_bytes():
+            image_bytes += image_part
+            if len(image_bytes) > max_bytes:
+                LOGGER.warning("Image at %s is over the %s byte limit.", image_url, max_bytes)
+                return None
+        etag = response.headers.get("ETag")
+
+    image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+    cache_image(image_url, etag, image_b64, image_fetch_options["cache_max_bytes"])
+    return image_b64
+
+async def fetch_image_with_timeout(image_url, cached_image, image_fetch_options):
+    try:
+        return await asyncio.wait_for(fetch_image(image_url, cached_image, image_fetch_options), image_fetch_options["timeout"])
+    except asyncio.TimeoutError:
+        LOGGER.warning("Image download from %s timed out.", image_url)
+    except httpx.HTTPError as e:
+        LOGGER.warning("Image download from %s failed: %s", image_url, e)
+    return None
 
 async def download_image_from_url_and_encode_b64(image_url):
-    # Add an indented block of code here
-    async with httpx.AsyncClient() as client:
-        response = await client.get(image_url)
-        image_bytes = response.content
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        return base64_image
-    return ""
-    
\ No newline at end of file
+    # Returns the image as base64, or None if it couldn't be fetched within the configured limits.
+    if image_url.startswith("data:"):
+        return decode_data_url(image_url)
+
+    image_fetch_options = get_image_fetch_options()
+    cached_image = IMAGE_CACHE.get(image_url)
+    if cached_image is not None:
+        IMAGE_CACHE.move_to_end(image_url)
+        if time.monotonic() - cached_image["fetched_at"] < image_fetch_options["cache_ttl"]:
+            return cached_image["image_b64"]
+
+    # The same image showing up twice at once only gets downloaded once.
+    image_download = IMAGE_DOWNLOADS.get(image_url)
+    if image_download is None:
+        image_download = asyncio.ensure_future(fetch_image_with_timeout(image_url, cached_image, image_fetch_options))
+        IMAGE_DOWNLOADS[image_url] = image_download
+        image_download.add_done_callback(lambda finished_download: IMAGE_DOWNLOADS.pop(image_url, None))
+    return await asyncio.shield(image_download)
+
+def split_string_by_length(text, end):
+    return [text[i:i+end] for i in range(0,len(text),end)]
+
+# OpenAI has a very specific chunk setup it needs and various apis evaluate it differently
+# so it has to match EXACTLY... let's do that globally.
+# This is only the fallback for responses that came back whole (tool emulation, n > 1).
+def generate_response_chunks(response_data):
+    response_chunks = []
+    chat_id = response_data['id']
+    created_time = int(time.time())
+    selected_model = response_data['model']
+    system_fingerprint = "warp-pipe-001"
+
+    for choice in response_data['choices']:
+        choice_index = choice.get('index', 0)
+        # Adapters hand back either the finished message or one they already turned into a delta.
+        response_message = dict(choice.get('message', choice.get('delta', {})))
+        response_content = response_message.get('content')
+
+        # First chunk has no content
+        first_response_message = response_message
+        first_response_message['content'] = ""
+
+        i_chunk = {
+            'id':chat_id,
+            'object':'chat.completion.chunk',
+            'created':created_time,
+            'model':selected_model,
+            'system_fingerprint':system_fingerprint,
+            'choices':[{
+                "index":choice_index,
+                "delta":first_response_message,
+                "logprobs":None,
+                "finish_reason":None
+        }]}
+
+        response_chunks.append(json.dumps(i_chunk))
+
+        if isinstance(response_content, str) and len(response_content) > 0:
+            c_content = split_string_by_length(response_content,4096)
+            for cc in c_content:
+                c_chunk = {
+                    'id':chat_id,
+                    'object':'chat.completion.chunk',
+                    'created':created_time,
+                    'model':selected_model,
+                    'system_fingerprint':system_fingerprint,
+                    'choices':[{
+                        "index":choice_index,
+                        "delta":{"content":cc},
+                        "logprobs":None,
+                        "finish_reason":None
+                        }
+                    ]
+                }
+                response_chunks.append(json.dumps(c_chunk))
+
+        # Yup - it does this.
+        finish_reason = choice.get('finish_reason') or "stop"
+        final_chunk = {"id":chat_id,"object":"chat.completion.chunk","created":created_time,"model":selected_model,"system_fingerprint":system_fingerprint,"choices":[{"index":choice_index,"delta":{},"logprobs":None,"finish_reason":finish_reason}]}
+        response_chunks.append(json.dumps(final_chunk))
+
+    # It also does this.
+    response_chunks.append("[DONE]")
+    return response_chunks
+
+def build_stream_chunk(chat_id, created_time, model_name, delta, finish_reason=None):
+    return json.dumps({
+        "id": chat_id,
+        "object": "chat.completion.chunk",
+        "created": created_time,
+        "model": model_name,
+        "system_fingerprint": "fp_44709d6fcb",
+        "choices": [{
+            "index": 0,
+            "delta": delta,
+            "logprobs": None,
+            "finish_reason": finish_reason
+        }]
+    })
+
+def build_usage_chunk(chat_id, created_time, model_name, prompt_tokens, completion_tokens):
+    # Same shape OpenAI sends for stream_options.include_usage - no choices, just the totals.
+    return json.dumps({
+        "id": chat_id,
+        "object": "chat.completion.chunk",
+        "created": created_time,
+        "model": model_name,
+        "system_fingerprint": "fp_44709d6fcb",
+        "choices": [],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    })
+
+async def relay_openai_stream(upstream, rewrite_chunk=None, rewrite_marker=None):
+    # Relays an OpenAI style SSE stream chunk by chunk. Chunks are only decoded if they need rewriting,
+    # and if a marker is given, only the chunks that contain it.
+    sse_data = request_manager.iter_sse_data(upstream)
+    try:
+        async for data in sse_data:
+            if data == "[DONE]":
+                break
+            if rewrite_chunk is not None and (rewrite_marker is None or rewrite_marker in data):
+                data = json.dumps(rewrite_chunk(json.loads(data)))
+            yield data
+    finally:
+        await sse_data.aclose()
+    yield "[DONE]"
+
+def build_tool_prompt(tools):
+    # Tool emulation for providers without function calling: the tools get described in a system prompt
+    # and the model is asked to answer with a JSON call.
+    system_prompt = "You have the following functions available to you:\n"
+    for tool in tools:
+        function_info = tool.get("function", {})
+        function_name = function_info.get("name")
+        parameters = function_info.get("parameters", {})
+
+        system_prompt += f"- Function Name: {function_name}, Parameters: {json.dumps(parameters)}\n"
+    
+    system_prompt += "Please execute any function you deem appropriate based on the context provided.\n"
+    system_prompt += """ Respond only in a valid JSON block containing the following keys: \n
+    "name": "function_name", \n
+    "arguments": { "parameter1": "value1", "parameter2": "value2" } \n
+    """
+    return system_prompt
@@ -0,0 +1,218 @@
+import contextvars
+import hashlib
+import json
+import logging
+import math
+import time
+
+from starlette.routing import Match
+
+import config_manager
+import log_manager
+import metrics
+
+LOGGER = log_manager.get_logger("rate_limiter")
+
+# Limits per API key, from the rate_limits block:
+#   "rate_limits": {"default": {"max_concurrency": 8}, "keys": {"team-a-key": {"requests_per_second": 5, "tokens_per_minute": 200000}}}
+# Keys without an entry of their own get "default", and anything left at 0 is unlimited. Requests without
+# a known key (only possible with auth enforcement off) all share the one "anonymous" allowance.
+DEFAULT_RATE_LIMITS = {
+    "requests_per_second": 0,
+    # Requests that can arrive back to back before requests_per_second kicks in, one second's worth when 0.
+    "burst": 0,
+    # Prompt plus completion tokens from the provider's usage block. Usage is only known once a response is
+    # done, so a key is let in while it has any allowance left and the response can put it into debt.
+    "tokens_per_minute": 0,
+    "max_concurrency": 0
+}
+ANONYMOUS_KEY = "anonymous"
+# Only the OpenAI-style routes are limited, the admin and metrics routes stay reachable.
+LIMITED_PATH_PREFIX = "/v1/"
+
+# api key -> limits, rebuilt whenever the config changes
+KEY_LIMITS = {}
+DEFAULT_KEY_LIMITS = dict(DEFAULT_RATE_LIMITS)
+# api key -> buckets and in flight count
+KEY_STATE = {}
+RATE_LIMIT_STATS = {
+    "admitted": 0,
+    "rejected_requests": 0,
+    "rejected_tokens": 0,
+    "rejected_concurrency": 0
+}
+# The key the current request is charged to.
+CURRENT_KEY = contextvars.ContextVar("rate_limit_key", default=None)
+
+
+def load_rate_limits(old_config, new_config):
+    # Reload listener, so picking a key's limits is a single dict lookup per request.
+    global KEY_LIMITS
+    global DEFAULT_KEY_LIMITS
+    rate_limits = new_config.get("rate_limits", {})
+    default_limits = dict(DEFAULT_RATE_LIMITS)
+    default_limits.update(rate_limits.get("default", {}))
+    key_limits = {}
+    for api_key, limits in rate_limits.get("keys", {}).items():
+        key_limits[api_key] = dict(default_limits)
+        key_limits[api_key].update(limits)
+    DEFAULT_KEY_LIMITS = default_limits
+    KEY_LIMITS = key_limits
+
+load_rate_limits(None, config_manager.APP_CONFIG)
+config_manager.add_reload_listener(load_rate_limits)
+
+def get_api_key(scope):
+    # Unknown keys are lumped together, so making up a new key per request doesn't get a fresh allowance.
+    for header_name, header_value in scope["headers"]:
+        if header_name == b"authorization":
+            token_type, _, api_key = header_value.decode("latin-1").partition(" ")
+            if token_type.lower() == "bearer" and (api_key in config_manager.get_config()["api_keys"] or api_key in KEY_LIMITS):
+                return api_key
+            break
+    return ANONYMOUS_KEY
+
+def get_key_id(api_key, key_names):
+    # How a key shows up anywhere it can be read back: its name from key_names if it has one, otherwise a
+    # hash, since the key itself is a secret.
+    if api_key is None or api_key == ANONYMOUS_KEY:
+        return ANONYMOUS_KEY
+    key_name = key_names.get(api_key)
+    if key_name is not None:
+        return key_name
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+def get_key_state(api_key):
+    key_state = KEY_STATE.get(api_key)
+    if key_state is None:
+        # Buckets start full, the first refill caps them at whatever the limit is.
+        key_state = {
+            "request_bucket": {"level": math.inf, "updated": time.monotonic()},
+            "token_bucket": {"level": math.inf, "updated": time.monotonic()},
+            "in_flight": 0
+        }
+        KEY_STATE[api_key] = key_state
+    return key_state
+
+def refill(bucket, rate, capacity, now):
+    bucket["level"] = min(capacity, bucket["level"] + (now - bucket["updated"]) * rate)
+    bucket["updated"] = now
+
+def try_admit(api_key, now):
+    # Returns None if the request can go ahead, otherwise (seconds until it could, message, which limit).
+    limits = KEY_LIMITS.get(api_key, DEFAULT_KEY_LIMITS)
+    key_state = get_key_state(api_key)
+
+    max_concurrency = limits["max_concurrency"]
+    if max_concurrency and key_state["in_flight"] >= max_concurrency:
+        return 1, f"Too many requests in flight for this key, the limit is {max_concurrency}.", "concurrency"
+
+    requests_per_second = limits["requests_per_second"]
+    request_bucket = key_state["request_bucket"]
+    if requests_per_second:
+        refill(request_bucket, requests_per_second, limits["burst"] or max(1, requests_per_second), now)
+        if request_bucket["level"] < 1:
+            return (1 - request_bucket["level"]) / requests_per_second, f"Rate limit reached, the limit is {requests_per_second} requests per second.", "requests"
+
+    tokens_per_minute = limits["tokens_per_minute"]
+    if tokens_per_minute:
+        token_bucket = key_state["token_bucket"]
+        refill(token_bucket, tokens_per_minute / 60, tokens_per_minute, now)
+        if token_bucket["level"] <= 0:
+            return (1 - token_bucket["level"]) / (tokens_per_minute / 60), f"Rate limit reached, the limit is {tokens_per_minute} tokens per minute.", "tokens"
+
+    if requests_per_second:
+        request_bucket["level"] -= 1
+    key_state["in_flight"] += 1
+    return None
+
+def release(api_key):
+    KEY_STATE[api_key]["in_flight"] -= 1
+
+def charge_usage(provider, model_name, usage):
+    # Usage listener, charges the tokens of a finished response to the key that asked for it.
+    api_key = CURRENT_KEY.get()
+    if api_key is None:
+        return
+    tokens_per_minute = KEY_LIMITS.get(api_key, DEFAULT_KEY_LIMITS)["tokens_per_minute"]
+    if not tokens_per_minute:
+        return
+    token_bucket = get_key_state(api_key)["token_bucket"]
+    refill(token_bucket, tokens_per_minute / 60, tokens_per_minute, time.monotonic())
+    token_bucket["level"] -= (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+
+metrics.add_usage_listener(charge_usage)
+
+def rate_limit_error(message):
+    return {
+        "error": {
+            "message": message,
+            "type": "rate_limit_error",
+            "param": None,
+            "code": "rate_limit_exceeded"
+        }
+    }
+
+class RateLimitMiddleware:
+    # Plain ASGI middleware so a key's concurrency slot is held until the last chunk of a stream is sent.
+    def __init__(self, app):
+        self.app = app
+
+    def match_route(self, scope):
+        # Turned away requests never reach the router, so the route is looked up here for the metrics labels.
+        app = scope.get("app")
+        for route in getattr(getattr(app, "router", None), "routes", []):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                scope["route"] = route
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(LIMITED_PATH_PREFIX):
+            return await self.app(scope, receive, send)
+
+        api_key = get_api_key(scope)
+        rejection = try_admit(api_key, time.monotonic())
+        if rejection is not None:
+            retry_after, message, limit_name = rejection
+            RATE_LIMIT_STATS[f"rejected_{limit_name}"] += 1
+            self.match_route(scope)
+            log_manager.log_event(LOGGER, logging.INFO, "rate_limited", "Turned request away", path=scope["path"], limit=limit_name)
+            response_body = json.dumps({"detail": rate_limit_error(message)}).encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(response_body)).encode("latin-1")),
+                    (b"retry-after", str(max(1, math.ceil(retry_after))).encode("latin-1"))
+                ]
+            })
+            await send({"type": "http.response.body", "body": response_body})
+            return
+
+        RATE_LIMIT_STATS["admitted"] += 1
+        CURRENT_KEY.set(api_key)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            release(api_key)
+
+def get_rate_limit_stats():
+    # Keys are shown by the same id the usage ledger files them under.
+    now = time.monotonic()
+    key_names = config_manager.get_config().get("usage_ledger", {}).get("key_names", {})
+    key_stats = {}
+    for api_key, key_state in KEY_STATE.items():
+        limits = KEY_LIMITS.get(api_key, DEFAULT_KEY_LIMITS)
+        key_name = get_key_id(api_key, key_names)
+        key_stats[key_name] = {
+            "in_flight": key_state["in_flight"],
+            "limits": limits
+        }
+        if limits["tokens_per_minute"]:
+            refill(key_state["token_bucket"], limits["tokens_per_minute"] / 60, limits["tokens_per_minute"], now)
+            key_stats[key_name]["tokens_available"] = int(key_state["token_bucket"]["level"])
+    rate_limit_stats = dict(RATE_LIMIT_STATS)
+    rate_limit_stats["keys"] = key_stats
+    return rate_limit_stats
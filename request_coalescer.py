@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import json
+
+import config_manager
+import request_manager
+import response_cache
+
+# Identical requests that arrive while one is already in flight wait on that one instead of going upstream again.
+# Streamed responses are broadcast: every waiter gets every chunk, and late joiners replay what they missed.
+DEFAULT_COALESCING_OPTIONS = {
+    "enabled": True,
+    # Sampled completions are supposed to differ, so by default only deterministic ones are shared.
+    "include_sampled": False
+}
+
+COALESCING_STATS = {
+    "upstream_requests": 0,
+    "coalesced_requests": 0
+}
+
+IN_FLIGHT = {}
+
+
+def get_coalescing_options():
+    coalescing_options = dict(DEFAULT_COALESCING_OPTIONS)
+    coalescing_options.update(config_manager.get_config().get("request_coalescing", {}))
+    return coalescing_options
+
+def make_coalescing_key(endpoint, header_info, request_body):
+    # Returns None for requests that should always get their own upstream call.
+    coalescing_options = get_coalescing_options()
+    if not coalescing_options["enabled"]:
+        return None
+    if endpoint == "/v1/chat/completions" and not coalescing_options["include_sampled"] and not response_cache.is_deterministic(request_body):
+        return None
+
+    # Different provider keys can see different models and limits, so they never share a call.
+    provider_auth = header_info.get("provider_auth", "")
+    key_fields = {
+        "endpoint": endpoint,
+        "provider": header_info["llm_provider"],
+        "provider_auth": hashlib.sha256(provider_auth.encode("utf-8")).hexdigest(),
+        "max_context_header": header_info.get("max_context"),
+        "request": request_body
+    }
+    canonical_request = json.dumps(key_fields, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+
+class StreamBroadcast:
+    def __init__(self, key, response_chunks):
+        self.key = key
+        self.response_chunks = response_chunks
+        # Everything seen so far is kept so anyone joining mid-stream starts from the first chunk.
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.pump_task = asyncio.ensure_future(self.pump())
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def pump(self):
+        try:
+            async for response_chunk in self.response_chunks:
+                self.chunks.append(response_chunk)
+                self.notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            if IN_FLIGHT.get(self.key) is self:
+                IN_FLIGHT.pop(self.key)
+            self.notify()
+
+    def subscribe(self):
+        # Counted up front so a waiter that hasn't started reading yet still keeps the stream alive.
+        self.subscribers += 1
+        return self.iterate_chunks()
+
+    async def iterate_chunks(self):
+        position = 0
+        try:
+            while True:
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+            # Nobody left listening, so there's no point keeping the upstream stream open.
+            if self.subscribers == 0 and not self.done:
+                self.pump_task.cancel()
+
+async def lead_request(key, send):
+    try:
+        response = await send()
+    except BaseException:
+        IN_FLIGHT.pop(key, None)
+        raise
+    if response.success and response.stream:
+        # The key stays claimed by the broadcast until the stream finishes.
+        broadcast = StreamBroadcast(key, response.body)
+        IN_FLIGHT[key] = broadcast
+        response.body = broadcast
+    else:
+        IN_FLIGHT.pop(key, None)
+    return response
+
+async def run_coalesced(key, send):
+    # send() is only called by the first request for a key, everyone else gets a copy of its response.
+    if key is None:
+        return await send()
+
+    flight = IN_FLIGHT.get(key)
+    if flight is None:
+        COALESCING_STATS["upstream_requests"] += 1
+        flight = asyncio.ensure_future(lead_request(key, send))
+        IN_FLIGHT[key] = flight
+    else:
+        COALESCING_STATS["coalesced_requests"] += 1
+
+    if isinstance(flight, StreamBroadcast):
+        broadcast = flight
+        response = request_manager.ResponseStatus(200, None)
+        response.success = True
+        response.stream = True
+    else:
+        # Shielded so one client hanging up doesn't cancel the call everyone else is waiting on.
+        shared_response = await asyncio.shield(flight)
+        response = request_manager.ResponseStatus(shared_response.status_code, shared_response.body)
+        response.success = shared_response.success
+        response.stream = shared_response.stream
+        broadcast = shared_response.body if shared_response.stream else None
+
+    if broadcast is not None:
+        response.body = broadcast.subscribe()
+    return response
+
+def get_coalescing_stats():
+    return {
+        **COALESCING_STATS,
+        "in_flight": len(IN_FLIGHT)
+    }
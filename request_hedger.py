@@ -0,0 +1,128 @@
+import asyncio
+import copy
+import logging
+import time
+from collections import deque
+
+import config_manager
+import log_manager
+import backend_pool
+
+LOGGER = log_manager.get_logger("request_hedger")
+
+# A non-streaming request that's taking longer than most requests to the same place gets a duplicate sent
+# alongside it, and whichever answers first wins while the other is cancelled. Providers with several
+# backends send the duplicate wherever least-outstanding routing puts it, which won't be the busy one.
+# Off by default, since every hedge is an extra request the provider has to serve (and may bill for).
+DEFAULT_HEDGING_OPTIONS = {
+    "enabled": False,
+    # Hedge once a request has run longer than this share of recent requests did.
+    "percentile": 0.95,
+    # Most hedges as a share of requests, so a slow provider doesn't get twice the traffic.
+    "budget": 0.05,
+    # Never hedge sooner than this many seconds in.
+    "min_delay": 0.05,
+    # Recent latencies needed before a delay is worth trusting.
+    "min_samples": 20
+}
+# Latencies kept per provider and endpoint.
+LATENCY_WINDOW = 500
+# Unused budget adds up to this many hedges, enough to ride out a short burst of slow responses.
+MAX_HEDGE_TOKENS = 10
+
+# (provider, endpoint) -> recent latencies in seconds
+LATENCIES = {}
+# provider -> hedges that can be spent right now
+HEDGE_TOKENS = {}
+HEDGING_STATS = {
+    "requests": 0,
+    "hedged_requests": 0,
+    "hedge_wins": 0,
+    "over_budget": 0
+}
+
+
+def get_hedging_options():
+    hedging_options = dict(DEFAULT_HEDGING_OPTIONS)
+    hedging_options.update(config_manager.get_config().get("request_hedging", {}))
+    return hedging_options
+
+def get_hedge_delay(latency_key, hedging_options):
+    # Returns None until there's enough history to say what "slow" is.
+    latencies = LATENCIES.get(latency_key)
+    if latencies is None or len(latencies) < hedging_options["min_samples"]:
+        return None
+    sorted_latencies = sorted(latencies)
+    percentile_index = min(len(sorted_latencies) - 1, int(hedging_options["percentile"] * len(sorted_latencies)))
+    return max(hedging_options["min_delay"], sorted_latencies[percentile_index])
+
+def take_hedge_token(provider):
+    hedge_tokens = HEDGE_TOKENS.get(provider, 0)
+    if hedge_tokens < 1:
+        return False
+    HEDGE_TOKENS[provider] = hedge_tokens - 1
+    return True
+
+def record_latency(latency_key, latency):
+    latencies = LATENCIES.get(latency_key)
+    if latencies is None:
+        latencies = deque(maxlen=LATENCY_WINDOW)
+        LATENCIES[latency_key] = latencies
+    latencies.append(latency)
+
+async def run_hedged(provider, endpoint, send, request_body):
+    # send(request_body) makes the request and returns a ResponseStatus. Streams aren't hedged, by the time
+    # a stream is slow the client has already seen part of it.
+    hedging_options = get_hedging_options()
+    if not hedging_options["enabled"] or request_body.get("stream", False):
+        return await send(request_body)
+
+    HEDGING_STATS["requests"] += 1
+    HEDGE_TOKENS[provider] = min(MAX_HEDGE_TOKENS, HEDGE_TOKENS.get(provider, 0) + hedging_options["budget"])
+    latency_key = (provider, endpoint)
+    hedge_delay = get_hedge_delay(latency_key, hedging_options)
+    # The adapters rewrite bodies in place, so the duplicate gets its own copy before the first one starts.
+    hedge_body = copy.deepcopy(request_body)
+
+    start_time = time.perf_counter()
+    # Tasks copy the context they're created in, which is how the hedge learns where the first request went.
+    primary_backends = set()
+    routed_token = backend_pool.ROUTED_BACKENDS.set(primary_backends)
+    primary_task = asyncio.ensure_future(send(request_body))
+    backend_pool.ROUTED_BACKENDS.reset(routed_token)
+    tasks = [primary_task]
+    try:
+        if hedge_delay is not None:
+            done, pending = await asyncio.wait(tasks, timeout=hedge_delay)
+            if len(pending) > 0:
+                if take_hedge_token(provider):
+                    HEDGING_STATS["hedged_requests"] += 1
+                    log_manager.log_event(LOGGER, logging.DEBUG, "hedged_request", "Sending a hedge for a slow request", provider=provider, endpoint=endpoint, delay=round(hedge_delay, 3))
+                    avoided_token = backend_pool.AVOIDED_BACKENDS.set(primary_backends)
+                    tasks.append(asyncio.ensure_future(send(hedge_body)))
+                    backend_pool.AVOIDED_BACKENDS.reset(avoided_token)
+                else:
+                    HEDGING_STATS["over_budget"] += 1
+
+        # First successful answer wins. If they both fail, the first request's answer goes back.
+        pending = set(tasks)
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().success:
+                    if task is not primary_task:
+                        HEDGING_STATS["hedge_wins"] += 1
+                    # Measured from the first request's start, since that's what the next one gets compared to.
+                    record_latency(latency_key, time.perf_counter() - start_time)
+                    return task.result()
+        return primary_task.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+def get_hedging_stats():
+    hedging_stats = dict(HEDGING_STATS)
+    hedging_options = get_hedging_options()
+    hedging_stats["hedge_delays"] = {f"{provider} {endpoint}": get_hedge_delay((provider, endpoint), hedging_options) for provider, endpoint in LATENCIES}
+    return hedging_stats
@@ -1,5 +1,62 @@
+import logging
+import asyncio
 import httpx
 import json
+import random
+import email.utils
+from datetime import datetime, timezone
+
+import config_manager
+import log_manager
+import metrics
+import backend_pool
+import request_scheduler
+
+LOGGER = log_manager.get_logger("request_manager")
+
+try:
+    import h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# One long-lived client per provider so connections (and TLS sessions) get reused between requests.
+# Requests that verify against their own CA bundle get a client per (provider, cert) instead.
+CLIENT_POOL = {}
+# When a config reload changes a provider's pool options its client is swapped out, and the old one
+# is only closed once the requests still using it are done.
+CLIENT_USERS = {}
+RETIRED_CLIENTS = set()
+DEFAULT_POOL_OPTIONS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30,
+    "http2": False,
+    # Seconds to get connected, and seconds to wait on the provider between bytes. Generous, since a
+    # long completion can take a while before its first byte, but a hung provider is let go eventually.
+    "connect_timeout": 10,
+    "read_timeout": 600
+}
+# Failed provider requests are tried again, overridable per provider in provider_options.
+DEFAULT_RETRY_OPTIONS = {
+    "max_retries": 2,
+    # The wait before retry n is random between 0 and retry_base_delay * 2^n seconds, capped at retry_max_delay.
+    "retry_base_delay": 0.5,
+    "retry_max_delay": 8,
+    "retry_status_codes": [429, 500, 502, 503, 504],
+    # A Retry-After longer than this isn't worth holding the client for, so the error goes back instead.
+    "max_retry_after": 30,
+    # A POST that got a 500, 502 or 504 may still have run, and paid providers bill for it again when it's resent.
+    # So by default POSTs are only retried when the provider can't have acted on them. Turn this on for providers
+    # where a resent request costs nothing, like a local Ollama.
+    "retry_post": False
+}
+# Statuses that mean the provider didn't act on the request.
+NOT_PROCESSED_STATUS_CODES = {429, 503}
+# Errors that mean the request never reached the provider.
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# How many of the n completions in a request can be in flight at once, overridable per provider.
+DEFAULT_MAX_PARALLEL_COMPLETIONS = 4
 
 ERROR_AUTH_RESPONSE = {
     "error": {
@@ -72,34 +129,399 @@ ERROR_MODEL_NOT_FOUND = {
     }
 }
 
+ERROR_PROVIDER_UNAVAILABLE = {
+    "error": {
+        "message": "The provider is failing and is being given time to recover. Try again shortly.",
+        "type": "provider_unavailable",
+        "param": None,
+        "code": None
+    }
+}
+
+ERROR_QUEUE_TIMEOUT = {
+    "error": {
+        "message": "The provider is too busy, the request waited too long for its turn. Try again later.",
+        "type": "queue_timeout",
+        "param": None,
+        "code": None
+    }
+}
+
+ERROR_IMAGE_DOWNLOAD_FAILED = {
+    "error": {
+        "message": "One of the image_url images could not be downloaded.",
+        "type": "invalid_request_error",
+        "param": None,
+        "code": "image_download_failed"
+    }
+}
+
 class ResponseStatus:
     def __init__(self, status_code=500, body=None):
         self.status_code = status_code
         self.success = False    
         self.body = body
+        # When set, body is an async generator of chunk payloads to relay as they arrive.
+        self.stream = False
+        # Seconds the provider asked us to wait before trying again, from its Retry-After header.
+        self.retry_after = None
+
+
+def get_pool_options(provider_options):
+    pool_options = dict(DEFAULT_POOL_OPTIONS)
+    for option in DEFAULT_POOL_OPTIONS:
+        if option in provider_options:
+            pool_options[option] = provider_options[option]
+    return pool_options
+
+def create_client(provider_options={}, cert=None):
+    pool_options = get_pool_options(provider_options)
+
+    use_http2 = pool_options["http2"]
+    if use_http2 and not HTTP2_AVAILABLE:
+        LOGGER.warning("http2 is enabled but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+        use_http2 = False
+
+    limits = httpx.Limits(
+        max_connections=pool_options["max_connections"],
+        max_keepalive_connections=pool_options["max_keepalive_connections"],
+        keepalive_expiry=pool_options["keepalive_expiry"]
+    )
+    timeout = httpx.Timeout(
+        connect=pool_options["connect_timeout"],
+        read=pool_options["read_timeout"],
+        write=pool_options["read_timeout"],
+        pool=None
+    )
+    client = httpx.AsyncClient(timeout=timeout, limits=limits, http2=use_http2, verify=cert if cert is not None else True)
+    client.pool_options = pool_options
+    return client
+
+def get_pool_key(provider, cert):
+    return provider if cert is None else (provider, cert)
+
+def get_client(provider=None, cert=None):
+    client = CLIENT_POOL.get(get_pool_key(provider, cert))
+    if client is None:
+        # Anything that shows up before startup (or without a provider) still gets a pooled client.
+        provider_options = {}
+        if provider is not None:
+            provider_options = config_manager.get_config()["provider_options"].get(provider, {})
+        client = create_client(provider_options, cert)
+        CLIENT_POOL[get_pool_key(provider, cert)] = client
+    return client
+
+def acquire_client(provider=None, cert=None):
+    client = get_client(provider, cert)
+    CLIENT_USERS[client] = CLIENT_USERS.get(client, 0) + 1
+    return client
+
+async def release_client(client):
+    client_users = CLIENT_USERS.get(client, 1) - 1
+    if client_users > 0:
+        CLIENT_USERS[client] = client_users
+        return
+    CLIENT_USERS.pop(client, None)
+    if client in RETIRED_CLIENTS:
+        RETIRED_CLIENTS.discard(client)
+        await client.aclose()
+
+def retire_client(client):
+    if CLIENT_USERS.get(client, 0) > 0:
+        RETIRED_CLIENTS.add(client)
+    else:
+        asyncio.ensure_future(client.aclose())
+
+def refresh_clients(old_config, new_config):
+    # Reload listener: only providers whose pool options actually changed get a new client.
+    for pool_key, client in list(CLIENT_POOL.items()):
+        provider, cert = pool_key if isinstance(pool_key, tuple) else (pool_key, None)
+        if provider is None:
+            continue
+        provider_options = new_config["provider_options"].get(provider, {})
+        if get_pool_options(provider_options) == getattr(client, "pool_options", None):
+            continue
+        CLIENT_POOL[pool_key] = create_client(provider_options, cert)
+        retire_client(client)
 
+def init_clients():
+    for provider, provider_options in config_manager.get_config()["provider_options"].items():
+        if provider not in CLIENT_POOL:
+            CLIENT_POOL[provider] = create_client(provider_options)
+    config_manager.add_reload_listener(refresh_clients)
 
-async def send_request(method, url, headers={}, body={},cert=None):    
-    print(f"Sending Request to: {url}")    
+async def close_clients():
+    clients = list(CLIENT_POOL.values()) + list(RETIRED_CLIENTS)
+    CLIENT_POOL.clear()
+    RETIRED_CLIENTS.clear()
+    for client in clients:
+        await client.aclose()
+
+
+# -- RETRIES --
+
+def get_retry_options(provider=None):
+    provider_options = {}
+    if provider is not None:
+        provider_options = config_manager.get_config()["provider_options"].get(provider, {})
+    retry_options = dict(DEFAULT_RETRY_OPTIONS)
+    for option in DEFAULT_RETRY_OPTIONS:
+        if option in provider_options:
+            retry_options[option] = provider_options[option]
+    return retry_options
+
+def parse_retry_after(headers):
+    # Retry-After is either a number of seconds or an HTTP date.
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+def get_backoff_delay(retry_options, retry_number):
+    # Full jitter, so a burst of failed requests doesn't come back all at once.
+    max_delay = min(retry_options["retry_max_delay"], retry_options["retry_base_delay"] * (2 ** retry_number))
+    return random.uniform(0, max_delay)
+
+async def send_with_retries(send_attempt, method, url, provider, idempotent):
+    # Calls send_attempt(url) until it gets a response worth handing back. Connection errors and the
+    # retry_status_codes are tried again after a backoff (or the provider's Retry-After), on another
+    # backend when the provider has more than one. Requests that aren't idempotent are only tried again
+    # when the provider can't have acted on them.
+    retry_options = get_retry_options(provider)
+    if idempotent is None:
+        idempotent = method == "GET" or retry_options["retry_post"]
+    retry_number = 0
+    while True:
+        last_attempt = retry_number >= retry_options["max_retries"]
+        try:
+            response = await send_attempt(url)
+        except backend_pool.CircuitOpenError as e:
+            if last_attempt or backend_pool.retarget(provider, url) == url:
+                log_manager.log_event(LOGGER, logging.WARNING, "circuit_open", "Turned request away", url=url, reason=str(e))
+                return ResponseStatus(503, ERROR_PROVIDER_UNAVAILABLE)
+            # Another backend can take it right away.
+            retry_reason = "circuit_open"
+            delay = 0
+        except request_scheduler.QueueTimeoutError:
+            # Sending it again would only put it at the back of the same queue.
+            return ResponseStatus(503, ERROR_QUEUE_TIMEOUT)
+        except httpx.TransportError as e:
+            if last_attempt or not (idempotent or isinstance(e, NOT_SENT_ERRORS)):
+                raise
+            retry_reason = type(e).__name__
+            delay = get_backoff_delay(retry_options, retry_number)
+        else:
+            if last_attempt or response.status_code not in retry_options["retry_status_codes"]:
+                return response
+            if not idempotent and response.status_code not in NOT_PROCESSED_STATUS_CODES:
+                return response
+            delay = response.retry_after
+            if delay is None:
+                delay = get_backoff_delay(retry_options, retry_number)
+            if delay > retry_options["max_retry_after"]:
+                return response
+            retry_reason = str(response.status_code)
+
+        retry_number += 1
+        metrics.record_retry(provider, retry_reason)
+        log_manager.log_event(LOGGER, logging.INFO, "upstream_retry", "Retrying upstream request", url=url, reason=retry_reason, retry=retry_number, delay=round(delay, 3))
+        await asyncio.sleep(delay)
+        url = backend_pool.retarget(provider, url)
+
+
+async def acquire_slot(provider, backend_request):
+    # Waits for the scheduler to let the request go. If it never does, the backend is let go of untouched.
+    try:
+        return await request_scheduler.acquire(provider, backend_request)
+    except BaseException:
+        backend_pool.finish_request(backend_request, "cancelled")
+        raise
+
+async def send_request(method, url, headers={}, body={},cert=None,provider=None,idempotent=None):
     if not "Content-Type" in headers:
         headers["Content-Type"] = "application/json"
 
-    async with httpx.AsyncClient(timeout=None,verify=cert) as client:
-        
-        if method == "GET":
-            result = await client.get(url, headers=headers)
-        elif method == "POST":
-            result = await client.post(url, json=body, headers=headers)
-        # If there's an error print the response
-        if result.status_code != 200:
-            print(f"Error in request: {result.status_code}: {result.text}")
-        
-        response = ResponseStatus(result.status_code, None)
+    async def send_attempt(attempt_url):
+        log_manager.log_event(LOGGER, logging.DEBUG, "upstream_request", "Sending request", method=method, url=attempt_url)
+        backend_request = backend_pool.start_request(provider, attempt_url)
+        scheduler_slot = await acquire_slot(provider, backend_request)
+        upstream_timer = metrics.start_upstream(provider)
+        status_code = "error"
+        try:
+            client = acquire_client(provider, cert)
+            try:
+                response = await execute_request(client, method, attempt_url, headers, body)
+            finally:
+                await release_client(client)
+            status_code = response.status_code
+            return response
+        except asyncio.CancelledError:
+            # Cancelled by a hedge that won or a client that went away, which says nothing about the backend.
+            status_code = "cancelled"
+            raise
+        finally:
+            metrics.finish_upstream(upstream_timer, status_code)
+            request_scheduler.release(scheduler_slot, status_code)
+            backend_pool.finish_request(backend_request, status_code)
+
+    return await send_with_retries(send_attempt, method, url, provider, idempotent)
+
+async def execute_request(client, method, url, headers, body):
+    if method == "GET":
+        result = await client.get(url, headers=headers)
+    elif method == "POST":
+        result = await client.post(url, json=body, headers=headers)
+    # If there's an error log (the start of) the response
+    if result.status_code != 200:
+        log_manager.log_event(LOGGER, logging.WARNING, "upstream_error", "Upstream request failed", url=url, status_code=result.status_code, body=log_manager.truncate_body(result.text))
+    
+    response = ResponseStatus(result.status_code, None)
+    try:
+        response.body = result.json()
+    except:
+        response.body = result.text
+    
+    if response.status_code != 200:
+        response.retry_after = parse_retry_after(result.headers)
+    if response.status_code == 200:
+        response.success = True
+    return response
+
+async def open_stream(method, url, headers={}, body={}, provider=None, idempotent=None):
+    if not "Content-Type" in headers:
+        headers["Content-Type"] = "application/json"
+
+    # Only opening the stream is retried. Once chunks are on their way to the client it's too late.
+    async def open_attempt(attempt_url):
+        log_manager.log_event(LOGGER, logging.DEBUG, "upstream_request", "Opening stream", method=method, url=attempt_url)
+        backend_request = backend_pool.start_request(provider, attempt_url)
+        scheduler_slot = await acquire_slot(provider, backend_request)
+        client = acquire_client(provider)
+        upstream_request = client.build_request(method, attempt_url, json=body, headers=headers)
+        upstream_timer = metrics.start_upstream(provider)
         try:
-            response.body = result.json()
-        except:
-            response.body = result.text
-        
-        if response.status_code == 200:
-            response.success = True
-        return response
\ No newline at end of file
+            result = await client.send(upstream_request, stream=True)
+        except BaseException as e:
+            status_code = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+            metrics.finish_upstream(upstream_timer, status_code)
+            request_scheduler.release(scheduler_slot, status_code)
+            backend_pool.finish_request(backend_request, status_code)
+            await release_client(client)
+            raise
+
+        request_scheduler.sample(scheduler_slot, result.status_code, streamed=True)
+        response = ResponseStatus(result.status_code, None)
+        if result.status_code != 200:
+            # Nothing to stream, so read the error body and hand it back like send_request would.
+            await result.aread()
+            await result.aclose()
+            metrics.finish_upstream(upstream_timer, result.status_code)
+            request_scheduler.release(scheduler_slot)
+            backend_pool.finish_request(backend_request, result.status_code)
+            await release_client(client)
+            log_manager.log_event(LOGGER, logging.WARNING, "upstream_error", "Upstream request failed", url=attempt_url, status_code=result.status_code, body=log_manager.truncate_body(result.text))
+            try:
+                response.body = result.json()
+            except:
+                response.body = result.text
+            response.retry_after = parse_retry_after(result.headers)
+            return response
+
+        # The caller owns the open response now and has to drain it with one of the iter_* helpers,
+        # which also close out its metrics once the stream ends.
+        result.extensions["upstream_timer"] = upstream_timer
+        result.extensions["pool_client"] = client
+        result.extensions["backend_request"] = backend_request
+        result.extensions["scheduler_slot"] = scheduler_slot
+        response.body = result
+        response.success = True
+        return response
+
+    return await send_with_retries(open_attempt, method, url, provider, idempotent)
+
+async def close_stream(upstream):
+    try:
+        await upstream.aclose()
+    finally:
+        upstream_timer = upstream.extensions.pop("upstream_timer", None)
+        if upstream_timer is not None:
+            metrics.finish_upstream(upstream_timer, upstream.status_code)
+        request_scheduler.release(upstream.extensions.pop("scheduler_slot", None))
+        if "backend_request" in upstream.extensions:
+            backend_pool.finish_request(upstream.extensions.pop("backend_request"), upstream.status_code)
+        pool_client = upstream.extensions.pop("pool_client", None)
+        if pool_client is not None:
+            await release_client(pool_client)
+
+async def iter_sse_data(upstream):
+    # Yields the payload of every "data:" line of a server-sent event stream.
+    try:
+        async for line in upstream.aiter_lines():
+            if line.startswith("data:"):
+                yield line[5:].strip()
+    finally:
+        await close_stream(upstream)
+
+async def iter_ndjson(upstream):
+    # Yields every line of a newline delimited JSON stream as a dict.
+    try:
+        async for line in upstream.aiter_lines():
+            if line.strip() == "":
+                continue
+            yield json.loads(line)
+    finally:
+        await close_stream(upstream)
+
+async def fan_out(count, send, max_concurrency=DEFAULT_MAX_PARALLEL_COMPLETIONS):
+    # Runs send() count times with at most max_concurrency in flight and returns the responses in the
+    # order they finished. The first failed response ends it early and anything still running is cancelled.
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def send_limited():
+        async with semaphore:
+            return await send()
+
+    tasks = [asyncio.ensure_future(send_limited()) for i in range(0, count)]
+    responses = []
+    try:
+        for next_finished in asyncio.as_completed(tasks):
+            response = await next_finished
+            responses.append(response)
+            if response.status_code != 200:
+                break
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    return responses
+
+async def gather_limited(sends, max_concurrency):
+    # Runs every send() with at most max_concurrency in flight and returns the responses in the same
+    # order as sends. If one fails, the rest are cancelled and a list with just that failure comes back.
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def send_limited(send):
+        async with semaphore:
+            return await send()
+
+    tasks = [asyncio.ensure_future(send_limited(send)) for send in sends]
+    try:
+        for next_finished in asyncio.as_completed(tasks):
+            response = await next_finished
+            if response.status_code != 200:
+                return [response]
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    return [task.result() for task in tasks]
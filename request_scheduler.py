@@ -0,0 +1,272 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import time
+
+import config_manager
+import log_manager
+import metrics
+import rate_limiter
+
+LOGGER = log_manager.get_logger("request_scheduler")
+
+# Every backend gets a limit on requests in flight, and the rest wait in our own queue instead of piling up
+# on the provider. Waiting requests go out by priority class first, then fairly between API keys (weighted
+# fair queuing), so one key's batch job can't stall everyone else's chats.
+#
+# The limit is learned per backend (gradient style): it grows while latency stays close to what the backend
+# does when it's lightly loaded, and shrinks when latency climbs past that or the provider answers with
+# overload errors, which keeps each backend near the point where more concurrency stops buying throughput.
+# Latency is only ever compared within one kind of request (endpoint, model, streamed or not), since a
+# /v1/models call and a long completion on the same backend have nothing to say about each other.
+# The local servers that register here learn by default, everything else is unlimited unless its provider
+# opts in with adaptive_concurrency: true. With it off, local servers keep a fixed max_concurrent_requests.
+DEFAULT_SCHEDULER_OPTIONS = {
+    # Class for requests that don't ask for one, unless their key has its own.
+    "default_priority": "interactive",
+    # Seconds a request can wait for a slot before it's turned away with a 503, by class.
+    "max_queue_time": {"interactive": 30, "batch": 600},
+    # Per key settings, e.g. {"batch-key": {"priority": "batch"}, "team-a-key": {"weight": 2}}.
+    # A key's weight is its share of the slots compared to other keys waiting in the same class.
+    "keys": {}
+}
+# Highest priority first. The X-Priority header can move a request down from its key's class, never up.
+PRIORITY_CLASSES = ("interactive", "batch")
+# Slots per backend for local servers when the provider doesn't say, Ollama's default OLLAMA_NUM_PARALLEL.
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+# Where the learned limit starts for providers that opt in.
+DEFAULT_INITIAL_LIMIT = 20
+# Bounds for the learned limit, overridable per provider.
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 200
+# Statuses that mean the backend has more than it can handle.
+OVERLOAD_STATUS_CODES = {429, 502, 503, 504}
+# Latency can rise this far over the light load baseline before the limit comes down.
+LATENCY_TOLERANCE = 1.5
+# Requests that started with at most this share of the limit in flight count towards the baseline.
+# Busy periods never do, so queueing can't creep into what "normal" looks like.
+LIGHT_LOAD_SHARE = 0.25
+# How fast the latency averages and the limit itself move with each response.
+RECENT_LATENCY_WEIGHT = 0.1
+BASELINE_LATENCY_WEIGHT = 0.05
+LIMIT_SMOOTHING = 0.2
+# What an overloaded backend's limit is multiplied by (before smoothing).
+OVERLOAD_BACKOFF = 0.5
+
+SCHEDULED_PROVIDERS = set()
+# (provider, base_url) -> queue state
+BACKEND_QUEUES = {}
+QUEUE_SEQUENCE = itertools.count()
+REQUEST_PRIORITY = contextvars.ContextVar("request_priority", default=None)
+
+
+class QueueTimeoutError(Exception):
+    # Raised by acquire when a request waited past its class's max_queue_time.
+    pass
+
+def register_provider(provider):
+    SCHEDULED_PROVIDERS.add(provider)
+
+def get_scheduler_options():
+    scheduler_options = dict(DEFAULT_SCHEDULER_OPTIONS)
+    scheduler_options.update(config_manager.get_config().get("scheduler", {}))
+    return scheduler_options
+
+def set_request_priority(requested_priority):
+    # Called by the route handlers with the X-Priority header, if there was one.
+    REQUEST_PRIORITY.set(requested_priority)
+
+def get_request_priority(scheduler_options, api_key):
+    priority = scheduler_options["keys"].get(api_key, {}).get("priority", scheduler_options["default_priority"])
+    if priority not in PRIORITY_CLASSES:
+        priority = PRIORITY_CLASSES[0]
+    requested_priority = REQUEST_PRIORITY.get()
+    if requested_priority in PRIORITY_CLASSES and PRIORITY_CLASSES.index(requested_priority) > PRIORITY_CLASSES.index(priority):
+        priority = requested_priority
+    return priority
+
+def get_provider_options(provider):
+    return config_manager.get_config()["provider_options"].get(provider, {})
+
+def is_adaptive(provider):
+    return get_provider_options(provider).get("adaptive_concurrency", provider in SCHEDULED_PROVIDERS)
+
+def get_configured_limit(provider, base_url):
+    # The fixed limit with adaptive_concurrency off, or where the learned one starts.
+    provider_options = get_provider_options(provider)
+    for backend in provider_options.get("backends") or []:
+        if backend["base_url"] == base_url and "max_concurrent_requests" in backend:
+            return backend["max_concurrent_requests"]
+    if provider in SCHEDULED_PROVIDERS:
+        return provider_options.get("max_concurrent_requests", DEFAULT_MAX_CONCURRENT_REQUESTS)
+    return provider_options.get("max_concurrent_requests", DEFAULT_INITIAL_LIMIT)
+
+def get_concurrency_limit(backend_queue):
+    if is_adaptive(backend_queue["provider"]):
+        return max(1, int(backend_queue["limit"]))
+    return get_configured_limit(backend_queue["provider"], backend_queue["base_url"])
+
+def get_backend_queue(provider, base_url):
+    backend_queue = BACKEND_QUEUES.get((provider, base_url))
+    if backend_queue is None:
+        backend_queue = {
+            "provider": provider,
+            "base_url": base_url,
+            "active": 0,
+            "waiting": 0,
+            # Learned limit, and the latency averages it's learned from by kind of request.
+            "limit": float(get_configured_limit(provider, base_url)),
+            # (endpoint, model, streamed) -> {"recent": seconds, "baseline": seconds}
+            "latency": {},
+            # priority -> heap of [finish tag, sequence, waiter future, priority]
+            "queues": {priority: [] for priority in PRIORITY_CLASSES},
+            # priority -> finish tag of the last request sent out
+            "virtual_time": {priority: 0.0 for priority in PRIORITY_CLASSES},
+            # (priority, api key) -> finish tag of the key's last queued request
+            "last_finish": {}
+        }
+        BACKEND_QUEUES[(provider, base_url)] = backend_queue
+        metrics.add_gauge("warp_pipe_concurrency_limit", (provider, base_url), backend_queue["limit"])
+    return backend_queue
+
+def dispatch_waiting(backend_queue):
+    # Hands free slots to waiting requests, best class first and smallest finish tag within it.
+    limit = get_concurrency_limit(backend_queue)
+    for priority in PRIORITY_CLASSES:
+        queue = backend_queue["queues"][priority]
+        while len(queue) > 0 and backend_queue["active"] < limit:
+            finish_tag, _, waiter, _ = heapq.heappop(queue)
+            if waiter.done():
+                # Gave up waiting, it's already been taken off the depth count.
+                continue
+            backend_queue["virtual_time"][priority] = finish_tag
+            backend_queue["active"] += 1
+            waiter.set_result(True)
+
+def enqueue(backend_queue, priority, api_key, weight):
+    # A key's requests are spaced 1/weight apart in virtual time, so keys that have been waiting less get
+    # ahead of a key with a long backlog.
+    last_finish = backend_queue["last_finish"].get((priority, api_key), 0.0)
+    finish_tag = max(backend_queue["virtual_time"][priority], last_finish) + 1 / max(weight, 0.001)
+    backend_queue["last_finish"][(priority, api_key)] = finish_tag
+    waiter = asyncio.get_running_loop().create_future()
+    heapq.heappush(backend_queue["queues"][priority], [finish_tag, next(QUEUE_SEQUENCE), waiter, priority])
+    return waiter
+
+def create_slot(backend_queue):
+    endpoint, _, model_name = metrics.REQUEST_LABELS.get()
+    return {"queue": backend_queue, "start_time": time.perf_counter(), "in_flight": backend_queue["active"], "sampled": False, "endpoint": endpoint, "model": model_name}
+
+async def acquire(provider, backend_request):
+    # Waits for a slot on the backend the request is going to. Returns a slot for sample() and release(),
+    # or None when the provider isn't limited.
+    if backend_request is None:
+        return None
+    if provider not in SCHEDULED_PROVIDERS and not is_adaptive(provider):
+        return None
+    backend_queue = get_backend_queue(provider, backend_request["backend"]["base_url"])
+    scheduler_options = get_scheduler_options()
+    api_key = rate_limiter.CURRENT_KEY.get() or rate_limiter.ANONYMOUS_KEY
+    priority = get_request_priority(scheduler_options, api_key)
+    queue_labels = (provider, backend_queue["base_url"], priority)
+
+    start_time = time.perf_counter()
+    if backend_queue["waiting"] == 0 and backend_queue["active"] < get_concurrency_limit(backend_queue):
+        backend_queue["active"] += 1
+        metrics.observe("warp_pipe_queue_wait_seconds", (provider, priority), 0.0)
+        return create_slot(backend_queue)
+
+    weight = scheduler_options["keys"].get(api_key, {}).get("weight", 1)
+    waiter = enqueue(backend_queue, priority, api_key, weight)
+    backend_queue["waiting"] += 1
+    metrics.add_gauge("warp_pipe_queue_depth", queue_labels, 1)
+    max_queue_time = scheduler_options["max_queue_time"].get(priority)
+    try:
+        # The limit may have gone up since the last release.
+        dispatch_waiting(backend_queue)
+        await asyncio.wait_for(waiter, timeout=max_queue_time)
+    except BaseException as e:
+        if waiter.done() and not waiter.cancelled():
+            # Got a slot just as it gave up, so hand it on.
+            release(create_slot(backend_queue))
+        if isinstance(e, asyncio.TimeoutError):
+            log_manager.log_event(LOGGER, logging.WARNING, "queue_timeout", "Request waited too long for a slot", provider=provider, backend=backend_queue["base_url"], priority=priority)
+            raise QueueTimeoutError(f"waited over {max_queue_time}s for {backend_queue['base_url']}")
+        raise
+    finally:
+        backend_queue["waiting"] -= 1
+        metrics.add_gauge("warp_pipe_queue_depth", queue_labels, -1)
+        metrics.observe("warp_pipe_queue_wait_seconds", (provider, priority), time.perf_counter() - start_time)
+    return create_slot(backend_queue)
+
+def update_limit(backend_queue, latency_class, latency, in_flight, overloaded):
+    # Gradient style: the limit is scaled by baseline / recent latency (never below half). Only while latency
+    # is flat does it get some headroom on top (the square root of the limit), so it keeps probing upwards.
+    # Anything else only ever brings it down, all the way to the minimum if need be, which is also how a
+    # backend that got slower for good gets lightly loaded again and its baseline re-measured.
+    provider_options = get_provider_options(backend_queue["provider"])
+    limit = backend_queue["limit"]
+    if overloaded:
+        new_limit = limit * OVERLOAD_BACKOFF
+    else:
+        latency_state = backend_queue["latency"].get(latency_class)
+        if latency_state is None:
+            latency_state = {"recent": latency, "baseline": None}
+            backend_queue["latency"][latency_class] = latency_state
+        latency_state["recent"] += (latency - latency_state["recent"]) * RECENT_LATENCY_WEIGHT
+        if in_flight <= max(1, backend_queue["limit"] * LIGHT_LOAD_SHARE):
+            if latency_state["baseline"] is None:
+                latency_state["baseline"] = latency
+            latency_state["baseline"] += (latency - latency_state["baseline"]) * BASELINE_LATENCY_WEIGHT
+        if latency_state["baseline"] is None:
+            return
+        gradient = max(0.5, min(1.0, LATENCY_TOLERANCE * latency_state["baseline"] / latency_state["recent"]))
+        if gradient < 1.0:
+            new_limit = limit * gradient
+        elif in_flight < limit / 2:
+            # Latency that looks fine while the backend is mostly idle doesn't say anything about a higher limit.
+            return
+        else:
+            new_limit = limit + math.sqrt(limit)
+
+    new_limit = limit * (1 - LIMIT_SMOOTHING) + new_limit * LIMIT_SMOOTHING
+    min_limit = provider_options.get("adaptive_min_concurrency", DEFAULT_MIN_LIMIT)
+    max_limit = provider_options.get("adaptive_max_concurrency", DEFAULT_MAX_LIMIT)
+    backend_queue["limit"] = max(min_limit, min(max_limit, new_limit))
+    metrics.add_gauge("warp_pipe_concurrency_limit", (backend_queue["provider"], backend_queue["base_url"]), backend_queue["limit"] - limit)
+
+def sample(scheduler_slot, status_code, streamed=False):
+    # Feeds how the request went into the backend's limit. Streams call this once the headers are in, since
+    # how long a stream runs depends on what was asked for more than on the backend.
+    if scheduler_slot is None or scheduler_slot["sampled"]:
+        return
+    scheduler_slot["sampled"] = True
+    if not is_adaptive(scheduler_slot["queue"]["provider"]):
+        return
+    latency_class = (scheduler_slot["endpoint"], scheduler_slot["model"], streamed)
+    if status_code == "error" or status_code in OVERLOAD_STATUS_CODES:
+        update_limit(scheduler_slot["queue"], latency_class, None, scheduler_slot["in_flight"], True)
+    elif status_code == 200:
+        update_limit(scheduler_slot["queue"], latency_class, time.perf_counter() - scheduler_slot["start_time"], scheduler_slot["in_flight"], False)
+
+def release(scheduler_slot, status_code=None):
+    if scheduler_slot is None:
+        return
+    if status_code is not None:
+        sample(scheduler_slot, status_code)
+    backend_queue = scheduler_slot["queue"]
+    backend_queue["active"] -= 1
+    dispatch_waiting(backend_queue)
+
+def get_scheduler_stats():
+    return {f"{provider} {base_url}": {
+        "active": backend_queue["active"],
+        "waiting": backend_queue["waiting"],
+        "limit": get_concurrency_limit(backend_queue),
+        "adaptive": is_adaptive(provider),
+        "latency": {f"{endpoint} {model_name}{' stream' if streamed else ''}".strip(): latency_state
+                    for (endpoint, model_name, streamed), latency_state in backend_queue["latency"].items()}
+    } for (provider, base_url), backend_queue in BACKEND_QUEUES.items()}
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+import config_manager
+
+# Opt-in cache for chat completions that should come back the same every time (temperature 0 or a fixed seed).
+# Entries are finished chat.completion bodies, kept in an LRU bounded by a byte budget and a ttl.
+DEFAULT_CACHE_OPTIONS = {
+    "enabled": False,
+    "max_bytes": 64 * 1024 * 1024,
+    "ttl": 3600
+}
+
+# Everything in a request that can change what comes back. stream, user and friends are left out on purpose.
+CACHE_KEY_FIELDS = [
+    "messages",
+    "tools",
+    "tool_choice",
+    "functions",
+    "function_call",
+    "response_format",
+    "temperature",
+    "top_p",
+    "seed",
+    "max_tokens",
+    "stop",
+    "n",
+    "frequency_penalty",
+    "presence_penalty",
+    "logit_bias",
+    "logprobs",
+    "top_logprobs",
+    "max_context"
+]
+
+CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "evictions": 0
+}
+
+RESPONSE_CACHE = OrderedDict()
+RESPONSE_CACHE_BYTES = 0
+
+
+def get_cache_options():
+    cache_options = dict(DEFAULT_CACHE_OPTIONS)
+    cache_options.update(config_manager.get_config().get("response_cache", {}))
+    return cache_options
+
+def is_deterministic(request_body):
+    return request_body.get("temperature") == 0 or request_body.get("seed") is not None
+
+def make_cache_key(header_info, request_body, resolve_model=None):
+    # Returns None when the request shouldn't touch the cache at all.
+    if not get_cache_options()["enabled"] or header_info.get("cache_bypass") == "no-store":
+        return None
+    if not is_deterministic(request_body):
+        return None
+
+    model_name = request_body.get("model")
+    if resolve_model is not None:
+        model_name = resolve_model(model_name)
+    # Callers passing their own provider key never share entries, one tenant's answer can't go to another.
+    provider_auth = header_info.get("provider_auth", "")
+    key_fields = {
+        "provider": header_info["llm_provider"],
+        "provider_auth": hashlib.sha256(provider_auth.encode("utf-8")).hexdigest(),
+        "model": model_name,
+        "max_context_header": header_info.get("max_context")
+    }
+    for field in CACHE_KEY_FIELDS:
+        if field in request_body:
+            key_fields[field] = request_body[field]
+    canonical_request = json.dumps(key_fields, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+
+def get_response(cache_key, header_info):
+    if cache_key is None or header_info.get("cache_bypass") == "no-cache":
+        return None
+    cached_entry = RESPONSE_CACHE.get(cache_key)
+    if cached_entry is not None and time.monotonic() > cached_entry["expires_at"]:
+        remove_entry(cache_key)
+        cached_entry = None
+    if cached_entry is None:
+        CACHE_STATS["misses"] += 1
+        return None
+    RESPONSE_CACHE.move_to_end(cache_key)
+    CACHE_STATS["hits"] += 1
+    return cached_entry["response_body"]
+
+def remove_entry(cache_key):
+    global RESPONSE_CACHE_BYTES
+    cached_entry = RESPONSE_CACHE.pop(cache_key, None)
+    if cached_entry is not None:
+        RESPONSE_CACHE_BYTES -= cached_entry["size"]
+
+def put_response(cache_key, response_body):
+    global RESPONSE_CACHE_BYTES
+    if cache_key is None:
+        return
+    cache_options = get_cache_options()
+    response_body = normalize_completion(response_body)
+    entry_size = len(json.dumps(response_body))
+    if entry_size > cache_options["max_bytes"]:
+        return
+
+    remove_entry(cache_key)
+    RESPONSE_CACHE[cache_key] = {
+        "response_body": response_body,
+        "size": entry_size,
+        "expires_at": time.monotonic() + cache_options["ttl"]
+    }
+    RESPONSE_CACHE_BYTES += entry_size
+    CACHE_STATS["stores"] += 1
+    while RESPONSE_CACHE_BYTES > cache_options["max_bytes"]:
+        evicted_key = next(iter(RESPONSE_CACHE))
+        remove_entry(evicted_key)
+        CACHE_STATS["evictions"] += 1
+
+def normalize_completion(response_body):
+    # Fallback streams come back from the adapters already shaped as chunks, the cache keeps plain completions.
+    if response_body.get("object") != "chat.completion.chunk":
+        return response_body
+    choices = []
+    for choice in response_body.get("choices", []):
+        choice = dict(choice)
+        if "delta" in choice:
+            choice["message"] = choice.pop("delta")
+        choices.append(choice)
+    return {**response_body, "object": "chat.completion", "choices": choices}
+
+def assemble_stream_chunks(response_chunks):
+    # Stitches a relayed chunk stream back into the chat.completion it describes, or None if it didn't finish cleanly.
+    completion = None
+    choices = {}
+    for response_chunk in response_chunks:
+        if response_chunk == "[DONE]":
+            break
+        chunk = json.loads(response_chunk)
+        if "error" in chunk:
+            return None
+        if completion is None:
+            completion = {
+                "id": chunk.get("id"),
+                "object": "chat.completion",
+                "created": chunk.get("created", int(time.time())),
+                "model": chunk.get("model"),
+                "system_fingerprint": chunk.get("system_fingerprint"),
+                "choices": []
+            }
+        if chunk.get("usage"):
+            completion["usage"] = chunk["usage"]
+        for chunk_choice in chunk.get("choices", []):
+            choice = choices.setdefault(chunk_choice.get("index", 0), {
+                "index": chunk_choice.get("index", 0),
+                "message": {"role": "assistant", "content": None},
+                "logprobs": None,
+                "finish_reason": None
+            })
+            delta = chunk_choice.get("delta", {})
+            message = choice["message"]
+            if delta.get("role"):
+                message["role"] = delta["role"]
+            if delta.get("content"):
+                message["content"] = (message["content"] or "") + delta["content"]
+            for tool_call_delta in delta.get("tool_calls") or []:
+                tool_calls = message.setdefault("tool_calls", [])
+                tool_call_index = tool_call_delta.get("index", len(tool_calls))
+                while len(tool_calls) <= tool_call_index:
+                    tool_calls.append({"id": None, "type": "function", "function": {"name": None, "arguments": ""}})
+                tool_call = tool_calls[tool_call_index]
+                if tool_call_delta.get("id"):
+                    tool_call["id"] = tool_call_delta["id"]
+                if tool_call_delta.get("type"):
+                    tool_call["type"] = tool_call_delta["type"]
+                function_delta = tool_call_delta.get("function", {})
+                if function_delta.get("name"):
+                    tool_call["function"]["name"] = function_delta["name"]
+                tool_call["function"]["arguments"] += function_delta.get("arguments") or ""
+            if chunk_choice.get("finish_reason"):
+                choice["finish_reason"] = chunk_choice["finish_reason"]
+
+    if completion is None or len(choices) == 0:
+        return None
+    if any(choice["finish_reason"] is None for choice in choices.values()):
+        return None
+    completion["choices"] = [choices[index] for index in sorted(choices)]
+    return completion
+
+async def record_stream(cache_key, response_chunks):
+    # Passes the chunks through untouched and caches the finished completion once the stream completes.
+    recorded_chunks = []
+    async for response_chunk in response_chunks:
+        recorded_chunks.append(response_chunk)
+        yield response_chunk
+    completed_response = assemble_stream_chunks(recorded_chunks)
+    if completed_response is not None:
+        put_response(cache_key, completed_response)
+
+def get_cache_stats():
+    return {
+        **CACHE_STATS,
+        "entries": len(RESPONSE_CACHE),
+        "bytes": RESPONSE_CACHE_BYTES
+    }
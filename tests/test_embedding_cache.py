@@ -0,0 +1,127 @@
+import base64
+import copy
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import embedding_cache
+import request_manager
+
+
+def use_cache_options(**cache_options):
+    config_data = copy.deepcopy(config_manager.DEFAULT_CONFIG)
+    config_data["embedding_cache"] = dict(config_data["embedding_cache"], **cache_options)
+    config_manager.swap_config(config_manager.build_config(config_data))
+
+def vector_for(input_value):
+    # Made up from the input so every vector is easy to tell apart, and exact as float32.
+    return [float(len(str(input_value))), float(sum(map(ord, str(input_value))) % 1024), 0.5]
+
+
+class EmbeddingCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.disk_dir = tempfile.TemporaryDirectory()
+        use_cache_options(disk_path=os.path.join(self.disk_dir.name, "embedding_cache.db"))
+        embedding_cache.MEMORY_CACHE.clear()
+        self.fetched_inputs = []
+
+    async def asyncTearDown(self):
+        await embedding_cache.close_disk_cache()
+        embedding_cache.MEMORY_CACHE.clear()
+        self.disk_dir.cleanup()
+        config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+    async def fetch_embeddings(self, request_headers, request_body):
+        self.fetched_inputs.append(request_body["input"])
+        # Handed back in reverse, upstream indexes are what say which input a vector belongs to.
+        upstream_data = [{"object": "embedding", "embedding": vector_for(input_value), "index": index} for index, input_value in enumerate(request_body["input"])]
+        response = request_manager.ResponseStatus(200, {
+            "object": "list",
+            "data": list(reversed(upstream_data)),
+            "model": request_body["model"],
+            "usage": {"prompt_tokens": len(request_body["input"]), "total_tokens": len(request_body["input"])}
+        })
+        response.success = True
+        return response
+
+    async def embed(self, input_list, model_name="embed-model", **request_fields):
+        request_body = dict({"model": model_name, "input": input_list}, **request_fields)
+        response = await embedding_cache.get_embeddings("OPENAI", model_name, self.fetch_embeddings, {}, request_body)
+        self.assertTrue(response.success)
+        return response.body
+
+    def assertVectors(self, response_body, input_list):
+        self.assertEqual([data["index"] for data in response_body["data"]], list(range(len(input_list))))
+        self.assertEqual([data["embedding"] for data in response_body["data"]], [vector_for(input_value) for input_value in input_list])
+
+    async def test_same_content_is_only_fetched_once(self):
+        self.assertVectors(await self.embed(["alpha", "beta"]), ["alpha", "beta"])
+        response_body = await self.embed(["beta", "alpha"])
+        self.assertVectors(response_body, ["beta", "alpha"])
+        self.assertEqual(self.fetched_inputs, [["alpha", "beta"]])
+        # Nothing went upstream, so nothing was billed.
+        self.assertEqual(response_body["usage"]["prompt_tokens"], 0)
+
+    async def test_model_and_dimensions_are_part_of_the_key(self):
+        await self.embed(["alpha"])
+        await self.embed(["alpha"], model_name="other-model")
+        await self.embed(["alpha"], dimensions=256)
+        self.assertEqual(self.fetched_inputs, [["alpha"], ["alpha"], ["alpha"]])
+
+    async def test_partial_hits_keep_the_input_order(self):
+        await self.embed(["b", "d"])
+        input_list = ["a", "b", "c", "b", "d", "e", "a"]
+        self.assertVectors(await self.embed(input_list), input_list)
+        # Only the misses went upstream, once each, in the order they first showed up.
+        self.assertEqual(self.fetched_inputs[1], ["a", "c", "e"])
+
+    async def test_single_string_and_token_array_inputs(self):
+        self.assertVectors(await self.embed("just one"), ["just one"])
+        self.assertVectors(await self.embed([101, 2023, 102]), [[101, 2023, 102]])
+        await self.embed([[101, 2023, 102]])
+        self.assertEqual(len(self.fetched_inputs), 2)
+
+    async def test_base64_from_cache_matches_floats(self):
+        await self.embed(["alpha", "beta"])
+        response_body = await self.embed(["beta", "alpha"], encoding_format="base64")
+        decoded = [list(struct.unpack("<3f", base64.b64decode(data["embedding"]))) for data in response_body["data"]]
+        self.assertEqual(decoded, [vector_for("beta"), vector_for("alpha")])
+        self.assertEqual(len(self.fetched_inputs), 1)
+
+    async def test_disk_tier_survives_a_restart(self):
+        await self.embed(["alpha", "beta"])
+        await embedding_cache.close_disk_cache()
+        # A fresh process starts with nothing in memory.
+        embedding_cache.MEMORY_CACHE.clear()
+        disk_hits = embedding_cache.CACHE_STATS["disk_hits"]
+        self.assertVectors(await self.embed(["beta", "gamma", "alpha"]), ["beta", "gamma", "alpha"])
+        self.assertEqual(self.fetched_inputs, [["alpha", "beta"], ["gamma"]])
+        self.assertEqual(embedding_cache.CACHE_STATS["disk_hits"] - disk_hits, 2)
+
+    async def test_memory_tier_is_bounded(self):
+        use_cache_options(disk_path="", max_memory_entries=2)
+        for input_value in ["a", "b", "c"]:
+            await self.embed([input_value])
+        self.assertEqual(len(embedding_cache.MEMORY_CACHE), 2)
+        # The least recently used entry is the one that gets dropped.
+        await self.embed(["c", "a"])
+        self.assertEqual(self.fetched_inputs[-1], ["a"])
+
+    async def test_disabled_goes_straight_upstream(self):
+        use_cache_options(enabled=False)
+        await self.embed(["alpha"])
+        await self.embed(["alpha"])
+        self.assertEqual(self.fetched_inputs, [["alpha"], ["alpha"]])
+        self.assertEqual(len(embedding_cache.MEMORY_CACHE), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import httpx
+import metrics
+import rate_limiter
+from fastapi import FastAPI
+
+
+def use_rate_limits(default_limits, key_limits={}, key_names={}):
+    config_data = copy.deepcopy(config_manager.DEFAULT_CONFIG)
+    config_data["api_keys"] = ["sk-team-a", "sk-team-b"]
+    config_data["rate_limits"] = {"default": default_limits, "keys": key_limits}
+    config_data["usage_ledger"] = dict(config_data["usage_ledger"], key_names=key_names)
+    config_manager.swap_config(config_manager.build_config(config_data))
+
+
+class RateLimitTest(unittest.TestCase):
+    def setUp(self):
+        rate_limiter.KEY_STATE.clear()
+
+    def tearDown(self):
+        rate_limiter.KEY_STATE.clear()
+        config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+    def test_request_bucket_allows_a_burst_then_the_rate(self):
+        use_rate_limits({"requests_per_second": 2, "burst": 3})
+        now = 1000.0
+        for i in range(3):
+            self.assertIsNone(rate_limiter.try_admit("sk-team-a", now))
+            rate_limiter.release("sk-team-a")
+        retry_after, _, limit_name = rate_limiter.try_admit("sk-team-a", now)
+        self.assertEqual(limit_name, "requests")
+        self.assertAlmostEqual(retry_after, 0.5)
+        # Half a second later one more request's worth has come back.
+        self.assertIsNone(rate_limiter.try_admit("sk-team-a", now + 0.5))
+        self.assertIsNotNone(rate_limiter.try_admit("sk-team-a", now + 0.5))
+
+    def test_token_bucket_goes_into_debt_and_waits_it_off(self):
+        use_rate_limits({"tokens_per_minute": 600})
+        token = rate_limiter.CURRENT_KEY.set("sk-team-a")
+        try:
+            self.assertIsNone(rate_limiter.try_admit("sk-team-a", 1000.0))
+            rate_limiter.release("sk-team-a")
+            # A single response can take the key well past its allowance.
+            rate_limiter.charge_usage("OPENAI", "gpt-4o", {"prompt_tokens": 700, "completion_tokens": 200})
+        finally:
+            rate_limiter.CURRENT_KEY.reset(token)
+        token_bucket = rate_limiter.get_key_state("sk-team-a")["token_bucket"]
+        now = token_bucket["updated"]
+        self.assertLess(token_bucket["level"], 0)
+        retry_after, _, limit_name = rate_limiter.try_admit("sk-team-a", now)
+        self.assertEqual(limit_name, "tokens")
+        # 10 tokens a second pays the debt back.
+        self.assertAlmostEqual(retry_after, (1 - token_bucket["level"]) / 10)
+        self.assertIsNone(rate_limiter.try_admit("sk-team-a", now + retry_after))
+        # Other keys have their own bucket.
+        self.assertIsNone(rate_limiter.try_admit("sk-team-b", now))
+
+    def test_concurrency_admission(self):
+        use_rate_limits({"max_concurrency": 2}, {"sk-team-b": {"max_concurrency": 0}})
+        self.assertIsNone(rate_limiter.try_admit("sk-team-a", 1000.0))
+        self.assertIsNone(rate_limiter.try_admit("sk-team-a", 1000.0))
+        _, _, limit_name = rate_limiter.try_admit("sk-team-a", 1000.0)
+        self.assertEqual(limit_name, "concurrency")
+        rate_limiter.release("sk-team-a")
+        self.assertIsNone(rate_limiter.try_admit("sk-team-a", 1000.0))
+        # A per key override of 0 turns the limit off for that key.
+        for i in range(5):
+            self.assertIsNone(rate_limiter.try_admit("sk-team-b", 1000.0))
+
+    def test_unlimited_by_default(self):
+        use_rate_limits({})
+        for i in range(100):
+            self.assertIsNone(rate_limiter.try_admit("sk-team-a", 1000.0))
+
+    def test_stats_dont_merge_keys_with_the_same_prefix(self):
+        use_rate_limits({"max_concurrency": 5}, key_names={"sk-team-b": "team-b"})
+        for api_key in ("sk-team-a", "sk-team-b", rate_limiter.ANONYMOUS_KEY):
+            rate_limiter.try_admit(api_key, 1000.0)
+        key_stats = rate_limiter.get_rate_limit_stats()["keys"]
+        self.assertEqual(len(key_stats), 3)
+        self.assertIn("team-b", key_stats)
+        self.assertIn(rate_limiter.ANONYMOUS_KEY, key_stats)
+        self.assertIn(rate_limiter.get_key_id("sk-team-a", {}), key_stats)
+        self.assertNotIn("sk-team-a", str(key_stats))
+
+
+class RateLimitMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        rate_limiter.KEY_STATE.clear()
+        use_rate_limits({"max_concurrency": 1, "requests_per_second": 1, "burst": 1})
+        app = FastAPI()
+        app.add_middleware(rate_limiter.RateLimitMiddleware)
+        app.add_middleware(metrics.MetricsMiddleware)
+
+        @app.get("/v1/models/{model_id}")
+        async def get_model(model_id: str):
+            return {"id": model_id}
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        rate_limiter.KEY_STATE.clear()
+        config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+    async def test_rejections_are_labeled_with_their_route(self):
+        headers = {"Authorization": "Bearer sk-team-a"}
+        rejected_labels = ("/v1/models/{model_id}", "", "", "429")
+        rejected_before = metrics.COUNTERS.get("warp_pipe_requests_total", {}).get(rejected_labels, 0)
+        self.assertEqual((await self.client.get("/v1/models/gpt-4o", headers=headers)).status_code, 200)
+        response = await self.client.get("/v1/models/gpt-4o-mini", headers=headers)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["retry-after"], "1")
+        self.assertEqual(response.json()["detail"]["error"]["code"], "rate_limit_exceeded")
+        # The admitted request's concurrency slot came back once it was done.
+        self.assertEqual(rate_limiter.get_key_state("sk-team-a")["in_flight"], 0)
+        self.assertEqual(metrics.COUNTERS["warp_pipe_requests_total"][rejected_labels], rejected_before + 1)
+        self.assertNotIn(("unmatched", "", "", "429"), metrics.COUNTERS["warp_pipe_requests_total"])
+
+
+if __name__ == "__main__":
+    unittest.main()
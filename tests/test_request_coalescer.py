@@ -0,0 +1,158 @@
+import asyncio
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import request_coalescer
+import request_manager
+
+KEY = "coalescing-key"
+
+
+def build_response(body, stream=False):
+    response = request_manager.ResponseStatus(200, body)
+    response.success = True
+    response.stream = stream
+    return response
+
+async def collect(response_chunks):
+    return [response_chunk async for response_chunk in response_chunks]
+
+
+class CoalescingTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        request_coalescer.IN_FLIGHT.clear()
+        self.upstream_calls = 0
+
+    def tearDown(self):
+        self.assertEqual(request_coalescer.IN_FLIGHT, {})
+
+    def counted(self, send):
+        async def send_counted():
+            self.upstream_calls += 1
+            return await send()
+        return send_counted
+
+    async def test_identical_requests_share_one_upstream_call(self):
+        async def send():
+            await asyncio.sleep(0.05)
+            return build_response({"choices": [{"message": {"content": "shared"}}]})
+        responses = await asyncio.gather(*[request_coalescer.run_coalesced(KEY, self.counted(send)) for i in range(5)])
+        self.assertEqual(self.upstream_calls, 1)
+        for response in responses:
+            self.assertTrue(response.success)
+            self.assertEqual(response.body, {"choices": [{"message": {"content": "shared"}}]})
+
+    async def test_no_key_always_goes_upstream(self):
+        async def send():
+            await asyncio.sleep(0.01)
+            return build_response({})
+        await asyncio.gather(*[request_coalescer.run_coalesced(None, self.counted(send)) for i in range(3)])
+        self.assertEqual(self.upstream_calls, 3)
+
+    async def test_every_subscriber_gets_the_whole_stream(self):
+        async def chunks():
+            for i in range(5):
+                await asyncio.sleep(0.01)
+                yield f"chunk-{i}"
+        async def send():
+            await asyncio.sleep(0.01)
+            return build_response(chunks(), stream=True)
+
+        async def read_coalesced(delay):
+            # Some join before the leader has headers, some while chunks are already flowing.
+            await asyncio.sleep(delay)
+            response = await request_coalescer.run_coalesced(KEY, self.counted(send))
+            self.assertTrue(response.stream)
+            return await collect(response.body)
+        streams = await asyncio.gather(*[read_coalesced(delay) for delay in (0, 0, 0.02, 0.03, 0.04)])
+        self.assertEqual(self.upstream_calls, 1)
+        for stream in streams:
+            self.assertEqual(stream, [f"chunk-{i}" for i in range(5)])
+
+    async def test_leader_error_reaches_every_follower(self):
+        async def send():
+            await asyncio.sleep(0.02)
+            raise ValueError("upstream blew up")
+        results = await asyncio.gather(*[request_coalescer.run_coalesced(KEY, self.counted(send)) for i in range(4)], return_exceptions=True)
+        self.assertEqual(self.upstream_calls, 1)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+    async def test_upstream_cancellation_reaches_every_follower(self):
+        async def send():
+            await asyncio.sleep(0.02)
+            raise asyncio.CancelledError()
+        results = await asyncio.gather(*[request_coalescer.run_coalesced(KEY, self.counted(send)) for i in range(4)], return_exceptions=True)
+        for result in results:
+            self.assertIsInstance(result, asyncio.CancelledError)
+
+    async def test_leader_client_leaving_doesnt_cancel_the_followers(self):
+        async def send():
+            await asyncio.sleep(0.05)
+            return build_response({"done": True})
+        leader = asyncio.ensure_future(request_coalescer.run_coalesced(KEY, self.counted(send)))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(request_coalescer.run_coalesced(KEY, self.counted(send))) for i in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        responses = await asyncio.gather(*followers)
+        self.assertEqual(self.upstream_calls, 1)
+        for response in responses:
+            self.assertEqual(response.body, {"done": True})
+
+    async def test_stream_error_reaches_every_subscriber(self):
+        async def chunks():
+            yield "chunk-0"
+            await asyncio.sleep(0.02)
+            raise ValueError("stream broke")
+        async def send():
+            return build_response(chunks(), stream=True)
+
+        async def read_coalesced():
+            response = await request_coalescer.run_coalesced(KEY, self.counted(send))
+            received = []
+            with self.assertRaises(ValueError):
+                async for response_chunk in response.body:
+                    received.append(response_chunk)
+            return received
+        streams = await asyncio.gather(*[read_coalesced() for i in range(3)])
+        self.assertEqual(self.upstream_calls, 1)
+        self.assertEqual(streams, [["chunk-0"]] * 3)
+
+    async def test_last_subscriber_leaving_closes_the_upstream_stream(self):
+        closed = asyncio.Event()
+        async def chunks():
+            try:
+                for i in range(100):
+                    yield f"chunk-{i}"
+                    await asyncio.sleep(0.01)
+            finally:
+                closed.set()
+        async def send():
+            return build_response(chunks(), stream=True)
+        responses = await asyncio.gather(*[request_coalescer.run_coalesced(KEY, self.counted(send)) for i in range(2)])
+        for response in responses:
+            await response.body.__anext__()
+            await response.body.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+        await asyncio.sleep(0)
+        # A new request after that goes upstream again.
+        closed.clear()
+        response = await request_coalescer.run_coalesced(KEY, self.counted(send))
+        self.assertEqual(await response.body.__anext__(), "chunk-0")
+        await response.body.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+        await asyncio.sleep(0)
+        self.assertEqual(self.upstream_calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
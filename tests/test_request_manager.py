@@ -0,0 +1,201 @@
+import asyncio
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import backend_pool
+import certifi
+import httpx
+import request_manager
+
+BASE_URL = "http://openai.test"
+# No waiting between attempts, so the tests only count them.
+FAST_RETRIES = {"base_url": BASE_URL, "retry_base_delay": 0, "max_retries": 2}
+
+
+def use_provider_options(**provider_options):
+    config_data = copy.deepcopy(config_manager.DEFAULT_CONFIG)
+    config_data["provider_options"] = {"OPENAI": dict(FAST_RETRIES, **provider_options)}
+    config_manager.swap_config(config_manager.build_config(config_data))
+
+
+class UpstreamTest(unittest.IsolatedAsyncioTestCase):
+    # Every attempt takes the next step from self.steps: a status code, or an exception class to raise.
+    def setUp(self):
+        use_provider_options()
+        backend_pool.BACKENDS.pop("OPENAI", None)
+        self.steps = []
+        self.attempts = 0
+
+    async def asyncTearDown(self):
+        await request_manager.close_clients()
+        backend_pool.BACKENDS.pop("OPENAI", None)
+        config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+    def handle(self, request):
+        self.attempts += 1
+        step = self.steps.pop(0) if len(self.steps) > 0 else 200
+        if isinstance(step, type):
+            raise step("upstream trouble", request=request)
+        headers = {"Retry-After": "0"} if step in (429, 503) else {}
+        return httpx.Response(step, json={"status": step}, headers=headers)
+
+    async def send(self, method="POST"):
+        request_manager.CLIENT_POOL["OPENAI"] = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        return await request_manager.send_request(method, BASE_URL + "/v1/chat/completions", body={}, provider="OPENAI")
+
+
+class RetryTest(UpstreamTest):
+    async def test_post_isnt_resent_after_a_possibly_processed_error(self):
+        for status_code in (500, 502, 504):
+            self.steps = [status_code]
+            self.attempts = 0
+            response = await self.send()
+            self.assertEqual(response.status_code, status_code)
+            self.assertEqual(self.attempts, 1)
+            backend_pool.BACKENDS.pop("OPENAI", None)
+
+    async def test_post_is_retried_when_not_processed(self):
+        for status_code in (429, 503):
+            self.steps = [status_code, status_code]
+            self.attempts = 0
+            response = await self.send()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.attempts, 3)
+
+    async def test_post_is_retried_when_never_sent(self):
+        self.steps = [httpx.ConnectError]
+        response = await self.send()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.attempts, 2)
+
+    async def test_post_isnt_resent_after_a_read_error(self):
+        self.steps = [httpx.ReadError]
+        with self.assertRaises(httpx.ReadError):
+            await self.send()
+        self.assertEqual(self.attempts, 1)
+
+    async def test_get_is_retried(self):
+        self.steps = [500, 502]
+        response = await self.send("GET")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.attempts, 3)
+
+    async def test_retry_post_opt_in(self):
+        use_provider_options(retry_post=True)
+        self.steps = [500]
+        response = await self.send()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.attempts, 2)
+
+    async def test_gives_up_after_max_retries(self):
+        self.steps = [429, 429, 429, 429]
+        response = await self.send()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.attempts, 3)
+
+    async def test_long_retry_after_goes_back_to_the_client(self):
+        def handle(request):
+            self.attempts += 1
+            return httpx.Response(429, json={}, headers={"Retry-After": "3600"})
+        request_manager.CLIENT_POOL["OPENAI"] = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        response = await request_manager.send_request("POST", BASE_URL + "/v1/chat/completions", body={}, provider="OPENAI")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.attempts, 1)
+
+
+class CircuitBreakerTest(UpstreamTest):
+    def setUp(self):
+        super().setUp()
+        use_provider_options(max_failures=2, eject_duration=0.05, max_retries=0)
+
+    def circuit(self):
+        return backend_pool.get_backend_state("OPENAI", BASE_URL)["circuit"]
+
+    async def open_circuit(self):
+        self.steps = [502, 502]
+        await self.send()
+        self.assertEqual(self.circuit(), backend_pool.CIRCUIT_CLOSED)
+        await self.send()
+        self.assertEqual(self.circuit(), backend_pool.CIRCUIT_OPEN)
+
+    async def test_open_circuit_fails_fast(self):
+        await self.open_circuit()
+        attempts = self.attempts
+        response = await self.send()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.body, request_manager.ERROR_PROVIDER_UNAVAILABLE)
+        self.assertEqual(self.attempts, attempts)
+
+    async def test_successful_probe_closes_it(self):
+        await self.open_circuit()
+        await asyncio.sleep(0.06)
+        response = await self.send()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.circuit(), backend_pool.CIRCUIT_CLOSED)
+
+    async def test_failed_probe_opens_it_again(self):
+        await self.open_circuit()
+        await asyncio.sleep(0.06)
+        self.steps = [502]
+        response = await self.send()
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(self.circuit(), backend_pool.CIRCUIT_OPEN)
+        response = await self.send()
+        self.assertEqual(response.status_code, 503)
+
+    async def test_only_one_probe_at_a_time(self):
+        await self.open_circuit()
+        await asyncio.sleep(0.06)
+        probe_started = asyncio.Event()
+        finish_probe = asyncio.Event()
+        async def handle(request):
+            self.attempts += 1
+            probe_started.set()
+            await finish_probe.wait()
+            return httpx.Response(200, json={})
+        request_manager.CLIENT_POOL["OPENAI"] = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        probe = asyncio.ensure_future(request_manager.send_request("POST", BASE_URL + "/v1/chat/completions", body={}, provider="OPENAI"))
+        await probe_started.wait()
+        self.assertEqual(self.circuit(), backend_pool.CIRCUIT_HALF_OPEN)
+        response = await request_manager.send_request("POST", BASE_URL + "/v1/chat/completions", body={}, provider="OPENAI")
+        self.assertEqual(response.status_code, 503)
+        finish_probe.set()
+        self.assertEqual((await probe).status_code, 200)
+        self.assertEqual(self.circuit(), backend_pool.CIRCUIT_CLOSED)
+
+
+class ClientPoolTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        use_provider_options(read_timeout=42)
+
+    async def asyncTearDown(self):
+        await request_manager.close_clients()
+        config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+    async def test_cert_clients_are_pooled_with_the_configured_timeouts(self):
+        cert_client = request_manager.get_client("OPENAI", certifi.where())
+        self.assertIs(request_manager.get_client("OPENAI", certifi.where()), cert_client)
+        self.assertIsNot(request_manager.get_client("OPENAI"), cert_client)
+        self.assertEqual(cert_client.timeout.read, 42)
+        self.assertEqual(cert_client.timeout.connect, request_manager.DEFAULT_POOL_OPTIONS["connect_timeout"])
+
+    async def test_reload_replaces_cert_clients_too(self):
+        cert_client = request_manager.get_client("OPENAI", certifi.where())
+        old_config = config_manager.get_config()
+        use_provider_options(read_timeout=7)
+        request_manager.refresh_clients(old_config, config_manager.get_config())
+        new_client = request_manager.get_client("OPENAI", certifi.where())
+        self.assertIsNot(new_client, cert_client)
+        self.assertEqual(new_client.timeout.read, 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
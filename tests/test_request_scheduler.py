@@ -0,0 +1,268 @@
+import asyncio
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+# The scheduler reads provider options as it goes, so it gets the defaults rather than whatever file is around.
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import backend_pool
+import httpx
+import rate_limiter
+import request_manager
+import request_scheduler
+
+EMBEDDINGS = ("/v1/embeddings", "text-embedding-3-small", False)
+COMPLETIONS = ("/v1/chat/completions", "gpt-4o", False)
+BASE_URL = "http://ollama.test"
+
+request_scheduler.register_provider("OLLAMA")
+
+
+def use_config(**config_blocks):
+    config_data = copy.deepcopy(config_manager.DEFAULT_CONFIG)
+    config_data.update(config_blocks)
+    config_manager.swap_config(config_manager.build_config(config_data))
+
+
+def new_backend_queue(provider):
+    request_scheduler.BACKEND_QUEUES.pop((provider, "http://backend"), None)
+    return request_scheduler.get_backend_queue(provider, "http://backend")
+
+def full_load(backend_queue):
+    return max(1, int(backend_queue["limit"]))
+
+def saturated_latency(service_time, capacity, in_flight):
+    # A backend that works on capacity requests at once, and takes proportionally longer past that.
+    return service_time * max(1, in_flight / capacity)
+
+
+class UpdateLimitTest(unittest.TestCase):
+    def test_slow_completions_dont_drag_down_an_embeddings_baseline(self):
+        # Quick embeddings at light load, then healthy completions that always take 3s with the backend full.
+        # The completions are a different kind of request, so they can't look like the backend slowing down.
+        backend_queue = new_backend_queue("OPENAI")
+        start_limit = backend_queue["limit"]
+        for i in range(50):
+            request_scheduler.update_limit(backend_queue, EMBEDDINGS, 0.2, 1, False)
+        for i in range(500):
+            request_scheduler.update_limit(backend_queue, COMPLETIONS, 3.0, full_load(backend_queue), False)
+        self.assertGreaterEqual(backend_queue["limit"], start_limit)
+        self.assertAlmostEqual(backend_queue["latency"][EMBEDDINGS]["baseline"], 0.2)
+
+    def test_limit_settles_near_a_saturated_backends_capacity(self):
+        # A local server that runs 2 requests at a time and queues the rest, so latency grows with every
+        # request past 2. Queueing mustn't become the new normal and walk the limit up to the maximum.
+        backend_queue = new_backend_queue("OLLAMA")
+        for i in range(50):
+            request_scheduler.update_limit(backend_queue, COMPLETIONS, 0.1, 1, False)
+        for i in range(3000):
+            in_flight = full_load(backend_queue)
+            request_scheduler.update_limit(backend_queue, COMPLETIONS, saturated_latency(0.1, 2, in_flight), in_flight, False)
+        self.assertLessEqual(backend_queue["limit"], 4)
+        self.assertAlmostEqual(backend_queue["latency"][COMPLETIONS]["baseline"], 0.1)
+
+    def test_baseline_is_remeasured_after_a_backend_got_slower(self):
+        # Same backend, but every request now takes 3 times as long. The limit comes down until the backend
+        # is lightly loaded, which re-measures the baseline, and then settles again without running away.
+        backend_queue = new_backend_queue("OLLAMA")
+        for i in range(50):
+            request_scheduler.update_limit(backend_queue, COMPLETIONS, 0.1, 1, False)
+        lowest_limit = backend_queue["limit"]
+        for i in range(3000):
+            in_flight = full_load(backend_queue)
+            request_scheduler.update_limit(backend_queue, COMPLETIONS, saturated_latency(0.3, 2, in_flight), in_flight, False)
+            lowest_limit = min(lowest_limit, backend_queue["limit"])
+        self.assertLess(lowest_limit, 2)
+        self.assertGreater(backend_queue["latency"][COMPLETIONS]["baseline"], 0.2)
+        self.assertLessEqual(backend_queue["limit"], 4)
+
+    def test_overload_backs_off_to_the_minimum(self):
+        for start_limit in (1, 2, 3, 4, 6, 10, 200):
+            backend_queue = new_backend_queue("OPENAI")
+            backend_queue["limit"] = float(start_limit)
+            for i in range(60):
+                request_scheduler.update_limit(backend_queue, COMPLETIONS, None, full_load(backend_queue), True)
+            self.assertEqual(backend_queue["limit"], request_scheduler.DEFAULT_MIN_LIMIT)
+
+    def test_overload_respects_a_configured_minimum(self):
+        use_config(provider_options={"OPENAI": {"adaptive_min_concurrency": 3}})
+        try:
+            backend_queue = new_backend_queue("OPENAI")
+            for i in range(60):
+                request_scheduler.update_limit(backend_queue, COMPLETIONS, None, full_load(backend_queue), True)
+            self.assertEqual(backend_queue["limit"], 3)
+        finally:
+            use_config()
+
+
+class IsAdaptiveTest(unittest.TestCase):
+    def test_only_registered_local_servers_learn_by_default(self):
+        self.assertTrue(request_scheduler.is_adaptive("OLLAMA"))
+        self.assertFalse(request_scheduler.is_adaptive("OPENAI"))
+
+
+class QueueingTest(unittest.IsolatedAsyncioTestCase):
+    # One fixed slot, so every request after the first waits and the order they get out in is easy to see.
+    def setUp(self):
+        use_config(
+            provider_options={"OLLAMA": {"base_url": BASE_URL, "adaptive_concurrency": False, "max_concurrent_requests": 1}},
+            scheduler={"default_priority": "interactive", "max_queue_time": {"interactive": 30, "batch": 600}, "keys": {"heavy-key": {"weight": 2}}}
+        )
+        request_scheduler.BACKEND_QUEUES.pop(("OLLAMA", BASE_URL), None)
+        self.order = []
+
+    def tearDown(self):
+        use_config()
+
+    async def acquire_as(self, api_key, priority=None):
+        rate_limiter.CURRENT_KEY.set(api_key)
+        request_scheduler.set_request_priority(priority)
+        return await request_scheduler.acquire("OLLAMA", {"backend": {"base_url": BASE_URL}})
+
+    async def take_turn(self, name, api_key, priority=None):
+        scheduler_slot = await self.acquire_as(api_key, priority)
+        self.order.append(name)
+        # Handing the slot straight back lets the next one in line go.
+        request_scheduler.release(scheduler_slot)
+
+    async def run_in_queue(self, requests):
+        # Queues the requests in the given order behind a held slot, then lets them all through.
+        held_slot = await self.acquire_as("holder")
+        tasks = []
+        for request in requests:
+            tasks.append(asyncio.ensure_future(self.take_turn(*request)))
+            await asyncio.sleep(0)
+        self.assertEqual(request_scheduler.get_backend_queue("OLLAMA", BASE_URL)["waiting"], len(requests))
+        request_scheduler.release(held_slot)
+        await asyncio.gather(*tasks)
+        return self.order
+
+    async def test_same_key_goes_out_in_arrival_order(self):
+        order = await self.run_in_queue([(f"a{i}", "key-a") for i in range(5)])
+        self.assertEqual(order, ["a0", "a1", "a2", "a3", "a4"])
+
+    async def test_interactive_goes_before_batch(self):
+        order = await self.run_in_queue([("batch-0", "key-a", "batch"), ("batch-1", "key-b", "batch"), ("interactive", "key-c")])
+        self.assertEqual(order, ["interactive", "batch-0", "batch-1"])
+
+    async def test_priority_header_cant_move_a_batch_key_up(self):
+        use_config(
+            provider_options={"OLLAMA": {"base_url": BASE_URL, "adaptive_concurrency": False, "max_concurrent_requests": 1}},
+            scheduler={"default_priority": "interactive", "max_queue_time": {"interactive": 30, "batch": 600}, "keys": {"batch-key": {"priority": "batch"}}}
+        )
+        order = await self.run_in_queue([("batch-key", "batch-key", "interactive"), ("other", "key-a")])
+        self.assertEqual(order, ["other", "batch-key"])
+
+    async def test_keys_share_fairly(self):
+        # key-a queued a backlog before key-b showed up, key-b still doesn't wait behind all of it.
+        order = await self.run_in_queue([("a0", "key-a"), ("a1", "key-a"), ("a2", "key-a"), ("a3", "key-a"), ("b0", "key-b"), ("b1", "key-b")])
+        self.assertEqual(order, ["a0", "b0", "a1", "b1", "a2", "a3"])
+
+    async def test_weight_is_a_share_of_the_slots(self):
+        order = await self.run_in_queue([(f"h{i}", "heavy-key") for i in range(4)] + [(f"l{i}", "light-key") for i in range(2)])
+        self.assertEqual(order, ["h0", "h1", "l0", "h2", "h3", "l1"])
+
+    async def test_queue_timeout(self):
+        use_config(
+            provider_options={"OLLAMA": {"base_url": BASE_URL, "adaptive_concurrency": False, "max_concurrent_requests": 1}},
+            scheduler={"default_priority": "interactive", "max_queue_time": {"interactive": 0.05, "batch": 600}, "keys": {}}
+        )
+        held_slot = await self.acquire_as("holder")
+        with self.assertRaises(request_scheduler.QueueTimeoutError):
+            await self.acquire_as("key-a")
+        backend_queue = request_scheduler.get_backend_queue("OLLAMA", BASE_URL)
+        self.assertEqual(backend_queue["waiting"], 0)
+        request_scheduler.release(held_slot)
+        self.assertEqual(backend_queue["active"], 0)
+        # The timed out request's place in line is gone, so the next one gets straight in.
+        request_scheduler.release(await self.acquire_as("key-a"))
+        self.assertEqual(backend_queue["active"], 0)
+
+    async def test_giving_up_while_queued_frees_the_place(self):
+        held_slot = await self.acquire_as("holder")
+        waiting_task = asyncio.ensure_future(self.acquire_as("key-a"))
+        await asyncio.sleep(0)
+        waiting_task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting_task
+        backend_queue = request_scheduler.get_backend_queue("OLLAMA", BASE_URL)
+        self.assertEqual(backend_queue["waiting"], 0)
+        request_scheduler.release(held_slot)
+        self.assertEqual(backend_queue["active"], 0)
+
+
+class SlotReleaseTest(unittest.IsolatedAsyncioTestCase):
+    # Requests go through request_manager against a mock transport, and whatever happens to them the slot
+    # (and the backend's outstanding count) has to come back.
+    def setUp(self):
+        use_config(provider_options={"OLLAMA": {"base_url": BASE_URL, "adaptive_concurrency": False, "max_concurrent_requests": 2}})
+        request_scheduler.BACKEND_QUEUES.pop(("OLLAMA", BASE_URL), None)
+        backend_pool.BACKENDS.pop("OLLAMA", None)
+
+    async def asyncTearDown(self):
+        await request_manager.close_clients()
+        backend_pool.BACKENDS.pop("OLLAMA", None)
+        use_config()
+
+    def use_transport(self, handler):
+        request_manager.CLIENT_POOL["OLLAMA"] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def assertSlotsReturned(self):
+        self.assertEqual(request_scheduler.get_backend_queue("OLLAMA", BASE_URL)["active"], 0)
+        self.assertEqual(backend_pool.get_backend_state("OLLAMA", BASE_URL)["outstanding"], 0)
+
+    async def test_error_status(self):
+        self.use_transport(lambda request: httpx.Response(500, json={"error": "boom"}))
+        response = await request_manager.send_request("POST", BASE_URL + "/api/chat", body={}, provider="OLLAMA")
+        self.assertEqual(response.status_code, 500)
+        self.assertSlotsReturned()
+
+    async def test_transport_error(self):
+        def handler(request):
+            raise httpx.ReadError("connection reset", request=request)
+        self.use_transport(handler)
+        with self.assertRaises(httpx.ReadError):
+            await request_manager.send_request("POST", BASE_URL + "/api/chat", body={}, provider="OLLAMA")
+        self.assertSlotsReturned()
+
+    async def test_stream_closed_early(self):
+        async def stream_lines():
+            for i in range(100):
+                yield f'{{"message": {{"content": "{i}"}}}}\n'.encode("utf-8")
+                await asyncio.sleep(0.01)
+        self.use_transport(lambda request: httpx.Response(200, content=stream_lines()))
+        response = await request_manager.open_stream("POST", BASE_URL + "/api/chat", body={}, provider="OLLAMA")
+        self.assertEqual(request_scheduler.get_backend_queue("OLLAMA", BASE_URL)["active"], 1)
+        response_lines = request_manager.iter_ndjson(response.body)
+        await response_lines.__anext__()
+        # The client went away after the first chunk.
+        await response_lines.aclose()
+        self.assertSlotsReturned()
+
+    async def test_stream_cancelled_mid_read(self):
+        async def stream_lines():
+            yield b'{"message": {"content": "first"}}\n'
+            await asyncio.sleep(30)
+            yield b'{"message": {"content": "never"}}\n'
+        self.use_transport(lambda request: httpx.Response(200, content=stream_lines()))
+
+        async def read_stream():
+            response = await request_manager.open_stream("POST", BASE_URL + "/api/chat", body={}, provider="OLLAMA")
+            async for line in request_manager.iter_ndjson(response.body):
+                pass
+        read_task = asyncio.ensure_future(read_stream())
+        await asyncio.sleep(0.05)
+        read_task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await read_task
+        self.assertSlotsReturned()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import copy
+import json
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import response_cache
+
+REQUEST_BODY = {"model": "gpt-4o", "temperature": 0, "messages": [{"role": "user", "content": "Hello"}]}
+COMPLETION = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "model": "gpt-4o",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hi!"}, "logprobs": None, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}
+}
+
+
+def use_cache_options(**cache_options):
+    config_data = copy.deepcopy(config_manager.DEFAULT_CONFIG)
+    config_data["response_cache"] = dict(config_data["response_cache"], enabled=True, **cache_options)
+    config_manager.swap_config(config_manager.build_config(config_data))
+
+def header_info(**extra_headers):
+    return dict({"llm_provider": "OPENAI"}, **extra_headers)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        use_cache_options()
+        for cache_key in list(response_cache.RESPONSE_CACHE):
+            response_cache.remove_entry(cache_key)
+
+    def tearDown(self):
+        config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+    def store(self, header_info, request_body=REQUEST_BODY):
+        cache_key = response_cache.make_cache_key(header_info, request_body)
+        response_cache.put_response(cache_key, COMPLETION)
+        return cache_key
+
+    def test_same_request_hits(self):
+        self.store(header_info())
+        # Fields that can't change the answer don't split the key.
+        cache_key = response_cache.make_cache_key(header_info(), dict(REQUEST_BODY, stream=True, user="someone"))
+        self.assertEqual(response_cache.get_response(cache_key, header_info()), COMPLETION)
+
+    def test_different_request_misses(self):
+        self.store(header_info())
+        for request_body in (dict(REQUEST_BODY, model="gpt-4o-mini"), dict(REQUEST_BODY, max_tokens=10), dict(REQUEST_BODY, messages=[{"role": "user", "content": "Bye"}])):
+            cache_key = response_cache.make_cache_key(header_info(), request_body)
+            self.assertIsNone(response_cache.get_response(cache_key, header_info()))
+        cache_key = response_cache.make_cache_key(header_info(llm_provider="GROQ"), REQUEST_BODY)
+        self.assertIsNone(response_cache.get_response(cache_key, header_info(llm_provider="GROQ")))
+
+    def test_provider_keys_dont_share_entries(self):
+        self.store(header_info(provider_auth="sk-tenant-a"))
+        for other_info in (header_info(provider_auth="sk-tenant-b"), header_info()):
+            cache_key = response_cache.make_cache_key(other_info, REQUEST_BODY)
+            self.assertIsNone(response_cache.get_response(cache_key, other_info))
+        cache_key = response_cache.make_cache_key(header_info(provider_auth="sk-tenant-a"), REQUEST_BODY)
+        self.assertEqual(response_cache.get_response(cache_key, header_info(provider_auth="sk-tenant-a")), COMPLETION)
+
+    def test_sampled_requests_arent_cached(self):
+        self.assertIsNone(response_cache.make_cache_key(header_info(), dict(REQUEST_BODY, temperature=0.7)))
+        self.assertIsNotNone(response_cache.make_cache_key(header_info(), dict(REQUEST_BODY, temperature=0.7, seed=1)))
+
+    def test_expired_entries_miss(self):
+        use_cache_options(ttl=0.01)
+        cache_key = self.store(header_info())
+        time.sleep(0.02)
+        self.assertIsNone(response_cache.get_response(cache_key, header_info()))
+        self.assertNotIn(cache_key, response_cache.RESPONSE_CACHE)
+
+    def test_no_cache_skips_the_copy_but_refreshes_it(self):
+        cache_key = self.store(header_info())
+        self.assertEqual(response_cache.make_cache_key(header_info(cache_bypass="no-cache"), REQUEST_BODY), cache_key)
+        self.assertIsNone(response_cache.get_response(cache_key, header_info(cache_bypass="no-cache")))
+        response_cache.put_response(cache_key, dict(COMPLETION, id="chatcmpl-2"))
+        self.assertEqual(response_cache.get_response(cache_key, header_info())["id"], "chatcmpl-2")
+
+    def test_no_store_leaves_the_cache_alone(self):
+        self.assertIsNone(response_cache.make_cache_key(header_info(cache_bypass="no-store"), REQUEST_BODY))
+        response_cache.put_response(None, COMPLETION)
+        self.assertEqual(len(response_cache.RESPONSE_CACHE), 0)
+
+    def test_byte_budget_evicts_least_recently_used(self):
+        entry_size = len(json.dumps(COMPLETION))
+        use_cache_options(max_bytes=entry_size * 2)
+        first_key = self.store(header_info(), dict(REQUEST_BODY, seed=1))
+        second_key = self.store(header_info(), dict(REQUEST_BODY, seed=2))
+        response_cache.get_response(first_key, header_info())
+        self.store(header_info(), dict(REQUEST_BODY, seed=3))
+        self.assertIn(first_key, response_cache.RESPONSE_CACHE)
+        self.assertNotIn(second_key, response_cache.RESPONSE_CACHE)
+
+    def test_finished_stream_is_cached_as_a_completion(self):
+        response_chunks = [
+            json.dumps({"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "gpt-4o", "choices": [{"index": 0, "delta": {"role": "assistant", "content": "Hi"}, "finish_reason": None}]}),
+            json.dumps({"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "gpt-4o", "choices": [{"index": 0, "delta": {"content": "!"}, "finish_reason": "stop"}]}),
+            "[DONE]"
+        ]
+        completion = response_cache.assemble_stream_chunks(response_chunks)
+        self.assertEqual(completion["choices"][0]["message"], {"role": "assistant", "content": "Hi!"})
+        self.assertEqual(completion["choices"][0]["finish_reason"], "stop")
+        # A stream cut off before it finished isn't worth keeping.
+        self.assertIsNone(response_cache.assemble_stream_chunks(response_chunks[:1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import copy
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_manager
+
+config_manager.swap_config(config_manager.build_config(copy.deepcopy(config_manager.DEFAULT_CONFIG)))
+
+import adapter_anthropic
+import adapter_ollama
+import httpx
+
+# Golden transcripts: a recorded upstream stream in tests/transcripts, and next to it the OpenAI chunks it has
+# to come out as. Run with UPDATE_TRANSCRIPTS=1 to rewrite the .expected.json files after a deliberate change,
+# then read the diff.
+TRANSCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts")
+# Small enough that lines and events get split across network reads, like they do for real.
+READ_SIZE = 7
+
+
+async def open_transcript(file_name):
+    with open(os.path.join(TRANSCRIPT_DIR, file_name), "rb") as transcript_file:
+        transcript = transcript_file.read()
+
+    async def read_transcript():
+        for i in range(0, len(transcript), READ_SIZE):
+            yield transcript[i:i + READ_SIZE]
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=read_transcript())))
+    upstream = await client.send(client.build_request("POST", "http://upstream.test/chat"), stream=True)
+    return client, upstream
+
+def parse_chunks(response_chunks):
+    # created is the time of the request (and so is the id, when the upstream didn't send one), everything
+    # else has to match exactly.
+    parsed_chunks = []
+    for response_chunk in response_chunks:
+        if response_chunk == "[DONE]":
+            parsed_chunks.append(response_chunk)
+            continue
+        parsed_chunk = json.loads(response_chunk)
+        if "created" in parsed_chunk:
+            if parsed_chunk.get("id") == f"chatcmpl-{parsed_chunk['created']}":
+                parsed_chunk["id"] = "chatcmpl-0"
+            parsed_chunk["created"] = 0
+        parsed_chunks.append(parsed_chunk)
+    return parsed_chunks
+
+
+class StreamTranslationTest(unittest.IsolatedAsyncioTestCase):
+    async def translate(self, file_name, translate_stream, model_name):
+        client, upstream = await open_transcript(file_name)
+        try:
+            response_chunks = [response_chunk async for response_chunk in translate_stream(upstream, model_name)]
+        finally:
+            await client.aclose()
+        self.assertTrue(upstream.is_closed)
+        return parse_chunks(response_chunks)
+
+    async def assertMatchesTranscript(self, file_name, translate_stream, model_name):
+        parsed_chunks = await self.translate(file_name, translate_stream, model_name)
+        expected_path = os.path.join(TRANSCRIPT_DIR, os.path.splitext(file_name)[0] + ".expected.json")
+        if os.environ.get("UPDATE_TRANSCRIPTS"):
+            with open(expected_path, "w") as expected_file:
+                json.dump(parsed_chunks, expected_file, indent=2)
+                expected_file.write("\n")
+        with open(expected_path, "r") as expected_file:
+            self.assertEqual(parsed_chunks, json.load(expected_file))
+        return parsed_chunks
+
+    async def test_ollama_chat(self):
+        parsed_chunks = await self.assertMatchesTranscript("ollama_chat.ndjson", adapter_ollama.stream_chat_response, "llama3:latest")
+        self.assertEqual("".join(chunk["choices"][0]["delta"].get("content", "") for chunk in parsed_chunks[:-2]), "The sky is blue.")
+        self.assertEqual(parsed_chunks[-2]["usage"], {"prompt_tokens": 26, "completion_tokens": 4, "total_tokens": 30})
+        self.assertEqual(parsed_chunks[-1], "[DONE]")
+
+    async def test_ollama_chat_cut_off_by_length(self):
+        parsed_chunks = await self.assertMatchesTranscript("ollama_chat_length.ndjson", adapter_ollama.stream_chat_response, "llama3:latest")
+        self.assertEqual(parsed_chunks[-3]["choices"][0]["finish_reason"], "length")
+        # No prompt_eval_count when Ollama had the prompt cached.
+        self.assertEqual(parsed_chunks[-2]["usage"]["prompt_tokens"], 0)
+
+    async def test_ollama_error_mid_stream(self):
+        parsed_chunks = await self.assertMatchesTranscript("ollama_chat_error.ndjson", adapter_ollama.stream_chat_response, "llama3:latest")
+        self.assertEqual(parsed_chunks[-2]["error"]["type"], "upstream_error")
+        self.assertEqual(parsed_chunks[-1], "[DONE]")
+        self.assertNotIn("never sent", json.dumps(parsed_chunks))
+
+    async def test_anthropic_text_and_tool_use(self):
+        parsed_chunks = await self.assertMatchesTranscript("anthropic_messages.sse", adapter_anthropic.stream_messages_response, "claude-3-haiku-20240307")
+        self.assertEqual(parsed_chunks[0]["id"], "chatcmpl-01XFDUDYJgAACzvnptvVoYEL")
+        arguments = "".join(tool_call["function"]["arguments"] for chunk in parsed_chunks[:-2] for tool_call in chunk["choices"][0]["delta"].get("tool_calls", []))
+        self.assertEqual(json.loads(arguments), {"location": "San Francisco, CA"})
+        self.assertEqual(parsed_chunks[-3]["choices"][0]["finish_reason"], "tool_calls")
+        self.assertEqual(parsed_chunks[-2]["usage"], {"prompt_tokens": 472, "completion_tokens": 89, "total_tokens": 561})
+        self.assertEqual(parsed_chunks[-1], "[DONE]")
+
+    async def test_anthropic_error_mid_stream(self):
+        parsed_chunks = await self.assertMatchesTranscript("anthropic_messages_error.sse", adapter_anthropic.stream_messages_response, "claude-3-haiku-20240307")
+        self.assertEqual(parsed_chunks[-2], {"error": {"type": "overloaded_error", "message": "Overloaded"}})
+        self.assertEqual(parsed_chunks[-1], "[DONE]")
+        self.assertNotIn("never sent", json.dumps(parsed_chunks))
+
+
+if __name__ == "__main__":
+    unittest.main()
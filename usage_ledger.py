@@ -0,0 +1,208 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import config_manager
+import log_manager
+import metrics
+import rate_limiter
+
+LOGGER = log_manager.get_logger("usage_ledger")
+
+# Requests and tokens by API key, provider, model and minute, for chargeback. Usage is added up in memory
+# as responses finish and a background task writes the totals to a SQLite file every flush_interval
+# seconds, so the request path never touches the disk.
+DEFAULT_LEDGER_OPTIONS = {
+    "enabled": True,
+    # Empty to keep the ledger in memory only.
+    "disk_path": "usage_ledger.db",
+    "flush_interval": 10,
+    # Minutes older than this are dropped from the file.
+    "retention_days": 400,
+    # Keys are stored hashed. Name them here to see names in the ledger instead, e.g. {"team-a-key": "team-a"}.
+    "key_names": {}
+}
+BUCKET_SECONDS = 60
+ROLLUP_SECONDS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400
+}
+# How often old rows are pruned.
+PRUNE_INTERVAL = 3600
+
+# (minute, key id, provider, model) -> [requests, prompt tokens, completion tokens]
+PENDING_USAGE = {}
+LEDGER = None
+LEDGER_LOCK = threading.Lock()
+FLUSH_TASK = None
+LAST_PRUNE = 0.0
+
+
+def get_ledger_options():
+    ledger_options = dict(DEFAULT_LEDGER_OPTIONS)
+    ledger_options.update(config_manager.get_config().get("usage_ledger", {}))
+    return ledger_options
+
+def get_key_id(api_key, ledger_options):
+    return rate_limiter.get_key_id(api_key, ledger_options["key_names"])
+
+def get_pending_totals(provider, model_name):
+    # Just a dict lookup, the disk only sees it on the next flush. None when the ledger is off.
+    ledger_options = get_ledger_options()
+    if not ledger_options["enabled"]:
+        return None
+    minute = int(time.time()) // BUCKET_SECONDS * BUCKET_SECONDS
+    ledger_key = (minute, get_key_id(rate_limiter.CURRENT_KEY.get(), ledger_options), provider or "", model_name or "")
+    totals = PENDING_USAGE.get(ledger_key)
+    if totals is None:
+        totals = [0, 0, 0]
+        PENDING_USAGE[ledger_key] = totals
+    return totals
+
+def record_request(provider, model_name):
+    # Called by the route handlers once per /v1 call, whether or not the response ever reports usage
+    # (cache hits, coalesced followers and streams without include_usage all count).
+    totals = get_pending_totals(provider, model_name)
+    if totals is not None:
+        totals[0] += 1
+
+def record_usage(provider, model_name, usage):
+    # Usage listener, adds the tokens a client received to its key.
+    totals = get_pending_totals(provider, model_name)
+    if totals is not None:
+        totals[1] += usage.get("prompt_tokens") or 0
+        totals[2] += usage.get("completion_tokens") or 0
+
+metrics.add_usage_listener(record_usage)
+
+# -- STORAGE --
+
+def open_ledger():
+    global LEDGER
+    if LEDGER is not None:
+        return LEDGER
+    disk_path = get_ledger_options()["disk_path"] or ":memory:"
+    with LEDGER_LOCK:
+        connection = sqlite3.connect(disk_path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS usage (
+            bucket INTEGER NOT NULL,
+            key_id TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            PRIMARY KEY (bucket, key_id, provider, model)
+        )""")
+        connection.commit()
+        LEDGER = connection
+    return LEDGER
+
+def write_usage(rows, prune_before):
+    connection = open_ledger()
+    with LEDGER_LOCK:
+        # Adds to whatever the minute already has, since a minute can be flushed more than once.
+        connection.executemany("""INSERT INTO usage (bucket, key_id, provider, model, requests, prompt_tokens, completion_tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (bucket, key_id, provider, model) DO UPDATE SET
+                requests = requests + excluded.requests,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens""", rows)
+        if prune_before is not None:
+            connection.execute("DELETE FROM usage WHERE bucket < ?", (prune_before,))
+        connection.commit()
+
+async def flush_usage():
+    global PENDING_USAGE
+    global LAST_PRUNE
+    if len(PENDING_USAGE) == 0:
+        return
+    pending_usage = PENDING_USAGE
+    PENDING_USAGE = {}
+    rows = [ledger_key + tuple(totals) for ledger_key, totals in pending_usage.items()]
+    prune_before = None
+    if time.monotonic() - LAST_PRUNE > PRUNE_INTERVAL:
+        LAST_PRUNE = time.monotonic()
+        prune_before = int(time.time()) - get_ledger_options()["retention_days"] * 86400
+    try:
+        await asyncio.to_thread(write_usage, rows, prune_before)
+    except Exception as e:
+        # Put it back so it goes out with the next flush instead of being lost.
+        LOGGER.warning("Failed to write %s usage rows to the ledger: %s", len(rows), e)
+        for ledger_key, totals in pending_usage.items():
+            current_totals = PENDING_USAGE.setdefault(ledger_key, [0, 0, 0])
+            for i in range(3):
+                current_totals[i] += totals[i]
+
+async def run_flushes():
+    while True:
+        await asyncio.sleep(get_ledger_options()["flush_interval"])
+        await flush_usage()
+
+def start_ledger():
+    global FLUSH_TASK
+    if FLUSH_TASK is None:
+        open_ledger()
+        FLUSH_TASK = config_manager.start_background_task(run_flushes())
+
+async def stop_ledger():
+    global FLUSH_TASK
+    global LEDGER
+    if FLUSH_TASK is not None:
+        FLUSH_TASK.cancel()
+        FLUSH_TASK = None
+    await flush_usage()
+    if LEDGER is not None:
+        with LEDGER_LOCK:
+            LEDGER.close()
+            LEDGER = None
+
+# -- QUERIES --
+
+def read_usage(rollup_seconds, start_time, end_time, filters):
+    connection = open_ledger()
+    conditions = ["bucket >= ?", "bucket < ?"]
+    parameters = [start_time, end_time]
+    for column, value in filters.items():
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    if rollup_seconds is None:
+        bucket_column = "MIN(bucket)"
+        group_by = "key_id, provider, model"
+    else:
+        bucket_column = f"bucket / {rollup_seconds} * {rollup_seconds}"
+        group_by = "1, key_id, provider, model"
+    query = f"""SELECT {bucket_column}, key_id, provider, model, SUM(requests), SUM(prompt_tokens), SUM(completion_tokens)
+        FROM usage WHERE {" AND ".join(conditions)} GROUP BY {group_by} ORDER BY 1, key_id, provider, model"""
+    with LEDGER_LOCK:
+        return connection.execute(query, parameters).fetchall()
+
+async def query_usage(rollup="hour", start_time=None, end_time=None, key_id=None, provider=None, model_name=None):
+    # Totals by rollup ("minute", "hour", "day" or "total") between two unix times, last 24 hours by default.
+    # Anything still waiting for a flush is written out first so the answer is up to date.
+    await flush_usage()
+    if end_time is None:
+        end_time = int(time.time()) + BUCKET_SECONDS
+    if start_time is None:
+        start_time = end_time - 86400
+    filters = {"key_id": key_id, "provider": provider, "model": model_name}
+    rows = await asyncio.to_thread(read_usage, ROLLUP_SECONDS.get(rollup), start_time, end_time, filters)
+    return {
+        "rollup": rollup,
+        "start": start_time,
+        "end": end_time,
+        "usage": [{
+            "start": bucket,
+            "key": row_key_id,
+            "provider": row_provider,
+            "model": row_model,
+            "requests": requests,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        } for bucket, row_key_id, row_provider, row_model, requests, prompt_tokens, completion_tokens in rows]
+    }
@@ -5,15 +5,29 @@ import time
 
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request, Depends
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 
 import config_manager
 config_manager.init_config()
 
+import log_manager
+log_manager.setup_logging()
+LOGGER = log_manager.get_logger("warp_pipe")
+
 
 import request_manager
+import embedding_cache
+import response_cache
+import request_coalescer
+import request_hedger
+import rate_limiter
+import request_scheduler
+import usage_ledger
+import metrics
+import backend_pool
+import oai_tools
 
 import adapter_ollama
 import adapter_groq
@@ -33,12 +47,19 @@ ROUTE_DB = {
     "LMSTUDIO": adapter_lmstudio.process_request  
 }
 
+# Providers that rename models on the way out, so cached responses are keyed by what actually ran.
+MODEL_RESOLVERS = {
+    "OLLAMA": adapter_ollama.resolve_model_name
+}
+
 def get_adapter_route(provider):
     return ROUTE_DB.get(provider, None)
 
 
 app = FastAPI()
 
+# Added first so it sits inside CORS, and 429s still carry the CORS headers browsers need to read them.
+app.add_middleware(rate_limiter.RateLimitMiddleware)
 # Set up CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -47,94 +68,60 @@ app.add_middleware(
     allow_methods=["*"],  # Or specify methods e.g., ["GET", "POST"]
     allow_headers=["*"],  # Or specify headers
 )
-
-def split_string_by_length(text, end):
-    return [text[i:i+end] for i in range(0,len(text),end)]
-
-# OpenAI has a very specific chunk setup it needs and various apis evaluate it differently
-# so it has to match EXACTLY... let's do that globally.
-def generate_response_chunks(response_data):
-    response_chunks = []
-    chat_id = response_data['id']
-    created_time = int(time.time())
-    selected_model = response_data['model']
-    system_fingerprint = "warp-pipe-001"
-    # TODO - Actually chunk this out so it streams all pretty.
-    response_message = response_data['choices'][0]['message']
-    response_content = response_message['content']
-
-    # First chunk has no content
-    first_response_message = response_message
-    first_response_message['content'] = ""
-
-    i_chunk = {
-        'id':chat_id,
-        'object':'chat.completion.chunk',
-        'created':created_time,
-        'model':selected_model,
-        'system_fingerprint':system_fingerprint,
-        'choices':[{
-            "index":0,
-            "delta":first_response_message,
-            "logprobs":None,
-            "finish_reason":None
-    }]}
-
-    response_chunks.append(json.dumps(i_chunk))
-
-    if response_content and len(response_content) > 1:
-        c_content = split_string_by_length(response_content,4096)
-        for cc in c_content:
-            c_chunk = {
-                'id':chat_id,
-                'object':'chat.completion.chunk',
-                'created':created_time,
-                'model':selected_model,
-                'system_fingerprint':system_fingerprint,
-                'choices':[{
-                    "index":0,
-                    "delta":{"content":cc},
-                    "logprobs":None,
-                    "finish_reason":None
-                    }
-                ]
-            }
-            response_chunks.append(json.dumps(c_chunk))
-
-    # Yup - it does this.
-    final_chunk = {"id":chat_id,"object":"chat.completion.chunk","created":created_time,"model":selected_model,"system_fingerprint":system_fingerprint,"choices":[{"index":0,"delta":{},"logprobs":None,"finish_reason":"stop"}]}
-    response_chunks.append(json.dumps(final_chunk))
-
-    # It also does this.
-    response_chunks.append("[DONE]")
-    return response_chunks
+app.add_middleware(metrics.MetricsMiddleware)
+# Added last so it runs first and everything below it logs with the request id.
+app.add_middleware(log_manager.RequestIdMiddleware)
+app.add_middleware(config_manager.ConfigSnapshotMiddleware)
+
+CONFIG_WATCH_TASK = None
+
+# Upstream clients live for the lifetime of the app so connections get reused.
+@app.on_event("startup")
+async def startup_event():
+    global CONFIG_WATCH_TASK
+    request_manager.init_clients()
+    embedding_cache.open_disk_cache()
+    CONFIG_WATCH_TASK = config_manager.start_background_task(config_manager.watch_config())
+    backend_pool.start_health_checks()
+    usage_ledger.start_ledger()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if CONFIG_WATCH_TASK is not None:
+        CONFIG_WATCH_TASK.cancel()
+    backend_pool.stop_health_checks()
+    await request_manager.close_clients()
+    await embedding_cache.close_disk_cache()
+    await usage_ledger.stop_ledger()
+    log_manager.stop_logging()
 
 async def stream_response_data(response_data):
-    response_chunks = generate_response_chunks(response_data)
-    print("Response Chunks")
-    for rc in response_chunks:
-        print(f"data: {rc}\n\n")
+    response_chunks = oai_tools.generate_response_chunks(response_data)
+    log_manager.log_payload(LOGGER, "fallback_stream_chunks", "Response chunks", response_chunks)
 
     for chunk in response_chunks:
         yield f"data: {chunk}\n\n"
         #await asyncio.sleep(0.1)
 
+# Adapters that can stream for real hand us their chunks as they arrive, we just frame them.
+async def relay_response_chunks(response_chunks):
+    async for chunk in response_chunks:
+        yield f"data: {chunk}\n\n"
+
 
 # Dependency for API key authorization
 async def verify_api_key(request: Request):
-    global ERROR_AUTH_RESPONSE
-    global API_KEYS
-    if config_manager.APP_CONFIG["auth_enforcement_enabled"]:
+    if config_manager.get_config()["auth_enforcement_enabled"]:
         authorization: str = request.headers.get("Authorization")
         if not authorization:
             raise HTTPException(status_code=401, detail=request_manager.ERROR_AUTH_RESPONSE)
         token_type, _, api_key = authorization.partition(' ')
-        if token_type.lower() != "bearer" or api_key not in API_KEYS:
+        if token_type.lower() != "bearer" or api_key not in config_manager.get_config()["api_keys"]:
             raise HTTPException(status_code=401, detail=request_manager.ERROR_AUTH_RESPONSE)
 
 async def get_header_info(request_headers):
     header_info = {
-        "llm_provider": request_headers.get("LLM_PROVIDER", config_manager.APP_CONFIG["default_provider"]).upper(),
+        "llm_provider": request_headers.get("LLM_PROVIDER", config_manager.get_config()["default_provider"]).upper(),
     }   
     # Provider Auth Passthrough 
     provider_auth = request_headers.get("PROVIDER_AUTH","")
@@ -152,6 +139,13 @@ async def get_header_info(request_headers):
  
     if "MAX_CONTEXT" in request_headers:
         header_info["max_context"] = request_headers["MAX_CONTEXT"]
+
+    # no-cache skips the cached copy but still refreshes it, no-store leaves the cache alone entirely.
+    cache_control = request_headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control:
+        header_info["cache_bypass"] = "no-store"
+    elif "no-cache" in cache_control or "NO_CACHE" in request_headers:
+        header_info["cache_bypass"] = "no-cache"
     return header_info
 
 
@@ -168,12 +162,43 @@ async def handle_completions(request: Request,_=Depends(verify_api_key)):
         raise HTTPException(status_code=400, detail=request_manager.ERROR_BAD_REQUEST)
     
     stream_response = request_body.get("stream", False)
-    
-    # Assuming non-streaming fetch from the provider          
-    response = await process_request(request.url.path, header_info, request_body)
+    metrics.set_request_labels(request, header_info['llm_provider'], request_body.get("model"))
+    usage_ledger.record_request(header_info['llm_provider'], request_body.get("model"))
+    request_scheduler.set_request_priority(request.headers.get("X-Priority"))
+
+    # Keyed before the adapter gets its hands on the body, since some of them rewrite it.
+    cache_key = response_cache.make_cache_key(header_info, request_body, MODEL_RESOLVERS.get(header_info['llm_provider']))
+    cached_response = response_cache.get_response(cache_key, header_info)
+    if cached_response is not None:
+        metrics.record_client_usage(header_info['llm_provider'], request_body.get("model"), cached_response.get("usage"))
+        if stream_response:
+            return StreamingResponse(stream_response_data(cached_response),media_type='text/event-stream')
+        return cached_response
+
+    # Adapters that support it return a live stream, the rest get chunked up after the fact.
+    # Only the first of a burst of identical requests actually runs this, the rest share its response.
+    async def send_completion():
+        response = await request_hedger.run_hedged(header_info['llm_provider'], request.url.path, lambda body: process_request(request.url.path, header_info, body), request_body)
+        if response.success and response.stream:
+            response.body = metrics.count_stream_usage(response.body, header_info['llm_provider'], request_body.get("model"))
+            if cache_key is not None:
+                response.body = response_cache.record_stream(cache_key, response.body)
+        elif response.success:
+            metrics.record_usage(header_info['llm_provider'], request_body.get("model"), response.body.get("usage"))
+            response_cache.put_response(cache_key, response.body)
+        return response
+
+    coalescing_key = request_coalescer.make_coalescing_key(request.url.path, header_info, request_body)
+    response = await request_coalescer.run_coalesced(coalescing_key, send_completion)
     if response.success is False:
         raise HTTPException(status_code=response.status_code, detail=response.body)
 
+    # Charged here rather than in send_completion, so every client sharing a coalesced response pays for it
+    # with its own key, not the one that happened to go upstream.
+    if response.stream:
+        response_chunks = metrics.count_stream_usage(response.body, header_info['llm_provider'], request_body.get("model"), metrics.record_client_usage)
+        return StreamingResponse(relay_response_chunks(response_chunks),media_type='text/event-stream')
+    metrics.record_client_usage(header_info['llm_provider'], request_body.get("model"), response.body.get("usage"))
     if stream_response:
         # Create a StreamingResponse from an async generator
         return StreamingResponse(stream_response_data(response.body),media_type='text/event-stream')
@@ -195,12 +220,73 @@ async def get_embeddings(request: Request,_=Depends(verify_api_key)):
     except:
         raise HTTPException(status_code=400, detail=request_manager.ERROR_BAD_REQUEST)
 
-    response = await process_request(request.url.path, header_info, request_body)
+    metrics.set_request_labels(request, header_info['llm_provider'], request_body.get("model"))
+    usage_ledger.record_request(header_info['llm_provider'], request_body.get("model"))
+    request_scheduler.set_request_priority(request.headers.get("X-Priority"))
+
+    async def send_embeddings():
+        response = await request_hedger.run_hedged(header_info['llm_provider'], request.url.path, lambda body: process_request(request.url.path, header_info, body), request_body)
+        if response.success:
+            metrics.record_usage(header_info['llm_provider'], request_body.get("model"), response.body.get("usage"))
+        return response
+
+    coalescing_key = request_coalescer.make_coalescing_key(request.url.path, header_info, request_body)
+    response = await request_coalescer.run_coalesced(coalescing_key, send_embeddings)
     if response.success is False:
         raise HTTPException(status_code=response.status_code, detail=response.body)
-    
+
+    metrics.record_client_usage(header_info['llm_provider'], request_body.get("model"), response.body.get("usage"))
     return response.body
 
+@app.get("/warp_pipe/cache/embeddings")
+async def get_embedding_cache_stats(request: Request,_=Depends(verify_api_key)):
+    return embedding_cache.get_cache_stats()
+
+@app.get("/warp_pipe/cache/responses")
+async def get_response_cache_stats(request: Request,_=Depends(verify_api_key)):
+    return response_cache.get_cache_stats()
+
+@app.get("/warp_pipe/coalescing")
+async def get_coalescing_stats(request: Request,_=Depends(verify_api_key)):
+    return request_coalescer.get_coalescing_stats()
+
+@app.get("/warp_pipe/hedging")
+async def get_hedging_stats(request: Request,_=Depends(verify_api_key)):
+    return request_hedger.get_hedging_stats()
+
+@app.get("/warp_pipe/scheduler")
+async def get_scheduler_stats(request: Request,_=Depends(verify_api_key)):
+    return request_scheduler.get_scheduler_stats()
+
+@app.get("/warp_pipe/usage")
+async def get_usage(request: Request, rollup: str = "hour", start: int = None, end: int = None, key: str = None, provider: str = None, model: str = None, _=Depends(verify_api_key)):
+    if rollup != "total" and rollup not in usage_ledger.ROLLUP_SECONDS:
+        raise HTTPException(status_code=400, detail=request_manager.ERROR_BAD_REQUEST)
+    return await usage_ledger.query_usage(rollup, start, end, key, provider, model)
+
+@app.get("/warp_pipe/rate_limits")
+async def get_rate_limit_stats(request: Request,_=Depends(verify_api_key)):
+    return rate_limiter.get_rate_limit_stats()
+
+@app.get("/warp_pipe/backends")
+async def get_backend_stats(request: Request,_=Depends(verify_api_key)):
+    return backend_pool.get_backend_stats()
+
+# Re-reads the config file now instead of waiting for the watcher. In-flight requests finish on the old config.
+@app.post("/warp_pipe/config/reload")
+async def reload_config(request: Request,_=Depends(verify_api_key)):
+    try:
+        await config_manager.reload_config()
+    except Exception as e:
+        LOGGER.warning("Configuration reload failed, keeping the current one: %s", e)
+        raise HTTPException(status_code=400, detail={"error": {"message": f"Configuration reload failed: {e}", "type": "invalid_config", "param": None, "code": None}})
+    return {"reloaded": True}
+
+# Prometheus scrape endpoint, scrapers can send the API key as a bearer token.
+@app.get("/metrics")
+async def get_metrics(request: Request,_=Depends(verify_api_key)):
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
 # --- MODELS ROUTING ---
 
 # List all available models.
@@ -210,6 +296,8 @@ async def get_models(request: Request, _=Depends(verify_api_key)):
     process_request = get_adapter_route(header_info['llm_provider'])
     if process_request is None:
         raise HTTPException(status_code=400, detail=request_manager.ERROR_PROVIDER_RESPONSE)
+    metrics.set_request_labels(request, header_info['llm_provider'], None)
+    usage_ledger.record_request(header_info['llm_provider'], None)
 
     response = await process_request(request.url.path, header_info, None) 
     if response.success is False:
@@ -223,6 +311,8 @@ async def get_model(request: Request, model_id: str, _=Depends(verify_api_key)):
     process_request = get_adapter_route(header_info['llm_provider'])
     if process_request is None:
         raise HTTPException(status_code=400, detail=request_manager.ERROR_PROVIDER_RESPONSE)
+    metrics.set_request_labels(request, header_info['llm_provider'], None)
+    usage_ledger.record_request(header_info['llm_provider'], None)
 
     response = await process_request(request.url.path, header_info, None)
     if response.success is False: